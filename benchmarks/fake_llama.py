@@ -0,0 +1,152 @@
+"""Deterministic stand-in for `llama_cpp.Llama` used by the benchmarks.
+
+It tokenizes on whitespace and on the special tokens of the llama-3 chat format, and answers
+with a fixed number of tokens. Prefill and decode are simulated with configurable per-token
+sleeps, so that latency measurements exercise the whole serving stack without loading a model.
+Like llama.cpp, it only re-evaluates the prompt tokens that differ from the ones already in its
+context. `FakeEmbedding` likewise stands in for the embedding model of the retrieval mode.
+
+The delays are read from the environment, so they also apply in worker processes:
+    FAKE_LLAMA_PREFILL_S_PER_TOKEN  (default 0.0005)
+    FAKE_LLAMA_DECODE_S_PER_TOKEN   (default 0.005)
+    FAKE_LLAMA_RESPONSE_TOKENS      (default 32)
+"""
+import os
+import re
+import time
+import zlib
+from typing import Iterator, List, Optional
+
+import numpy as np
+from llama_cpp import LlamaState
+from llama_cpp.llama_chat_format import format_llama3
+
+PREFILL_S_PER_TOKEN = float(os.environ.get("FAKE_LLAMA_PREFILL_S_PER_TOKEN", "0.0005"))
+DECODE_S_PER_TOKEN = float(os.environ.get("FAKE_LLAMA_DECODE_S_PER_TOKEN", "0.005"))
+RESPONSE_TOKENS = int(os.environ.get("FAKE_LLAMA_RESPONSE_TOKENS", "32"))
+
+VOCAB_SIZE = 32000
+BOS_TOKEN = 1
+SPECIAL_TOKENS = {"<|start_header_id|>": 2, "<|end_header_id|>": 3, "<|eot_id|>": 4}
+SPECIAL_TOKEN_PATTERN = re.compile("(" + "|".join(re.escape(token) for token in SPECIAL_TOKENS) + ")")
+
+
+class FakeLlama:
+    """Implements the parts of the `Llama` interface used by the backend."""
+
+    def __init__(self, n_ctx: int = 10000, **kwargs):
+        self.n_ctx = n_ctx
+        self._input_ids: List[int] = []
+        self.num_prefilled_tokens = 0  # statistics for the benchmark report
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        tokens = [BOS_TOKEN] if add_bos else []
+        pieces = SPECIAL_TOKEN_PATTERN.split(text.decode("utf-8")) if special else [text.decode("utf-8")]
+        for piece in pieces:
+            if special and piece in SPECIAL_TOKENS:
+                tokens.append(SPECIAL_TOKENS[piece])
+            else:
+                tokens += [zlib.crc32(word.encode("utf-8")) % VOCAB_SIZE for word in piece.split()]
+        return tokens
+
+    def eval(self, tokens: List[int]) -> None:
+        """Evaluate tokens after the ones already in the context."""
+        time.sleep(len(tokens) * PREFILL_S_PER_TOKEN)
+        self.num_prefilled_tokens += len(tokens)
+        self._input_ids = self._input_ids + list(tokens)
+
+    def detokenize(self, tokens: List[int], **kwargs) -> bytes:
+        return b" ".join(b"tok%d" % token for token in tokens)
+
+    def reset(self) -> None:
+        self._input_ids = []
+
+    def save_state(self) -> LlamaState:
+        input_ids = np.array(self._input_ids, dtype=np.intc)
+        return LlamaState(
+            input_ids=input_ids,
+            scores=np.zeros((0, 0), dtype=np.single),
+            n_tokens=len(input_ids),
+            llama_state=bytes(4 * len(input_ids)),
+            llama_state_size=4 * len(input_ids),
+            seed=0,
+        )
+
+    def load_state(self, state: LlamaState) -> None:
+        self._input_ids = state.input_ids.tolist()
+
+    def create_chat_completion(
+        self,
+        messages: List[dict],
+        max_tokens: Optional[int] = None,
+        stream: bool = False,
+        **kwargs,
+    ):
+        prompt_tokens = self._tokenize_messages(messages)
+        self._prefill(prompt_tokens)
+        num_tokens = min(RESPONSE_TOKENS, max_tokens or RESPONSE_TOKENS)
+        if stream:
+            return self._stream(num_tokens)
+
+        for i in range(num_tokens):
+            self._decode(i)
+        return {
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": self._response(num_tokens)},
+                    "finish_reason": "length",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt_tokens),
+                "completion_tokens": num_tokens,
+                "total_tokens": len(prompt_tokens) + num_tokens,
+            },
+        }
+
+    def _stream(self, num_tokens: int) -> Iterator[dict]:
+        yield {"choices": [{"delta": {"role": "assistant"}, "finish_reason": None}]}
+        for i in range(num_tokens):
+            self._decode(i)
+            yield {"choices": [{"delta": {"content": f" word{i}"}, "finish_reason": None}]}
+        yield {"choices": [{"delta": {}, "finish_reason": "length"}]}
+
+    def _tokenize_messages(self, messages: List[dict]) -> List[int]:
+        # Formatted like the chat handler of the real model does
+        return self.tokenize(format_llama3(messages).prompt.encode("utf-8"), add_bos=True, special=True)
+
+    def _prefill(self, prompt_tokens: List[int]) -> None:
+        # Reuse the longest common prefix with the current context
+        num_cached = 0
+        for cached, token in zip(self._input_ids, prompt_tokens):
+            if cached != token:
+                break
+            num_cached += 1
+        num_new = len(prompt_tokens) - num_cached
+        time.sleep(num_new * PREFILL_S_PER_TOKEN)
+        self.num_prefilled_tokens += num_new
+        self._input_ids = list(prompt_tokens)
+
+    def _decode(self, i: int) -> None:
+        time.sleep(DECODE_S_PER_TOKEN)
+        self._input_ids.append(100 + i)
+
+    @staticmethod
+    def _response(num_tokens: int) -> str:
+        return "".join(f" word{i}" for i in range(num_tokens)).strip()
+
+
+class FakeEmbedding:
+    """Stand-in for an embedding model: hashes the words of each text into a bag-of-words vector."""
+
+    dim = 64
+
+    def __init__(self, **kwargs):
+        pass
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.single)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode("utf-8")) % self.dim] += 1.0
+        return vectors.tolist()
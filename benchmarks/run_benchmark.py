@@ -0,0 +1,264 @@
+"""Load test and latency benchmark for the chat backend.
+
+Starts `src.backend.main:app` in-process with the fake model from `benchmarks.fake_llama`
+and a throwaway database, replays a JSONL workload of multi-turn sessions at the given
+concurrency, and writes the results as JSON so that they can be compared across commits.
+
+Each workload line is one session:
+    {"system_message": "...", "prompts": ["first turn", "second turn", ...]}
+
+Usage (from the project root):
+    python -m benchmarks.run_benchmark --workload benchmarks/workload.jsonl --concurrency 4
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+
+DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values, default=None),
+    }
+
+
+class StatementCounter:
+    """Counts the SQL statements executed by the backend."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args) -> None:
+        with self._lock:
+            self.count += 1
+
+
+def load_workload(path: Path) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_session(
+    http: requests.Session,
+    base_url: str,
+    session: dict,
+    stream: bool,
+    statements: StatementCounter,
+    writer,
+) -> List[dict]:
+    """Play the turns of one session in order and return one record per turn.
+    `writer` is the backend's write-behind writer, flushed after every turn so that its inserts are
+    counted against it.
+    """
+    records = []
+    session_id = None
+    system_message = session.get("system_message", DEFAULT_SYSTEM_MESSAGE)
+    for turn_index, prompt in enumerate(session["prompts"]):
+        record = {"turn_index": turn_index, "ok": False, "ttft_s": None}
+        statements_before = statements.count
+        started_at = time.perf_counter()
+        try:
+            response = http.post(
+                f"{base_url}/chat",
+                json={
+                    "prompt": prompt,
+                    "system_message": system_message,
+                    "session_id": session_id,
+                    "stream": stream,
+                },
+                stream=stream,
+            )
+            record["status_code"] = response.status_code
+            if response.ok:
+                if stream:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[len("data: ") :])
+                        if record["ttft_s"] is None and "token" in event:
+                            record["ttft_s"] = time.perf_counter() - started_at
+                        if event.get("done"):
+                            session_id = event["session_id"]
+                else:
+                    session_id = response.json()["session_id"]
+                record["ok"] = True
+        except requests.RequestException as e:
+            record["error"] = str(e)
+        record["latency_s"] = time.perf_counter() - started_at
+        if session_id:
+            # The turn is saved after the response is returned
+            writer.wait_for_session(session_id)
+        # Only exact at concurrency 1, otherwise statements of concurrent turns are included
+        record["db_statements"] = statements.count - statements_before
+        records.append(record)
+        if not record["ok"]:
+            break
+
+    if session_id:
+        http.delete(f"{base_url}/sessions/{session_id}")
+    return records
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", type=Path, default=Path(__file__).parent / "workload.jsonl")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--stream", action="store_true", help="use the streaming /chat mode")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the workload this many times")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", type=Path, default=Path("bench_results.json"))
+    parser.add_argument("--prefill-s-per-token", type=float, default=None)
+    parser.add_argument("--decode-s-per-token", type=float, default=None)
+    parser.add_argument("--response-tokens", type=int, default=None)
+    args = parser.parse_args()
+
+    # Configure the backend before importing it, its parameters are read at import time
+    db_dir = tempfile.TemporaryDirectory()
+    os.environ["CLICHATBOT_DB_URL"] = f"sqlite:///{Path(db_dir.name) / 'bench.db'}"
+    os.environ.setdefault("CLICHATBOT_MODEL_FACTORY", "benchmarks.fake_llama:FakeLlama")
+    for option, variable in [
+        (args.prefill_s_per_token, "FAKE_LLAMA_PREFILL_S_PER_TOKEN"),
+        (args.decode_s_per_token, "FAKE_LLAMA_DECODE_S_PER_TOKEN"),
+        (args.response_tokens, "FAKE_LLAMA_RESPONSE_TOKENS"),
+    ]:
+        if option is not None:
+            os.environ[variable] = str(option)
+
+    import uvicorn
+    from sqlalchemy import event
+
+    from src.backend import chat_history_db
+    from src.backend.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, port=args.port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    base_url = f"http://127.0.0.1:{args.port}"
+    # The model is loaded and warmed up in the background
+    while requests.get(f"{base_url}/readyz").status_code != 200:
+        time.sleep(0.05)
+
+    statements = StatementCounter()
+    # Requests use the async engine, the write-behind writer the sync one
+    event.listen(chat_history_db.SessionLocal.kw["bind"], "before_cursor_execute", statements)
+    event.listen(
+        chat_history_db.AsyncSessionLocal.kw["bind"].sync_engine, "before_cursor_execute", statements
+    )
+
+    sessions = load_workload(args.workload) * args.repeat
+    local = threading.local()
+
+    def play(session: dict) -> List[dict]:
+        # One keep-alive connection per client thread
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        return run_session(local.http, base_url, session, args.stream, statements, app.state.writer)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        records = [record for result in executor.map(play, sessions) for record in result]
+    elapsed_s = time.perf_counter() - started_at
+
+    scheduler_stats = requests.get(f"{base_url}/scheduler").json()
+    server.should_exit = True
+    server_thread.join()
+
+    ok = [record for record in records if record["ok"]]
+    by_turn = defaultdict(list)
+    for record in ok:
+        by_turn[record["turn_index"]].append(record)
+
+    results = {
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "workload": str(args.workload),
+            "num_sessions": len(sessions),
+            "concurrency": args.concurrency,
+            "stream": args.stream,
+            "fake_llama": {
+                variable: os.environ.get(variable)
+                for variable in [
+                    "FAKE_LLAMA_PREFILL_S_PER_TOKEN",
+                    "FAKE_LLAMA_DECODE_S_PER_TOKEN",
+                    "FAKE_LLAMA_RESPONSE_TOKENS",
+                ]
+            },
+        },
+        "num_turns": len(records),
+        "num_errors": len(records) - len(ok),
+        "status_codes": dict(
+            sorted(
+                (str(code), sum(record.get("status_code") == code for record in records))
+                for code in {record.get("status_code") for record in records}
+            )
+        ),
+        "elapsed_s": elapsed_s,
+        "requests_per_s": len(ok) / elapsed_s if elapsed_s else None,
+        "latency_s": summarize([record["latency_s"] for record in ok]),
+        "ttft_s": summarize([record["ttft_s"] for record in ok if record["ttft_s"] is not None]),
+        "db_statements_per_turn": summarize([record["db_statements"] for record in ok]),
+        # Growth with history length: turn N is sent with N previous turns of history
+        "by_turn_index": {
+            turn_index: {
+                "latency_s": summarize([record["latency_s"] for record in turn_records]),
+                "db_statements": summarize([record["db_statements"] for record in turn_records]),
+            }
+            for turn_index, turn_records in sorted(by_turn.items())
+        },
+        "scheduler": scheduler_stats,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    latency = results["latency_s"]
+    print(
+        f"{len(ok)}/{len(records)} turns in {elapsed_s:.2f}s ({results['requests_per_s']:.2f} req/s), "
+        f"latency p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s"
+        if ok
+        else f"All {len(records)} turns failed"
+    )
+    print(f"Results written to {args.output}")
+    db_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
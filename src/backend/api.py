@@ -1,139 +1,1061 @@
+import asyncio
+import datetime
+import functools
+import json
 import logging
-from typing import Optional
+import uuid
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
 
-from fastapi import Request, APIRouter, Depends
-from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from fastapi import Request, APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import func, insert, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .chat_history_db import ChatSession, Message, get_db
+from . import chat_history_db
+from .chat_history_db import ChatSession, Message, get_async_db, utc_now
+from .history_cache import MessageRecord, history_cache
+from .memory import retrieve_history
+from .inference import (
+    ABORTED_FINISH_REASONS,
+    generate_batch_completions,
+    generate_chat_completion,
+)
+from .metrics import (
+    CHAT_REQUESTS,
+    CHAT_STAGE_SECONDS,
+    DB_POOL_CONNECTIONS,
+    DECODE_TOKENS_PER_SECOND,
+    GENERATED_TOKENS,
+    HISTORY_CACHE_BYTES,
+    HISTORY_CACHE_LOOKUPS,
+    REGISTRY,
+    RESPONSE_CACHE_BYTES,
+    RESPONSE_CACHE_LOOKUPS,
+    SCHEDULER_JOBS,
+    SCHEDULER_QUEUE_DEPTH,
+    SPECULATIVE_TOKENS,
+    SYSTEM_PROMPT_CACHE_LOOKUPS,
+    TIME_TO_FIRST_TOKEN_SECONDS,
+)
+from .parameters import (
+    BATCH_MAX_PROMPTS,
+    EXPORT_FETCH_SIZE,
+    GENERATION_TIME_LIMIT_S,
+    IMPORT_BATCH_SIZE,
+    LOG_LEVEL,
+    MAX_GENERATION_TIME_LIMIT_S,
+    MAX_REPEAT_PENALTY,
+    MAX_RESPONSE_TOKENS_CAP,
+    MAX_TEMPERATURE,
+    STARTUP_RETRY_AFTER_S,
+)
+from .persistence import WriteBehindWriter
+from .profiles import active_profile, generation_options
+from .response_cache import is_deterministic, response_cache
+from .scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    DeadlineExceededError,
+    InferenceJob,
+    JobCancelledError,
+    QueueFullError,
+)
+from .state_cache import session_state_cache
+from .worker_pool import NoWorkerAvailableError
 from .utils_api import *
 
 # Set up logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=LOG_LEVEL)
 
 router = APIRouter()
 
 
+class GenerationOverrides(BaseModel):
+    """Generation settings replacing the ones of the server's performance profile, within its caps."""
+
+    max_tokens: Optional[int] = Field(default=None, ge=1, le=MAX_RESPONSE_TOKENS_CAP)
+    temperature: Optional[float] = Field(default=None, ge=0, le=MAX_TEMPERATURE)
+    repeat_penalty: Optional[float] = Field(default=None, ge=1, le=MAX_REPEAT_PENALTY)
+    seed: Optional[int] = None
+
+
 class ChatRequest(BaseModel):
     prompt: str
     system_message: str
     session_id: Optional[str] = None
     clear_history: bool = False
+    stream: bool = False  # send tokens as server-sent events while generating
+    priority: int = PRIORITY_INTERACTIVE  # lower values are served first
+    # Reuse the response of an identical earlier request, even though sampling is random
+    cache: bool = False
+    options: GenerationOverrides = GenerationOverrides()
+    # The generation is stopped after this many seconds, and the turn is not saved
+    time_limit_s: float = Field(default=GENERATION_TIME_LIMIT_S, gt=0, le=MAX_GENERATION_TIME_LIMIT_S)
+
+
+class BatchPrompt(BaseModel):
+    prompt: str
+    system_message: Optional[str] = None  # defaults to the system message of the batch
+
+
+class BatchChatRequest(BaseModel):
+    prompts: List[BatchPrompt]
+    system_message: str
+    stateless: bool = True  # when False, every prompt and its response are saved as a new session
+    stream: bool = False  # send each result as a server-sent event as soon as it completes
+    priority: int = PRIORITY_BACKGROUND
+    options: GenerationOverrides = GenerationOverrides()
+    time_limit_s: float = Field(default=GENERATION_TIME_LIMIT_S, gt=0, le=MAX_GENERATION_TIME_LIMIT_S)
 
 
 @router.get("/")
-def read_root():
+async def read_root():
     return {"message": "Chat API is running. Use POST /chat endpoint."}
 
 
+@router.get("/healthz")
+async def healthz():
+    """Liveness probe: the server is up, even while the model is still loading."""
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def readyz(request: Request):
+    """Readiness probe: the model is loaded and warmed up, so /chat can be served."""
+    require_ready(request.app.state)
+    return {"status": "ready"}
+
+
+def require_ready(state) -> None:
+    """Fail with 503 until the model has been loaded and warmed up in the background."""
+    if state.ready.is_set():
+        return
+    if state.startup_error is not None:
+        raise HTTPException(status_code=503, detail=f"Model failed to load: {state.startup_error}")
+    raise HTTPException(
+        status_code=503,
+        detail="Model is loading, retry later.",
+        headers={"Retry-After": str(STARTUP_RETRY_AFTER_S)},
+    )
+
+
 @router.post("/chat")
-def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)):
+async def chat(req: ChatRequest, request: Request, db: AsyncSession = Depends(get_async_db)):
     """Handle chat requests by generating a response from the LLaMA model.
     Note that `request` is generated by FastAPI for internal representation for backend. (Not sent by the client)
+    Runs on the event loop, the blocking model calls run on the inference executor.
     """
+    require_ready(request.app.state)
+    # Only used for tokenization here, generation runs on the scheduler's worker
     llm = request.app.state.llm
     logger.debug(f"Using LLM of type: {type(llm)}")
 
-    session_id, db_session = get_or_create_session(db, req.session_id)
+    # Turns of this session may still be queued for writing
+    writer = request.app.state.writer
+    with CHAT_STAGE_SECONDS.time(stage="session_lookup"):
+        if req.session_id:
+            await run_in_threadpool(writer.wait_for_session, req.session_id)
+        session_id, db_session = await get_or_create_session(db, req.session_id)
 
     system_message = req.system_message
     logger.debug(f"Using system message: {system_message[:50]}...")
 
     # Clear history if requested
     if req.clear_history:
-        clear_session_history(db, session_id)
+        await clear_session_history(db, session_id)
+        CHAT_REQUESTS.inc(outcome="cleared")
         return {"response": "History has been cleared!", "session_id": session_id}
 
-    # Get history for this session
-    db_messages = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.timestamp)
-        .all()
-    )
+    # Get history for this session, usually from the cache
+    with CHAT_STAGE_SECONDS.time(stage="history_load"):
+        history = await history_cache.load_async(db, session_id)
+
+    # In retrieval mode, only the recent messages and the older turns relevant to the prompt are sent
+    embedder = request.app.state.embedder
+    prompt_embedding = None
+    if embedder is not None:
+        with CHAT_STAGE_SECONDS.time(stage="retrieval"):
+            prompt_embedding = (
+                await run_model_call(request.app.state, embedder.embed, [req.prompt])
+            )[0]
+            history = await retrieve_history(
+                db, session_id, history, prompt_embedding, has_summary=bool(db_session.summary)
+            )
+    # Give the connection back to the pool while the model runs, the other endpoints need it more
+    await db.close()
 
     # Build messages list
     # Format for Llama 3.2 is OpenAI chat format
     messages = [
         {"role": "system", "content": system_message},
     ]
-    [messages.append({"role": msg.role, "content": msg.content}) for msg in db_messages]
+    if db_session.summary:
+        # Older turns of long sessions are folded into a summary by the compactor
+        messages.append(
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{db_session.summary}",
+            }
+        )
+    [messages.append({"role": msg.role, "content": msg.content}) for msg in history]
 
     # Add the new user message
-    num_new_msg_tokens, num_sys_token, num_sys_msg_token = validate_token_limits(
-        llm, system_message, req.prompt
-    )
+    options = generation_options(req.options.model_dump())
+    with CHAT_STAGE_SECONDS.time(stage="tokenization"):
+        try:
+            num_new_msg_tokens, num_sys_token, num_sys_msg_token = await run_model_call(
+                request.app.state,
+                validate_token_limits,
+                llm,
+                system_message,
+                req.prompt,
+                options["max_tokens"],
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     messages.append({"role": "user", "content": req.prompt})
     logger.debug(f"Sending {len(messages)} messages to LLM")
+    # The history is trimmed to leave room for this response, and for the default one of later requests
+    max_response_tokens = max(options["max_tokens"], active_profile.max_tokens)
+
+    # Identical requests get the same response when sampling is deterministic
+    cache_key = None
+    job = None
+    if req.cache or is_deterministic(options):
+        with CHAT_STAGE_SECONDS.time(stage="cache_lookup"):
+            cache_key = response_cache.key(messages, options)
+            cached = await run_in_threadpool(response_cache.get, cache_key)
+        if cached is not None:
+            job = CachedResponse(cached)
+
+    if job is None:
+        # The model is only used by the scheduler's worker, requests wait for it in a bounded queue
+        with CHAT_STAGE_SECONDS.time(stage="queue_wait"):
+            job = await submit_inference(
+                request,
+                generate_chat_completion,
+                session_id,
+                messages,
+                options,
+                req.time_limit_s,
+                req.stream,
+                priority=req.priority,
+                affinity_key=session_id,
+            )
+
+    # Tokens sent before the history: system message and summary
+    num_prefix_tokens = num_sys_token + db_session.summary_tokens
+    if req.stream:
+        body = stream_chat(
+            job,
+            request.app.state,
+            session_id,
+            req.prompt,
+            num_new_msg_tokens,
+            num_prefix_tokens,
+            db_session.num_tokens,
+            max_response_tokens,
+            cache_key,
+            cancel_on_disconnect(request, job),
+            embedding_bytes(prompt_embedding),
+        )
+        return StreamingResponse(
+            cancel_when_closed(body, job, lambda: untrack_job(request.app.state, session_id, job)),
+            media_type="text/event-stream",
+        )
+
+    try:
+        result = await run_model_call(
+            request.app.state, job.result, poll=cancel_on_disconnect(request, job)
+        )
+    finally:
+        untrack_job(request.app.state, session_id, job)
+    if result["finish_reason"] in ABORTED_FINISH_REASONS:
+        abort_turn(session_id, result["finish_reason"])
+    else:
+        await finish_turn(
+            request.app.state,
+            db,
+            ConversationTurn(
+                session_id,
+                req.prompt,
+                result["response"],
+                num_new_msg_tokens,
+                result["completion_tokens"],
+                utc_now(),
+                prompt_embedding=embedding_bytes(prompt_embedding),
+            ),
+            result["timings"],
+            result["finish_reason"],
+            num_prefix_tokens,
+            db_session.num_tokens,
+            max_response_tokens,
+            cache_key,
+        )
+    response = {
+        "response": result["response"],
+        "session_id": session_id,
+        "finish_reason": result["finish_reason"],
+    }
+    if result.get("speculative"):
+        response["speculative"] = observe_speculation(result["speculative"])
+    return response
+
+
+class CachedResponse:
+    """Stands in for the inference job of a request answered from the response cache."""
+
+    def __init__(self, cached: dict):
+        # Entries cached before the finish reason was stored only hold complete responses
+        self._result = {"finish_reason": "stop", **cached, "timings": None}
+
+    def events(self, poll: Optional[Callable[[], None]] = None) -> Iterator[dict]:
+        yield {"token": self._result["response"]}
+        yield self._result
+
+    def result(self, poll: Optional[Callable[[], None]] = None) -> dict:
+        return self._result
 
-    # NOTE: change max_tokens and stop parameters depending on your use-case
-    # Output
-    output = llm.create_chat_completion(
-        messages=messages, max_tokens=1000, temperature=1, repeat_penalty=1.2
+    def cancel(self) -> None:
+        pass
+
+
+@router.post("/chat/batch")
+async def chat_batch(req: BatchChatRequest, request: Request):
+    """Generate responses to many independent prompts in one batched model call.
+    Without streaming, the results are returned in the order of the prompts.
+    """
+    require_ready(request.app.state)
+    if not 0 < len(req.prompts) <= BATCH_MAX_PROMPTS:
+        raise HTTPException(
+            status_code=400, detail=f"A batch holds between 1 and {BATCH_MAX_PROMPTS} prompts."
+        )
+
+    conversations = [
+        [
+            {"role": "system", "content": item.system_message or req.system_message},
+            {"role": "user", "content": item.prompt},
+        ]
+        for item in req.prompts
+    ]
+    # Prompts too long for the context get an error result of their own, see `generate_batch_completions`
+    num_prompt_tokens = await run_model_call(
+        request.app.state, count_tokens, request.app.state.llm, [item.prompt for item in req.prompts]
+    )
+
+    job = await submit_inference(
+        request,
+        generate_batch_completions,
+        conversations,
+        generation_options(req.options.model_dump()),
+        req.time_limit_s,
+        priority=req.priority,
     )
-    logger.debug(f"Finish reason: {output['choices'][0]['finish_reason']}")
-    response_text = output["choices"][0]["message"]["content"].strip()
-    num_response_tokens = output["usage"]["completion_tokens"]
-    num_total_tokens = output["usage"]["total_tokens"]
-
-    trim_history_if_needed(db, db_messages, num_total_tokens, num_sys_token)
-
-    save_conversation(
-        db,
-        session_id,
-        req.prompt,
-        response_text,
-        num_new_msg_tokens,
-        num_response_tokens,
+    results = batch_results(
+        job, request.app.state.writer, req, num_prompt_tokens, cancel_on_disconnect(request, job)
     )
-    return {"response": response_text, "session_id": session_id}
+    if req.stream:
+        return StreamingResponse(
+            cancel_when_closed(stream_batch(iterate_in_executor(request.app.state, results)), job),
+            media_type="text/event-stream",
+        )
+    results = await run_model_call(request.app.state, list, results)
+    return {"results": sorted(results, key=lambda result: result["index"])}
+
+
+def batch_results(
+    job: InferenceJob,
+    writer: WriteBehindWriter,
+    req: BatchChatRequest,
+    num_prompt_tokens: List[int],
+    poll: Optional[Callable[[], None]] = None,
+) -> Iterator[dict]:
+    """Yield the result of each prompt of a batch as it completes, saving it unless stateless,
+    stopped before its end or failed.
+    """
+    for event in job.events(poll):
+        GENERATED_TOKENS.inc(event["completion_tokens"])
+        if (
+            not req.stateless
+            and event["finish_reason"] not in ABORTED_FINISH_REASONS
+            and "error" not in event
+        ):
+            # Each prompt starts its own session, so there is no history to trim
+            event["session_id"] = str(uuid.uuid4())
+            record_turn(
+                writer,
+                ConversationTurn(
+                    event["session_id"],
+                    req.prompts[event["index"]].prompt,
+                    event["response"],
+                    num_prompt_tokens[event["index"]],
+                    event["completion_tokens"],
+                    utc_now(),
+                ),
+            )
+        yield event
+
+
+async def stream_batch(results: AsyncIterator[dict]) -> AsyncIterator[str]:
+    """Send batch results as server-sent events, followed by a final `done` event."""
+    async for result in results:
+        yield format_sse(result)
+    yield format_sse({"done": True})
+
+
+async def finish_turn(
+    state,
+    db: AsyncSession,
+    turn: ConversationTurn,
+    timings: Optional[dict],
+    finish_reason: str,
+    num_prefix_tokens: int,
+    num_history_tokens: int,
+    max_response_tokens: int,
+    cache_key: Optional[str] = None,
+) -> None:
+    """Trim the history if needed, queue the turn for saving and compact the session if it got long.
+    `state` is the application state holding the writer and the compactor, `timings` are the
+    generation timings reported by the inference worker, or None for a response served from the
+    response cache. The history is trimmed to leave room for a response of `max_response_tokens`.
+    A generated response is stored in the cache under `cache_key` if given, with its `finish_reason`.
+    """
+    if timings is not None:
+        observe_generation(timings, turn.num_response_tokens)
+        if cache_key is not None:
+            await run_in_threadpool(
+                response_cache.put,
+                cache_key,
+                turn.response_text,
+                turn.num_response_tokens,
+                finish_reason,
+            )
+
+    # The total is computed from the stored counts, the same way for streamed and plain responses
+    num_history_tokens += turn.num_new_msg_tokens + turn.num_response_tokens
+    # In retrieval mode the prompt does not grow with the history, which is kept whole
+    if state.embedder is None:
+        with CHAT_STAGE_SECONDS.time(stage="trim"):
+            await trim_history_if_needed(
+                db,
+                turn.session_id,
+                num_prefix_tokens + num_history_tokens,
+                num_prefix_tokens,
+                max_response_tokens,
+                turn.num_new_msg_tokens + turn.num_response_tokens,
+            )
+
+    # Saved in the background, the response does not wait for the database
+    with CHAT_STAGE_SECONDS.time(stage="save"):
+        record_turn(state.writer, turn)
+    CHAT_REQUESTS.inc(outcome="ok")
+
+    if state.compactor is not None and num_history_tokens > state.compactor.threshold_tokens:
+        state.compactor.request(turn.session_id)
+
+
+def observe_generation(timings: dict, num_response_tokens: int) -> None:
+    """Record the prefill and decode timings of one generated response."""
+    CHAT_STAGE_SECONDS.observe(timings["state_restore_s"], stage="state_restore")
+    CHAT_STAGE_SECONDS.observe(timings["ttft_s"], stage="prefill")
+    CHAT_STAGE_SECONDS.observe(timings["decode_s"], stage="decode")
+    TIME_TO_FIRST_TOKEN_SECONDS.observe(timings["ttft_s"])
+    if timings["system_prompt_hit"] is not None:
+        SYSTEM_PROMPT_CACHE_LOOKUPS.inc(result="hit" if timings["system_prompt_hit"] else "miss")
+    GENERATED_TOKENS.inc(num_response_tokens)
+    # The first token is produced by the prefill
+    if num_response_tokens > 1 and timings["decode_s"] > 0:
+        DECODE_TOKENS_PER_SECOND.observe((num_response_tokens - 1) / timings["decode_s"])
+
+
+def observe_speculation(stats: dict) -> dict:
+    """Record the drafted and accepted tokens of a response generated with speculative decoding."""
+    SPECULATIVE_TOKENS.inc(stats["num_drafted"], result="drafted")
+    SPECULATIVE_TOKENS.inc(stats["num_accepted"], result="accepted")
+    return stats
+
+
+async def submit_inference(
+    request: Request,
+    fn,
+    *args,
+    priority: int,
+    affinity_key: Optional[str] = None,
+) -> InferenceJob:
+    """Queue a model call and wait until the worker starts it.
+    Fails fast with 429 when the queue is full, with 503 when the request waited past its deadline,
+    and with 499 when it was cancelled meanwhile.
+    Jobs with an `affinity_key` are the chat turns of that session, which can be cancelled by session.
+    """
+    scheduler = request.app.state.scheduler
+    job = None
+    try:
+        job = scheduler.submit(fn, *args, priority=priority, affinity_key=affinity_key)
+        if affinity_key is not None:
+            request.app.state.active_jobs[affinity_key] = job
+        await run_model_call(
+            request.app.state,
+            job.wait_started,
+            scheduler.retry_after(),
+            poll=cancel_on_disconnect(request, job),
+        )
+    except JobCancelledError as e:
+        untrack_job(request.app.state, affinity_key, job)
+        CHAT_REQUESTS.inc(outcome="cancelled")
+        raise HTTPException(status_code=499, detail=str(e))
+    except QueueFullError as e:
+        CHAT_REQUESTS.inc(outcome="rejected")
+        raise HTTPException(
+            status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+        )
+    except (DeadlineExceededError, NoWorkerAvailableError) as e:
+        untrack_job(request.app.state, affinity_key, job)
+        CHAT_REQUESTS.inc(outcome="unavailable")
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+        )
+    return job
+
+
+async def run_model_call(state, fn, *args, **kwargs):
+    """Run a blocking model call, such as tokenization or waiting for an inference job, on the
+    inference executor, so that requests waiting for the model hold neither the event loop nor
+    the thread pool that runs the other blocking work.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        state.inference_executor, functools.partial(fn, *args, **kwargs)
+    )
+
+
+async def iterate_in_executor(state, iterator: Iterator) -> AsyncIterator:
+    """Like `iterate_in_threadpool`, with each item produced on the inference executor."""
+    end = object()
+    while True:
+        item = await run_model_call(state, next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+
+def untrack_job(state, session_id: Optional[str], job: Optional[InferenceJob]) -> None:
+    """Forget the running job of a session once it ended, unless a newer one replaced it."""
+    if session_id is not None and state.active_jobs.get(session_id) is job:
+        state.active_jobs.pop(session_id, None)
+
+
+def cancel_on_disconnect(request: Request, job: InferenceJob) -> Callable[[], None]:
+    """Poll callback for `InferenceJob.events` cancelling the job once the client of `request` is gone.
+    Jobs are waited for on the inference executor, so the check is run on the event loop.
+    Must be called from the event loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    def check() -> None:
+        if asyncio.run_coroutine_threadsafe(request.is_disconnected(), loop).result():
+            logger.info("Client disconnected, cancelling its request")
+            job.cancel()
+
+    return check
+
+
+def abort_turn(session_id: str, finish_reason: str) -> None:
+    """Account for a generation that was cancelled or timed out, whose turn is not saved."""
+    CHAT_REQUESTS.inc(outcome=finish_reason)
+    logger.info(f"Generation for session {session_id} stopped early ({finish_reason}), turn not saved")
+
+
+def record_turn(writer: WriteBehindWriter, turn: ConversationTurn) -> None:
+    """Add a turn to the cached history of its session and queue it for saving."""
+    history_cache.append(
+        turn.session_id,
+        [
+            MessageRecord("user", turn.prompt, turn.num_new_msg_tokens),
+            MessageRecord("assistant", turn.response_text, turn.num_response_tokens),
+        ],
+    )
+    if not writer.submit(turn):
+        # The session was deleted while the turn was generated
+        history_cache.invalidate(turn.session_id)
+        session_state_cache.drop(turn.session_id)
+
+
+def embedding_bytes(embedding) -> Optional[bytes]:
+    """Embedding as stored in `Message.embedding`, or None outside retrieval mode."""
+    return embedding.tobytes() if embedding is not None else None
+
+
+def format_sse(data: dict) -> str:
+    """Format a dictionary as a single server-sent event."""
+    return f"data: {json.dumps(data)}\n\n"
+
+
+async def stream_chat(
+    job: InferenceJob,
+    state,
+    session_id: str,
+    prompt: str,
+    num_new_msg_tokens: int,
+    num_prefix_tokens: int,
+    num_history_tokens: int,
+    max_response_tokens: int,
+    cache_key: Optional[str] = None,
+    poll: Optional[Callable[[], None]] = None,
+    prompt_embedding: Optional[bytes] = None,
+) -> AsyncIterator[str]:
+    """Yield each chunk generated by `job` as a server-sent event.
+    The full response is queued for saving once the stream ends, unless the generation was stopped early.
+    """
+    done = {"done": True, "session_id": session_id}
+    async for event in iterate_in_executor(state, job.events(poll)):
+        if "token" in event:
+            yield format_sse({"token": event["token"]})
+            continue
+
+        untrack_job(state, session_id, job)
+        done["finish_reason"] = event["finish_reason"]
+        if event["finish_reason"] in ABORTED_FINISH_REASONS:
+            abort_turn(session_id, event["finish_reason"])
+            continue
+        # The request-scoped session from `get_async_db` is closed before the response body is sent,
+        # so the stream uses its own database session.
+        async with chat_history_db.AsyncSessionLocal() as db:
+            await finish_turn(
+                state,
+                db,
+                ConversationTurn(
+                    session_id,
+                    prompt,
+                    event["response"],
+                    num_new_msg_tokens,
+                    event["completion_tokens"],
+                    utc_now(),
+                    prompt_embedding=prompt_embedding,
+                ),
+                event["timings"],
+                event["finish_reason"],
+                num_prefix_tokens,
+                num_history_tokens,
+                max_response_tokens,
+                cache_key,
+            )
+        if event.get("speculative"):
+            done["speculative"] = observe_speculation(event["speculative"])
+    yield format_sse(done)
+
+
+async def cancel_when_closed(
+    body: AsyncIterator[str], job: InferenceJob, on_cancel: Optional[Callable[[], None]] = None
+) -> AsyncIterator[str]:
+    """Send a response body and cancel `job` when the response is closed before the end of the body.
+    Starlette stops reading the body as soon as the client disconnects, so `body` itself is not
+    resumed and only learns about it when it is garbage collected.
+    """
+    completed = False
+    try:
+        async for chunk in body:
+            yield chunk
+        completed = True
+    finally:
+        if not completed:
+            job.cancel()
+            if on_cancel is not None:
+                on_cancel()
+
+
+@router.get("/scheduler")
+async def scheduler_stats(request: Request):
+    """Report the inference queue depth and wait times."""
+    require_ready(request.app.state)
+    return request.app.state.scheduler.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics(request: Request):
+    """Report the request stage latencies and the server's state in the Prometheus text format."""
+    update_runtime_metrics(request.app.state)
+    return REGISTRY.render()
+
+
+def update_runtime_metrics(state) -> None:
+    """Sample the statistics kept by the scheduler, the caches and the database pool."""
+    # The scheduler only exists once the model is loaded
+    if state.scheduler is not None:
+        scheduler_stats = state.scheduler.stats()
+        SCHEDULER_QUEUE_DEPTH.set(scheduler_stats["queue_depth"])
+        # The worker pool reports the statistics of each of its workers
+        for outcome in ["completed", "rejected", "expired"]:
+            SCHEDULER_JOBS.set_total(
+                sum(
+                    stats[f"num_{outcome}"]
+                    for stats in scheduler_stats.get("workers", [scheduler_stats])
+                ),
+                outcome=outcome,
+            )
+
+    cache_stats = history_cache.stats()
+    HISTORY_CACHE_LOOKUPS.set_total(cache_stats["num_hits"], result="hit")
+    HISTORY_CACHE_LOOKUPS.set_total(cache_stats["num_misses"], result="miss")
+    HISTORY_CACHE_BYTES.set(cache_stats["num_bytes"])
+
+    cache_stats = response_cache.stats()
+    RESPONSE_CACHE_LOOKUPS.set_total(cache_stats["num_hits"], result="hit")
+    RESPONSE_CACHE_LOOKUPS.set_total(cache_stats["num_misses"], result="miss")
+    RESPONSE_CACHE_BYTES.set(cache_stats["num_bytes"])
+
+    # The pool of the async engine, used by the request handlers
+    pool = state.async_db_session.kw["bind"].pool
+    if hasattr(pool, "checkedout"):  # pools without a size limit do not keep these numbers
+        DB_POOL_CONNECTIONS.set(pool.size(), state="size")
+        DB_POOL_CONNECTIONS.set(pool.checkedout(), state="checked_out")
+        DB_POOL_CONNECTIONS.set(pool.checkedin(), state="checked_in")
+        DB_POOL_CONNECTIONS.set(max(0, pool.overflow()), state="overflow")
 
 
 @router.get("/sessions")
-def list_sessions(db: Session = Depends(get_db)):
-    """List all available chat sessions."""
-    sessions = db.query(ChatSession).all()
-    result = []
+async def list_sessions(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """List chat sessions, most recently active first.
+    Pass the returned `next_cursor` as `cursor` to get the next page.
+    """
+    query = (
+        select(ChatSession, func.count(Message.id).label("message_count"))
+        .outerjoin(Message, Message.session_id == ChatSession.session_id)
+        .group_by(ChatSession.session_id)
+        .order_by(ChatSession.last_activity.desc(), ChatSession.session_id.desc())
+        .limit(limit)
+    )
+    if cursor:
+        # Keyset pagination: continue right after the last session of the previous page
+        last_activity, session_id = parse_cursor(cursor)
+        query = query.where(
+            tuple_(ChatSession.last_activity, ChatSession.session_id) < (last_activity, session_id)
+        )
 
-    for session in sessions:
-        message_count = (
-            db.query(Message).filter(Message.session_id == session.session_id).count()
+    rows = (await db.execute(query)).all()
+    result = [
+        {
+            "session_id": session.session_id,
+            "created_at": session.created_at.isoformat(),
+            "last_activity": session.last_activity.isoformat(),
+            "message_count": message_count,
+        }
+        for session, message_count in rows
+    ]
+
+    next_cursor = None
+    if len(rows) == limit:
+        last_session = rows[-1][0]
+        next_cursor = f"{last_session.last_activity.isoformat()}|{last_session.session_id}"
+    return {"sessions": result, "next_cursor": next_cursor}
+
+
+def parse_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    """Split a pagination cursor into the timestamp and ID of the row it points after."""
+    try:
+        timestamp, row_id = cursor.split("|", 1)
+        return datetime.datetime.fromisoformat(timestamp), row_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+
+class ImportedMessage(BaseModel):
+    role: str
+    content: str
+    timestamp: Optional[datetime.datetime] = None
+    num_tokens: Optional[int] = None  # counted with the model's tokenizer when missing
+
+
+class ImportedSession(BaseModel):
+    """A line of /sessions/export or of the session archive, other fields are ignored."""
+
+    session_id: str = Field(min_length=1)
+    created_at: Optional[datetime.datetime] = None
+    messages: List[ImportedMessage] = []
+
+
+# Registered before /sessions/{session_id}, which would match it
+@router.get("/sessions/export")
+async def export_sessions(
+    request: Request,
+    session_id: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Stream every session, or only `session_id`, as NDJSON: one line per session with its messages.
+    The lines can be loaded back with /sessions/import.
+    """
+    writer = request.app.state.writer
+    if session_id is None:
+        await run_in_threadpool(writer.wait_for_all)
+    else:
+        await run_in_threadpool(writer.wait_for_session, session_id)
+        if await db.get(ChatSession, session_id) is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+    return StreamingResponse(export_lines(session_id), media_type="application/x-ndjson")
+
+
+async def export_lines(session_id: Optional[str]) -> AsyncIterator[str]:
+    """Exported sessions, read through a server-side cursor so that only a batch of messages is in memory.
+    The messages of a session are consecutive rows of the query, whose order follows the indexes.
+    """
+    query = (
+        select(
+            ChatSession.session_id,
+            ChatSession.created_at,
+            ChatSession.last_activity,
+            ChatSession.summary,
+            Message.id.label("message_id"),
+            Message.role,
+            Message.content,
+            Message.timestamp,
+            Message.num_tokens,
         )
-        result.append(
+        .outerjoin(Message, Message.session_id == ChatSession.session_id)
+        .order_by(ChatSession.session_id, Message.timestamp, Message.id)
+        .execution_options(yield_per=EXPORT_FETCH_SIZE)
+    )
+    if session_id is not None:
+        query = query.where(ChatSession.session_id == session_id)
+
+    # The request's database session is closed before the body is sent, so the stream opens its own
+    async with chat_history_db.AsyncSessionLocal() as db:
+        result = await db.stream(query)
+        record = None
+        async for rows in result.partitions():
+            lines = []
+            for row in rows:
+                if record is None or row.session_id != record["session_id"]:
+                    if record is not None:
+                        lines.append(json.dumps(record) + "\n")
+                    record = {
+                        "session_id": row.session_id,
+                        "created_at": row.created_at.isoformat(),
+                        "last_activity": row.last_activity.isoformat(),
+                        "summary": row.summary,
+                        "messages": [],
+                    }
+                if row.message_id is not None:
+                    record["messages"].append(
+                        {
+                            "role": row.role,
+                            "content": row.content,
+                            "timestamp": row.timestamp.isoformat(),
+                            "num_tokens": row.num_tokens,
+                        }
+                    )
+            if lines:
+                yield "".join(lines)
+        if record is not None:
+            yield json.dumps(record) + "\n"
+
+
+@router.post("/sessions/import")
+async def import_sessions(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Load sessions sent as NDJSON in the request body, in the format of /sessions/export.
+    The body is read as it arrives and inserted in batches, each in one transaction. Sessions whose ID
+    already exists are skipped. On an invalid line, the sessions of the lines before it are kept.
+    Summaries are not imported, the imported sessions start with their whole history.
+    """
+    state = request.app.state
+    counts = {"imported": 0, "skipped": 0, "messages": 0}
+    batch: List[ImportedSession] = []
+    num_batch_rows = 0
+    async for line_number, line in ndjson_lines(request):
+        try:
+            session = ImportedSession.model_validate_json(line)
+        except ValidationError as e:
+            await import_batch(state, db, batch, counts)
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid session on line {line_number}: {e.errors()[0]['msg']}. "
+                f"{counts['imported']} sessions before it were imported.",
+            )
+        batch.append(session)
+        num_batch_rows += 1 + len(session.messages)
+        if num_batch_rows >= IMPORT_BATCH_SIZE:
+            await import_batch(state, db, batch, counts)
+            batch, num_batch_rows = [], 0
+    await import_batch(state, db, batch, counts)
+    logger.info(
+        f"Imported {counts['imported']} sessions with {counts['messages']} messages, "
+        f"skipped {counts['skipped']} existing ones"
+    )
+    return {"status": "success", **counts}
+
+
+async def ndjson_lines(request: Request) -> AsyncIterator[Tuple[int, bytes]]:
+    """Non-empty lines of the request body with their line number, as the body arrives."""
+    buffer = b""
+    line_number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+
+async def import_batch(state, db: AsyncSession, sessions: List[ImportedSession], counts: dict) -> None:
+    """Insert the sessions whose ID is not taken, with their messages, in one transaction."""
+    if not sessions:
+        return
+    taken = set(
+        (
+            await db.scalars(
+                select(ChatSession.session_id).where(
+                    ChatSession.session_id.in_([session.session_id for session in sessions])
+                )
+            )
+        ).all()
+    )
+    new_sessions = []
+    for session in sessions:
+        if session.session_id in taken:
+            counts["skipped"] += 1
+        else:
+            taken.add(session.session_id)  # the same session twice in the body
+            new_sessions.append(session)
+    if not new_sessions:
+        return
+
+    messages = [message for session in new_sessions for message in session.messages]
+    # Token counts are needed to fit the history in the context
+    uncounted = [message for message in messages if message.num_tokens is None]
+    if uncounted:
+        require_ready(state)
+        num_tokens = await run_model_call(state, count_tokens, state.llm, [m.content for m in uncounted])
+        for message, count in zip(uncounted, num_tokens):
+            message.num_tokens = count
+    embeddings = [None] * len(messages)
+    if state.embedder is not None and messages:
+        embeddings = await run_model_call(state, state.embedder.embed, [m.content for m in messages])
+
+    now = utc_now()
+    await db.execute(
+        insert(ChatSession),
+        [
             {
                 "session_id": session.session_id,
-                "created_at": session.created_at.isoformat(),
-                "last_activity": session.last_activity.isoformat(),
-                "message_count": message_count,
+                "created_at": as_utc(session.created_at) or now,
+                # The import counts as activity, so that old sessions are not expired right away
+                "last_activity": now,
+                "num_tokens": sum(message.num_tokens for message in session.messages),
             }
-        )
+            for session in new_sessions
+        ],
+    )
+    message_rows = []
+    for session in new_sessions:
+        for message in session.messages:
+            message_rows.append(
+                {
+                    "session_id": session.session_id,
+                    "role": message.role,
+                    "content": message.content,
+                    "timestamp": as_utc(message.timestamp) or now,
+                    "num_tokens": message.num_tokens,
+                    "embedding": embedding_bytes(embeddings[len(message_rows)]),
+                }
+            )
+    if message_rows:
+        await db.execute(insert(Message), message_rows)
+    await db.commit()
+    for session in new_sessions:
+        # E.g. a session looked up before it existed
+        history_cache.invalidate(session.session_id)
+        session_state_cache.drop(session.session_id)
+    counts["imported"] += len(new_sessions)
+    counts["messages"] += len(messages)
+
+
+def count_tokens(llm, texts: List[str]) -> List[int]:
+    return [len(llm.tokenize(text.encode("utf-8"))) for text in texts]
+
 
-    return {"sessions": result}
+def as_utc(timestamp: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Timestamps are stored without their offset, in UTC like `utc_now`."""
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc)
 
 
 @router.get("/sessions/{session_id}")
-def get_session(session_id: str, db: Session = Depends(get_db)):
-    """Get a specific chat session's messages."""
-    messages = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.timestamp)
-        .all()
+async def get_session(
+    session_id: str,
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Get a page of a chat session's messages, oldest first.
+    Pass the returned `next_cursor` as `cursor` to get the next page.
+    """
+    await run_in_threadpool(request.app.state.writer.wait_for_session, session_id)
+    # Read from the database, the cache only holds the messages not folded into the summary
+    query = (
+        select(Message.id, Message.role, Message.content, Message.timestamp)
+        .where(Message.session_id == session_id)
+        .order_by(Message.timestamp, Message.id)
+        .limit(limit)
     )
+    if cursor:
+        # Keyset pagination: continue right after the last message of the previous page
+        timestamp, message_id = parse_cursor(cursor)
+        if not message_id.isdigit():
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+        query = query.where(tuple_(Message.timestamp, Message.id) > (timestamp, int(message_id)))
 
+    rows = (await db.execute(query)).all()
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = f"{rows[-1].timestamp.isoformat()}|{rows[-1].id}"
     return {
         "session_id": session_id,
-        "messages": [{"role": msg.role, "content": msg.content} for msg in messages],
+        "messages": [
+            {"role": row.role, "content": row.content, "timestamp": row.timestamp.isoformat()}
+            for row in rows
+        ],
+        "next_cursor": next_cursor,
     }
 
 
+@router.post("/sessions/{session_id}/cancel")
+async def cancel_generation(session_id: str, request: Request):
+    """Stop the response being generated, or waiting to be generated, for a session.
+    The turn is not saved, and the request waiting for it gets the partial response.
+    """
+    job = request.app.state.active_jobs.get(session_id)
+    if job is None:
+        return {"status": "error", "message": "No response is being generated for this session"}
+    job.cancel()
+    return {"status": "success", "message": f"Generation for session {session_id} cancelled"}
+
+
 @router.delete("/sessions/{session_id}")
-def delete_session(session_id: str, db: Session = Depends(get_db)):
+async def delete_session(
+    session_id: str, request: Request, db: AsyncSession = Depends(get_async_db)
+):
     """Delete a chat session."""
-    session = db.query(ChatSession).filter(ChatSession.session_id == session_id).first()
+    job = request.app.state.active_jobs.get(session_id)
+    if job is not None:
+        job.cancel()
+    # A generation that finished before the cancellation still submits its turn, which is dropped
+    had_queued_turns = request.app.state.writer.discard_session(session_id)
+    await run_in_threadpool(request.app.state.writer.wait_for_session, session_id)
+    session = await db.get(ChatSession, session_id)
     if session:
-        db.delete(session)
-        db.commit()
+        await db.delete(session)  # also deletes its messages
+        await db.commit()
+    if session or had_queued_turns:
+        history_cache.invalidate(session_id)
+        session_state_cache.drop(session_id)
         return {"status": "success", "message": f"Session {session_id} deleted"}
     return {"status": "error", "message": "Session not found"}
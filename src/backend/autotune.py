@@ -0,0 +1,168 @@
+"""Benchmark the model on this host and save the fastest settings as a performance profile.
+
+Prefill (prompt evaluation) and decode (token generation) are measured separately over a grid
+of thread counts and batch sizes, since they are bound by different resources: prefill by compute,
+so it scales with threads and batch size, decode by memory bandwidth, so it usually peaks before
+all cores are busy. The decode threads are taken from the best decode run, the prompt threads
+and batch size from the best prefill run. The batch size sets both n_batch and n_ubatch.
+
+Usage (from the project root):
+    python -m src.backend.autotune --threads 2 4 8 --batch-sizes 256 512 --name tuned
+    CLICHATBOT_PERFORMANCE_PROFILE=tuned uvicorn src.backend.main:app
+"""
+import argparse
+import logging
+import os
+import time
+from typing import List, NamedTuple
+
+from llama_cpp import Llama
+
+from .model import load_model
+from .profiles import PerformanceProfile, get_profile, save_profile
+
+logger = logging.getLogger(__name__)
+
+# Any text works, it is repeated up to the length of the benchmark prompt
+PROMPT_TEXT = (
+    "The history of computing spans mechanical calculators, vacuum tubes, transistors and "
+    "integrated circuits, each generation making machines smaller, faster and cheaper. "
+)
+
+
+class Measurement(NamedTuple):
+    n_threads: int
+    n_batch: int
+    flash_attn: bool
+    prefill_tokens_per_s: float
+    decode_tokens_per_s: float
+
+
+def default_thread_counts() -> List[int]:
+    """Powers of two up to the number of CPUs, and the number of CPUs itself."""
+    num_cpus = os.cpu_count() or 1
+    counts = {num_cpus}
+    n = 1
+    while n < num_cpus:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def benchmark_prompt(llm: Llama, num_tokens: int) -> List[int]:
+    tokens = llm.tokenize(PROMPT_TEXT.encode("utf-8"), add_bos=False)
+    repeated = tokens * (num_tokens // len(tokens) + 1)
+    return [llm.token_bos()] + repeated[: num_tokens - 1]
+
+
+def measure(llm: Llama, prompt_tokens: List[int], num_decode_tokens: int) -> tuple:
+    """Prefill and decode speeds in tokens/s of one greedy generation from an empty context."""
+    llm.reset()
+    started_at = time.perf_counter()
+    first_token_at = None
+    num_generated = 0
+    for _ in llm.generate(prompt_tokens, temp=0.0):
+        num_generated += 1
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        if num_generated >= num_decode_tokens:
+            break
+    finished_at = time.perf_counter()
+    # The first token comes right after the prompt is evaluated
+    prefill_tokens_per_s = len(prompt_tokens) / (first_token_at - started_at)
+    decode_tokens_per_s = (num_generated - 1) / (finished_at - first_token_at)
+    return prefill_tokens_per_s, decode_tokens_per_s
+
+
+def autotune(
+    base: PerformanceProfile,
+    thread_counts: List[int],
+    batch_sizes: List[int],
+    try_flash_attn: bool,
+    num_prompt_tokens: int,
+    num_decode_tokens: int,
+    repetitions: int,
+) -> tuple:
+    """Measure every combination of settings and return the tuned profile with all measurements."""
+    measurements = []
+    for flash_attn in sorted({base.flash_attn, True} if try_flash_attn else {base.flash_attn}):
+        for n_batch in batch_sizes:
+            # Batch sizes and flash attention are fixed when the context is created, threads are not.
+            # The whole batch is evaluated at once, a smaller n_ubatch would cap every size above it.
+            profile = base._replace(
+                n_batch=n_batch,
+                n_ubatch=n_batch,
+                flash_attn=flash_attn,
+                n_ctx=max(base.n_ctx, num_prompt_tokens + num_decode_tokens),
+            )
+            llm = load_model(n_threads=max(thread_counts), profile=profile)
+            if not isinstance(llm, Llama):
+                raise RuntimeError("Autotune needs the llama.cpp model, unset CLICHATBOT_MODEL_FACTORY")
+            prompt_tokens = benchmark_prompt(llm, num_prompt_tokens)
+            measure(llm, prompt_tokens[:16], 2)  # warm up the caches and thread pool
+            for n_threads in thread_counts:
+                llm._ctx.set_n_threads(n_threads, n_threads)
+                runs = [measure(llm, prompt_tokens, num_decode_tokens) for _ in range(repetitions)]
+                measurement = Measurement(
+                    n_threads,
+                    n_batch,
+                    flash_attn,
+                    max(prefill for prefill, _ in runs),
+                    max(decode for _, decode in runs),
+                )
+                logger.info(
+                    f"threads={n_threads} n_batch={n_batch} flash_attn={flash_attn}: "
+                    f"prefill {measurement.prefill_tokens_per_s:.1f} tokens/s, "
+                    f"decode {measurement.decode_tokens_per_s:.1f} tokens/s"
+                )
+                measurements.append(measurement)
+            llm.close()
+
+    best_prefill = max(measurements, key=lambda m: m.prefill_tokens_per_s)
+    best_decode = max(measurements, key=lambda m: m.decode_tokens_per_s)
+    tuned = base._replace(
+        n_threads=best_decode.n_threads,
+        n_threads_batch=best_prefill.n_threads,
+        n_batch=best_prefill.n_batch,
+        n_ubatch=best_prefill.n_batch,
+        # Flash attention changes both phases, keep the setting of the best decode
+        flash_attn=best_decode.flash_attn,
+    )
+    return tuned, measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base", default="default", help="profile whose other settings are kept")
+    parser.add_argument("--name", default="tuned", help="name of the profile to write")
+    parser.add_argument("--threads", type=int, nargs="+", default=default_thread_counts())
+    parser.add_argument(
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=[256, 512, 1024],
+        help="values of n_batch to measure, n_ubatch is set to the same value",
+    )
+    parser.add_argument("--try-flash-attn", action="store_true", help="also measure with flash attention")
+    parser.add_argument("--prompt-tokens", type=int, default=1024)
+    parser.add_argument("--decode-tokens", type=int, default=64)
+    parser.add_argument("--repetitions", type=int, default=2, help="the best run of each setting is kept")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tuned, measurements = autotune(
+        get_profile(args.base),
+        args.threads,
+        args.batch_sizes,
+        args.try_flash_attn,
+        args.prompt_tokens,
+        args.decode_tokens,
+        args.repetitions,
+    )
+    save_profile(args.name, tuned)
+    logger.info(f"Saved profile {args.name!r}: {tuned._asdict()}")
+    logger.info(f"Select it with CLICHATBOT_PERFORMANCE_PROFILE={args.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import logging
+from collections import deque
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import llama_cpp
+from llama_cpp import Llama
+
+try:
+    from llama_cpp._internals import LlamaBatch, LlamaSampler
+except ImportError:  # private module of llama_cpp, see `batch_decoding_supported`
+    LlamaBatch = LlamaSampler = None
+
+logger = logging.getLogger(__name__)
+
+
+def batch_decoding_supported(llm) -> bool:
+    """Whether `llm` exposes the private llama_cpp internals driven by `decode_batch`.
+    They are not part of the public API and may change between versions, this was written for 0.3.9.
+    """
+    if LlamaBatch is None or not isinstance(llm, Llama) or not hasattr(llama_cpp, "llama_token_is_eog"):
+        return False
+    ctx = getattr(llm, "_ctx", None)
+    return (
+        hasattr(llm, "_init_sampler")
+        and hasattr(getattr(llm, "_model", None), "vocab")
+        and all(hasattr(ctx, name) for name in ("decode", "kv_cache_clear", "kv_cache_seq_rm"))
+    )
+
+
+class _Sequence:
+    """One prompt being decoded in its own llama.cpp sequence of the shared KV cache."""
+
+    def __init__(
+        self,
+        index: int,
+        seq_id: int,
+        prompt_tokens: List[int],
+        max_tokens: int,
+        sampler: LlamaSampler,
+    ):
+        self.index = index
+        self.seq_id = seq_id
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.sampler = sampler
+        self.pending = list(prompt_tokens)  # tokens still to evaluate
+        self.n_past = 0  # tokens already in the KV cache
+        self.completion: List[int] = []
+        self.logits_index: Optional[int] = None  # position in the batch whose logits to sample
+
+
+def decode_batch(
+    llm: Llama,
+    prompts: List[List[int]],
+    make_sampler: Callable[[], LlamaSampler],
+    max_tokens: int,
+    max_sequences: int,
+    should_stop: Callable[[], Optional[str]] = lambda: None,
+) -> Iterator[Tuple[int, List[int], str]]:
+    """Generate a completion for every tokenized prompt, decoding up to `max_sequences` at once.
+    Every step evaluates a single llama.cpp batch holding the next token of each generating
+    sequence plus as many prompt tokens of newly started sequences as fit, so the weights are
+    read once per step for all sequences instead of once per sequence. A finished sequence
+    frees its slot for the next prompt (continuous batching).
+    Yields `(prompt index, completion tokens, finish reason)` as each prompt completes.
+    `should_stop` is called before every step. Once it returns a reason, the remaining prompts are
+    yielded right away with their partial completions and that reason as finish reason.
+    Every prompt must be shorter than the context, so that at least one token can be generated.
+    The KV cache of `llm` is cleared, so its previous context must have been saved beforehand.
+    """
+    ctx = llm._ctx
+    n_ctx = llm.n_ctx()
+    batch = LlamaBatch(n_tokens=llm.n_batch, embd=0, n_seq_max=1, verbose=False)
+    waiting = deque(enumerate(prompts))
+    active: List[_Sequence] = []
+    free_seq_ids = list(range(max_sequences))
+    num_reserved = 0  # KV cache cells reserved for the prompts and completions of active sequences
+
+    ctx.kv_cache_clear()
+    llm.reset()
+    try:
+        while waiting or active:
+            reason = should_stop()
+            if reason is not None:
+                stopped = [(seq.index, seq.completion) for seq in active]
+                stopped += [(index, []) for index, _ in waiting]
+                for seq in active:
+                    seq.sampler.close()
+                active = []
+                for index, completion in stopped:
+                    yield index, completion, reason
+                return
+
+            # Start new sequences while there is room for their whole completion in the KV cache
+            while waiting and free_seq_ids:
+                index, prompt_tokens = waiting[0]
+                seq_max_tokens = min(max_tokens, n_ctx - len(prompt_tokens))
+                num_cells = len(prompt_tokens) + seq_max_tokens
+                if active and num_reserved + num_cells > n_ctx:
+                    break
+                waiting.popleft()
+                num_reserved += num_cells
+                active.append(
+                    _Sequence(index, free_seq_ids.pop(), prompt_tokens, seq_max_tokens, make_sampler())
+                )
+
+            # Generating sequences go first, one token each, then prompt chunks fill the batch
+            batch.reset()
+            for seq in sorted(active, key=lambda seq: len(seq.pending)):
+                num_free = llm.n_batch - batch.n_tokens()
+                if num_free == 0:
+                    break
+                chunk = seq.pending[:num_free]
+                seq.pending = seq.pending[len(chunk) :]
+                for token in chunk:
+                    _add_token(batch, token, seq.n_past, seq.seq_id)
+                    seq.n_past += 1
+                if not seq.pending:
+                    # Only the last token of a sequence needs logits to sample the next one
+                    seq.logits_index = batch.n_tokens() - 1
+                    batch.batch.logits[seq.logits_index] = True
+            ctx.decode(batch)
+
+            still_active = []
+            for seq in active:
+                if seq.logits_index is None:
+                    still_active.append(seq)  # prompt not fully evaluated yet
+                    continue
+                token = seq.sampler.sample(ctx, seq.logits_index)
+                seq.logits_index = None
+                finish_reason = None
+                if llama_cpp.llama_token_is_eog(llm._model.vocab, token):
+                    finish_reason = "stop"
+                else:
+                    seq.completion.append(token)
+                    if len(seq.completion) >= seq.max_tokens:
+                        finish_reason = "length"
+                if finish_reason is None:
+                    seq.pending = [token]
+                    still_active.append(seq)
+                    continue
+
+                ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)
+                free_seq_ids.append(seq.seq_id)
+                num_reserved -= len(seq.prompt_tokens) + seq.max_tokens
+                seq.sampler.close()
+                yield seq.index, seq.completion, finish_reason
+            active = still_active
+    finally:
+        for seq in active:
+            seq.sampler.close()
+        batch.close()
+        # The next request starts from an empty context
+        ctx.kv_cache_clear()
+        llm.reset()
+
+
+def _add_token(batch: LlamaBatch, token: int, pos: int, seq_id: int) -> None:
+    i = batch.batch.n_tokens
+    batch.batch.token[i] = token
+    batch.batch.pos[i] = pos
+    batch.batch.seq_id[i][0] = seq_id
+    batch.batch.n_seq_id[i] = 1
+    batch.batch.logits[i] = False
+    batch.batch.n_tokens += 1
@@ -2,16 +2,30 @@ import datetime
 from pathlib import Path
 from sqlalchemy import (
     create_engine,
+    event,
+    func,
+    inspect,
+    select,
+    text,
     Column,
     String,
     Integer,
     Text,
     DateTime,
     ForeignKey,
+    Index,
+    LargeBinary,
 )
-from sqlalchemy.orm import sessionmaker, relationship, DeclarativeBase
-from .parameters import DB_URL  # Import the default DB_URL from parameters
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import deferred, sessionmaker, relationship, DeclarativeBase
+from .parameters import ASYNC_DB_URL, DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW  # Import the default DB_URL from parameters
 SessionLocal = None  # Global variable to hold the session factory
+AsyncSessionLocal = None  # Session factory of the async engine used by the request handlers
+
+
+def utc_now() -> datetime.datetime:
+    """Column default evaluated on every insert (a plain value would be fixed at import time)."""
+    return datetime.datetime.now(datetime.timezone.utc)
 
 
 class Base(DeclarativeBase):
@@ -24,12 +38,15 @@ class ChatSession(Base):
     __tablename__ = "chat_sessions"
 
     session_id = Column(String, primary_key=True)
-    created_at = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
-    last_activity = Column(
-        DateTime,
-        default=datetime.datetime.now(datetime.timezone.utc),
-        onupdate=datetime.datetime.now(datetime.timezone.utc),
-    )
+    created_at = Column(DateTime, default=utc_now)
+    last_activity = Column(DateTime, default=utc_now, onupdate=utc_now, index=True)
+    # Running total of `Message.num_tokens` in this session, kept up to date on every write.
+    # Messages folded into the summary are not counted.
+    num_tokens = Column(Integer, default=0, nullable=False)
+    # Running summary of the older messages, which are then no longer sent to the model
+    summary = Column(Text, nullable=True)
+    summary_tokens = Column(Integer, default=0, nullable=False)
+    summarized_until = Column(Integer, default=0, nullable=False)  # ID of the last folded message
     messages = relationship(
         "Message", back_populates="session", cascade="all, delete-orphan"
     )
@@ -42,24 +59,125 @@ class Message(Base):
     session_id = Column(String, ForeignKey("chat_sessions.session_id"))
     role = Column(String)
     content = Column(Text)
-    timestamp = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    timestamp = Column(DateTime, default=utc_now)
     num_tokens = Column(
         Integer
     )  # Optional: store number of tokens used for the message
+    # Unit-length float32 vector of the content in retrieval mode, see memory.py.
+    # Only read by the retrieval query, not when loading messages.
+    embedding = deferred(Column(LargeBinary, nullable=True))
 
     session = relationship("ChatSession", back_populates="messages")
 
+    # History is always read per session in chronological order
+    __table_args__ = (Index("ix_messages_session_id_timestamp", "session_id", "timestamp"),)
+
+
+def summarized_until_subquery(session_id: str):
+    """ID of the last message of a session folded into its summary, as a scalar subquery."""
+    return func.coalesce(
+        select(ChatSession.summarized_until)
+        .where(ChatSession.session_id == session_id)
+        .scalar_subquery(),
+        0,
+    )
+
 
 # Initialize database
 def init_db(db_url=DB_URL):
     """Initialize the database and create tables. This is called inside the FastAPI lifespan."""
-    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    engine = create_engine(
+        db_url,
+        connect_args={"check_same_thread": False},
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+    )
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    enable_incremental_vacuum(engine)
     Base.metadata.create_all(engine)
+    migrate_db(engine)
     global SessionLocal
     SessionLocal = sessionmaker(bind=engine)
     return SessionLocal
 
 
+def init_async_db(db_url=ASYNC_DB_URL):
+    """Create the async engine used by the request handlers, on the database set up by `init_db`.
+    Background threads (writer, compactor, reaper) keep using the sync engine.
+    """
+    engine = create_async_engine(db_url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    # The pragmas are set on the DBAPI connection wrapped by the async driver
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    global AsyncSessionLocal
+    # Async sessions cannot lazily reload expired attributes, so objects are not expired on commit
+    AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+    return AsyncSessionLocal
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Configure every new SQLite connection.
+    WAL lets readers run alongside the writer, and with `synchronous=NORMAL` commits
+    no longer wait for fsync (the WAL is synced at checkpoints instead).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")  # wait for the write lock instead of failing
+    cursor.close()
+
+
+def enable_incremental_vacuum(engine) -> None:
+    """Let the session reaper return the pages freed by deleted sessions to the file system.
+    The setting only takes effect on a database with tables after a full VACUUM, which runs once.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:  # 2 is INCREMENTAL
+            conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+            conn.execute(text("VACUUM"))
+
+
+# Columns added after the first release, with their SQLite definition
+ADDED_COLUMNS = {
+    "chat_sessions": {
+        "num_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "summary": "TEXT",
+        "summary_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "summarized_until": "INTEGER NOT NULL DEFAULT 0",
+    },
+    "messages": {
+        "embedding": "BLOB",
+    },
+}
+
+
+def migrate_db(engine) -> None:
+    """Bring databases created by older versions up to date with the current models.
+    `create_all` only creates missing tables, so new columns and indexes are added here.
+    """
+    inspector = inspect(engine)
+    existing_columns = {
+        table: {column["name"] for column in inspector.get_columns(table)}
+        for table in ADDED_COLUMNS
+    }
+    with engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            for name, definition in columns.items():
+                if name not in existing_columns[table]:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+        if "num_tokens" not in existing_columns["chat_sessions"]:
+            # Backfill the running token totals
+            conn.execute(
+                text(
+                    "UPDATE chat_sessions SET num_tokens = ("
+                    "SELECT COALESCE(SUM(messages.num_tokens), 0) FROM messages "
+                    "WHERE messages.session_id = chat_sessions.session_id)"
+                )
+            )
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
 def get_db():
     """Provide a database session and handle proper cleanup."""
     assert (
@@ -70,3 +188,12 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """Provide an async database session and handle proper cleanup."""
+    assert (
+        AsyncSessionLocal is not None
+    ), "Async database session factory is not initialized. Call init_async_db() first."
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,153 @@
+import logging
+import queue
+import threading
+from typing import Optional, Set
+
+from sqlalchemy import and_, exists, func, select, update
+from sqlalchemy.orm import sessionmaker
+
+from .chat_history_db import ChatSession, Message
+from .history_cache import history_cache
+from .inference import generate_summary
+from .parameters import COMPACTION_KEEP_RECENT_TOKENS, COMPACTION_THRESHOLD_TOKENS
+from .persistence import WriteBehindWriter
+from .scheduler import PRIORITY_BACKGROUND, InferenceScheduler, QueueFullError
+from .state_cache import session_state_cache
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryCompactor:
+    """Folds the older turns of long sessions into a running summary, off the request path.
+    Once the history of a session exceeds `threshold_tokens`, everything but the most recent
+    `keep_recent_tokens` is summarized by the model at background priority. The summary is stored
+    on the session and the folded messages are no longer sent to the model, so the prompt stays
+    bounded by the system message, the summary and the recent turns.
+    """
+
+    def __init__(
+        self,
+        scheduler: InferenceScheduler,
+        session_factory: sessionmaker,
+        writer: WriteBehindWriter,
+        threshold_tokens: int = COMPACTION_THRESHOLD_TOKENS,
+        keep_recent_tokens: int = COMPACTION_KEEP_RECENT_TOKENS,
+    ):
+        self.scheduler = scheduler
+        self.session_factory = session_factory
+        self.writer = writer
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._queued: Set[str] = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="history-compactor", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def request(self, session_id: str) -> None:
+        """Queue a session for compaction, unless it is already queued."""
+        with self._lock:
+            if session_id in self._queued:
+                return
+            self._queued.add(session_id)
+        self._queue.put(session_id)
+
+    def _run(self) -> None:
+        while True:
+            session_id = self._queue.get()
+            if session_id is None:
+                return
+            try:
+                self._compact(session_id)
+            except QueueFullError:
+                # Retried after a later turn of the session
+                logger.info(f"Inference queue full, postponing compaction of session {session_id}")
+            except Exception:
+                logger.exception(f"Failed to compact session {session_id}")
+            finally:
+                with self._lock:
+                    self._queued.discard(session_id)
+
+    def _compact(self, session_id: str) -> None:
+        self.writer.wait_for_session(session_id)
+        db = self.session_factory()
+        try:
+            session = db.get(ChatSession, session_id)
+            if session is None or session.num_tokens <= self.threshold_tokens:
+                return
+            summary = session.summary
+            summarized_until = session.summarized_until
+            rows = db.execute(
+                select(Message.id, Message.role, Message.content, Message.num_tokens)
+                .where(Message.session_id == session_id, Message.id > summarized_until)
+                .order_by(Message.timestamp, Message.id)
+            ).all()
+        finally:
+            db.close()
+
+        # Keep the most recent messages verbatim, starting the window at a user message
+        cut = len(rows)
+        num_recent_tokens = 0
+        while cut > 0 and num_recent_tokens + rows[cut - 1].num_tokens <= self.keep_recent_tokens:
+            cut -= 1
+            num_recent_tokens += rows[cut].num_tokens
+        while cut < len(rows) and rows[cut].role != "user":
+            cut += 1
+        folded = rows[:cut]
+        if not folded:
+            return
+
+        transcript = "\n".join(f"{row.role.capitalize()}: {row.content}" for row in folded)
+        job = self.scheduler.submit(
+            generate_summary,
+            summary,
+            transcript,
+            priority=PRIORITY_BACKGROUND,
+            affinity_key=session_id,
+        )
+        result = job.result()
+
+        new_summarized_until = folded[-1].id
+        db = self.session_factory()
+        try:
+            folded_tokens = (
+                select(func.coalesce(func.sum(Message.num_tokens), 0))
+                .where(
+                    Message.session_id == session_id,
+                    Message.id > summarized_until,
+                    Message.id <= new_summarized_until,
+                )
+                .scalar_subquery()
+            )
+            # Only apply the summary if the history was not cleared or compacted meanwhile
+            applied = db.execute(
+                update(ChatSession)
+                .where(
+                    ChatSession.session_id == session_id,
+                    ChatSession.summarized_until == summarized_until,
+                    exists().where(
+                        and_(Message.session_id == session_id, Message.id == new_summarized_until)
+                    ),
+                )
+                .values(
+                    summary=result["summary"],
+                    summary_tokens=result["num_tokens"],
+                    summarized_until=new_summarized_until,
+                    num_tokens=ChatSession.num_tokens - folded_tokens,
+                )
+            ).rowcount
+            db.commit()
+        finally:
+            db.close()
+
+        if applied:
+            # The prompt of the session changes, so its cached history and model state are stale
+            history_cache.invalidate(session_id)
+            session_state_cache.drop(session_id)
+            logger.info(f"Folded {len(folded)} messages of session {session_id} into its summary")
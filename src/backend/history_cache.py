@@ -0,0 +1,312 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .chat_history_db import Message, summarized_until_subquery
+from .parameters import HISTORY_CACHE_IDLE_TTL_S, HISTORY_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRecord:
+    """Compact, detached copy of a `Message` row."""
+
+    __slots__ = ("role", "content", "num_tokens")
+
+    def __init__(self, role: str, content: str, num_tokens: int):
+        self.role = role
+        self.content = content
+        self.num_tokens = num_tokens
+
+    def size(self) -> int:
+        """Approximate memory footprint in bytes."""
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+
+def history_query(session_id: str):
+    """Messages of a session not folded into its summary, in chronological order."""
+    return (
+        select(Message.role, Message.content, Message.num_tokens)
+        .where(
+            Message.session_id == session_id,
+            Message.id > summarized_until_subquery(session_id),
+        )
+        .order_by(Message.timestamp, Message.id)
+    )
+
+
+def embedding_query(session_id: str):
+    """Every message of a session with its embedding, including the ones folded into the summary."""
+    return (
+        select(Message.role, Message.content, Message.num_tokens, Message.embedding)
+        .where(Message.session_id == session_id)
+        .order_by(Message.timestamp, Message.id)
+    )
+
+
+class IndexedMessages(NamedTuple):
+    """Snapshot of messages of an `EmbeddingIndex`, one array row per record."""
+
+    records: List[MessageRecord]
+    roles: np.ndarray
+    num_tokens: np.ndarray
+    embeddings: np.ndarray
+
+
+class EmbeddingIndex:
+    """The messages of a session that have an embedding, in chronological order, with their embeddings
+    decoded into one matrix for the retrieval mode. Messages without an embedding, or with one of another
+    size, cannot be compared and are left out, but still count as messages of the session.
+    """
+
+    __slots__ = ("dim", "records", "positions", "num_messages", "num_bytes", "_roles", "_num_tokens", "_matrix")
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.records: List[MessageRecord] = []
+        self.positions: List[int] = []  # position of each record among all the messages of the session
+        self.num_messages = 0
+        # Grown by doubling, only the first `len(records)` rows are used
+        self._roles = np.empty(0, dtype="<U9")
+        self._num_tokens = np.empty(0, dtype=np.int64)
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self.num_bytes = sys.getsizeof(self)
+
+    @classmethod
+    def from_rows(cls, dim: int, rows: list) -> "EmbeddingIndex":
+        """Build the index from the rows of `embedding_query`."""
+        index = cls(dim)
+        index.positions = [
+            i for i, row in enumerate(rows) if row.embedding is not None and len(row.embedding) == dim * 4
+        ]
+        index.records = [
+            MessageRecord(rows[i].role, rows[i].content, rows[i].num_tokens) for i in index.positions
+        ]
+        index.num_messages = len(rows)
+        index._roles = np.array([record.role for record in index.records], dtype="<U9")
+        index._num_tokens = np.array([record.num_tokens or 0 for record in index.records], dtype=np.int64)
+        index._matrix = np.frombuffer(
+            b"".join(rows[i].embedding for i in index.positions), dtype=np.float32
+        ).reshape(len(index.positions), dim).copy()  # writable, rows are added in place
+        index.num_bytes += index._arrays_size() + sum(record.size() for record in index.records)
+        return index
+
+    def append(self, record: MessageRecord, embedding: Optional[bytes]) -> int:
+        """Add the next message of the session, and return the number of bytes it added."""
+        position = self.num_messages
+        self.num_messages += 1
+        if embedding is None or len(embedding) != self.dim * 4:
+            return 0
+        added_bytes = record.size()
+        n = len(self.records)
+        if n == len(self._matrix):
+            added_bytes -= self._arrays_size()
+            capacity = max(16, 2 * n)
+            self._roles = np.resize(self._roles, capacity)
+            self._num_tokens = np.resize(self._num_tokens, capacity)
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            matrix[:n] = self._matrix
+            self._matrix = matrix
+            added_bytes += self._arrays_size()
+        self._roles[n] = record.role
+        self._num_tokens[n] = record.num_tokens or 0
+        self._matrix[n] = np.frombuffer(embedding, dtype=np.float32)
+        self.records.append(record)
+        self.positions.append(position)
+        self.num_bytes += added_bytes
+        return added_bytes
+
+    def older(self, num_recent: int) -> IndexedMessages:
+        """The indexed messages before the `num_recent` most recent messages of the session."""
+        n = bisect.bisect_left(self.positions, self.num_messages - num_recent)
+        # Copies, since the arrays are changed in place by `append`
+        return IndexedMessages(
+            self.records[:n], self._roles[:n].copy(), self._num_tokens[:n].copy(), self._matrix[:n].copy()
+        )
+
+    def _arrays_size(self) -> int:
+        return self._roles.nbytes + self._num_tokens.nbytes + self._matrix.nbytes + 8 * len(self.positions)
+
+
+class _CachedHistory:
+    __slots__ = ("records", "index", "num_bytes", "last_access")
+
+    def __init__(self, records: List[MessageRecord]):
+        self.records = records
+        self.index: Optional[EmbeddingIndex] = None  # loaded by the first request in retrieval mode
+        self.num_bytes = sum(record.size() for record in records)
+        self.last_access = time.monotonic()
+
+
+class HistoryCache:
+    """In-memory cache of the message history of active sessions.
+    Holds each session's messages that are not folded into its summary,
+    in chronological order, as written to the database.
+    In retrieval mode, it also holds the `EmbeddingIndex` of every message of the session, to which
+    saved messages are added with `append_embeddings`.
+    New turns are added with `append` when they are saved (write-through), and code changing
+    the history in the database must call `invalidate` or `clear`.
+    Sessions are evicted when idle for `idle_ttl_s` or, least recently used first,
+    when the cache exceeds `max_bytes`.
+    """
+
+    def __init__(
+        self, max_bytes: int = HISTORY_CACHE_MAX_BYTES, idle_ttl_s: float = HISTORY_CACHE_IDLE_TTL_S
+    ):
+        self.max_bytes = max_bytes
+        self.idle_ttl_s = idle_ttl_s
+        self._sessions: "OrderedDict[str, _CachedHistory]" = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        # Sessions being read from the database, set to True if they are written meanwhile
+        self._loading: Dict[str, bool] = {}
+        self._index_loading: Dict[str, bool] = {}  # same for the embedding indexes
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def load(self, db: Session, session_id: str) -> List[MessageRecord]:
+        """Return the history of a session, reading it from the database on a miss."""
+        cached = self._lookup(session_id)
+        if cached is not None:
+            return cached
+        return self._loaded(session_id, db.execute(history_query(session_id)).all())
+
+    async def load_async(self, db: AsyncSession, session_id: str) -> List[MessageRecord]:
+        """Same as `load`, for the async database sessions of the request path."""
+        cached = self._lookup(session_id)
+        if cached is not None:
+            return cached
+        return self._loaded(session_id, (await db.execute(history_query(session_id))).all())
+
+    def _lookup(self, session_id: str) -> Optional[List[MessageRecord]]:
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached is not None:
+                self.num_hits += 1
+                cached.last_access = time.monotonic()
+                self._sessions.move_to_end(session_id)
+                return list(cached.records)
+            self.num_misses += 1
+            self._loading[session_id] = False
+            return None
+
+    def _loaded(self, session_id: str, rows: list) -> List[MessageRecord]:
+        records = [MessageRecord(role, content, num_tokens) for role, content, num_tokens in rows]
+        with self._lock:
+            # Rows read while the session was written to may be stale, so do not cache them
+            if not self._loading.pop(session_id, True):
+                self._store(session_id, _CachedHistory(records))
+        return list(records)
+
+    async def older_messages_async(
+        self, db: AsyncSession, session_id: str, num_recent: int, dim: int
+    ) -> IndexedMessages:
+        """Messages of a session before its `num_recent` most recent ones, with their embeddings of `dim`
+        floats, from the session's embedding index. The index is read from the database on a miss, and
+        kept if the history of the session is cached.
+        """
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached.index is not None:
+                return cached.index.older(num_recent)
+            self._index_loading[session_id] = False
+        index = EmbeddingIndex.from_rows(dim, (await db.execute(embedding_query(session_id))).all())
+        with self._lock:
+            # Rows read while the session was written to may be stale, so do not cache them
+            written = self._index_loading.pop(session_id, True)
+            cached = self._sessions.get(session_id)
+            if not written and cached is not None and cached.index is None:
+                cached.index = index
+                cached.num_bytes += index.num_bytes
+                self._num_bytes += index.num_bytes
+                self._evict()
+        return index.older(num_recent)
+
+    def append_embeddings(self, session_id: str, messages: List[tuple]) -> None:
+        """Add newly saved `(MessageRecord, embedding bytes)` pairs to the embedding index of a session.
+        Sessions whose index is not loaded are left to `older_messages_async`.
+        """
+        with self._lock:
+            if session_id in self._index_loading:
+                self._index_loading[session_id] = True
+            cached = self._sessions.get(session_id)
+            if cached is None or cached.index is None:
+                return
+            added_bytes = sum(cached.index.append(record, embedding) for record, embedding in messages)
+            cached.num_bytes += added_bytes
+            self._num_bytes += added_bytes
+            self._evict()
+
+    def append(self, session_id: str, records: List[MessageRecord]) -> None:
+        """Add newly saved messages to a cached session. Uncached sessions are left to `load`."""
+        with self._lock:
+            self._mark_written(session_id)
+            cached = self._sessions.get(session_id)
+            if cached is None:
+                return
+            cached.records.extend(records)
+            added_bytes = sum(record.size() for record in records)
+            cached.num_bytes += added_bytes
+            self._num_bytes += added_bytes
+            cached.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self._evict()
+
+    def clear(self, session_id: str) -> None:
+        """Mark the history of a session as empty."""
+        with self._lock:
+            self._mark_written(session_id)
+            self._store(session_id, _CachedHistory([]))
+
+    def invalidate(self, session_id: str) -> None:
+        """Forget a session, its history is read from the database on the next `load`."""
+        with self._lock:
+            self._mark_written(session_id)
+            cached = self._sessions.pop(session_id, None)
+            if cached is not None:
+                self._num_bytes -= cached.num_bytes
+
+    def stats(self) -> dict:
+        return {
+            "num_sessions": len(self._sessions),
+            "num_bytes": self._num_bytes,
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+        }
+
+    def _mark_written(self, session_id: str) -> None:
+        if session_id in self._loading:
+            self._loading[session_id] = True
+        if session_id in self._index_loading:
+            self._index_loading[session_id] = True
+
+    def _store(self, session_id: str, cached: _CachedHistory) -> None:
+        previous = self._sessions.pop(session_id, None)
+        if previous is not None:
+            self._num_bytes -= previous.num_bytes
+        self._sessions[session_id] = cached
+        self._num_bytes += cached.num_bytes
+        self._evict()
+
+    def _evict(self) -> None:
+        # Sessions are ordered by last access, so idle and least recently used ones come first
+        idle_before = time.monotonic() - self.idle_ttl_s
+        while self._sessions:
+            session_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_access >= idle_before and self._num_bytes <= self.max_bytes:
+                break
+            del self._sessions[session_id]
+            self._num_bytes -= oldest.num_bytes
+            logger.debug(f"Evicted history of session {session_id} from cache")
+
+
+history_cache = HistoryCache()
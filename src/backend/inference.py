@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from typing import Iterator, List, Optional
+
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_chat_format import format_llama3
+from .batch_decoding import batch_decoding_supported, decode_batch
+from .parameters import BATCH_MAX_SEQUENCES, COMPACTION_MAX_SUMMARY_TOKENS
+from .prefix_cache import system_prompt_cache
+from .profiles import active_profile
+from .speculative import DraftStatistics
+from .state_cache import session_state_cache
+
+logger = logging.getLogger(__name__)
+
+# Set when the job running on this process's inference worker has to stop early, see `InferenceJob.cancel`.
+# Worker processes of the pool replace it with an event shared with the parent process.
+cancel_event = threading.Event()
+
+# Finish reasons of generations stopped before the end of their response, which are not saved
+ABORTED_FINISH_REASONS = ("cancelled", "timeout")
+
+
+def stop_reason(deadline: float) -> Optional[str]:
+    """Why the running generation has to stop now, or None to keep going."""
+    if cancel_event.is_set():
+        return "cancelled"
+    if time.monotonic() >= deadline:
+        return "timeout"
+    return None
+
+
+def generate_chat_completion(
+    llm: Llama,
+    session_id: str,
+    messages: List[dict],
+    options: dict,
+    time_limit_s: float,
+    stream: bool = False,
+) -> Iterator[dict]:
+    """Generate a response for `messages` with the generation `options`, see `profiles.generation_options`,
+    and yield it as events.
+    When streaming, a `{"token": ...}` event is yielded for every generated chunk.
+    The last event always holds the full response, its token count, its finish reason and the timings
+    of the prefill (time to the first token) and the decode. The generation stops early when the job
+    is cancelled or runs for longer than `time_limit_s`.
+    This runs on the inference worker that owns `llm`.
+    """
+    started_at = time.perf_counter()
+    deadline = time.monotonic() + time_limit_s
+    # Load the model state of this session so that only the new turn has to be evaluated,
+    # or else start from its evaluated system prompt
+    system_prompt_hit = None
+    if not session_state_cache.restore(llm, session_id):
+        system_prompt_hit = system_prompt_cache.restore(llm, messages[0]["content"])
+    restored_at = time.perf_counter()
+    draft_model = getattr(llm, "draft_model", None)
+    if isinstance(draft_model, DraftStatistics):
+        draft_model.reset()
+
+    # Always generated as a stream, so that the prefill and the decode can be timed apart
+    chunks = []
+    finish_reason = None
+    first_token_at = None
+    for chunk in llm.create_chat_completion(messages=messages, stream=True, **options):
+        choice = chunk["choices"][0]
+        finish_reason = choice["finish_reason"] or finish_reason
+        token = choice["delta"].get("content")
+        if token:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            chunks.append(token)
+            if stream:
+                yield {"token": token}
+        aborted = stop_reason(deadline)
+        if aborted is not None:
+            finish_reason = aborted
+            break
+    finished_at = time.perf_counter()
+    logger.debug(f"Finish reason: {finish_reason}")
+
+    response_text = "".join(chunks).strip()
+    yield {
+        "response": response_text,
+        "completion_tokens": len(llm.tokenize(response_text.encode("utf-8"), add_bos=False)),
+        "finish_reason": finish_reason,
+        "timings": {
+            "state_restore_s": restored_at - started_at,
+            "ttft_s": (first_token_at or finished_at) - restored_at,
+            "decode_s": finished_at - (first_token_at or finished_at),
+            # Whether the system prompt was reused or evaluated, None when the session state was restored
+            "system_prompt_hit": system_prompt_hit,
+        },
+        # Drafted and accepted tokens when speculative decoding is enabled
+        "speculative": draft_model.stats() if isinstance(draft_model, DraftStatistics) else None,
+    }
+
+
+def generate_batch_completions(
+    llm: Llama, conversations: List[List[dict]], options: dict, time_limit_s: float
+) -> Iterator[dict]:
+    """Generate a response for each list of messages, yielding them as they complete.
+    When the job is cancelled or runs for longer than `time_limit_s`, the responses not completed
+    yet are yielded as they are, with the `cancelled` or `timeout` finish reason.
+    Conversations too long for the context are yielded right away with the `error` finish reason.
+    The conversations are decoded together with llama.cpp's multi-sequence batching, each in its
+    own sequence of the KV cache. Models that do not expose the llama.cpp internals it needs, like
+    the fake used by the benchmarks, generate them one after the other instead.
+    """
+    # The batch overwrites the context of the active session
+    session_state_cache.release(llm)
+    started_at = time.perf_counter()
+    deadline = time.monotonic() + time_limit_s
+
+    # The model is loaded with the llama-3 chat format, see `load_model`
+    prompts = [
+        llm.tokenize(format_llama3(messages).prompt.encode("utf-8"), add_bos=True, special=True)
+        for messages in conversations
+    ]
+    # A prompt filling the whole context leaves no room for its response
+    valid = []
+    for index, prompt in enumerate(prompts):
+        if len(prompt) < active_profile.n_ctx:
+            valid.append(index)
+            continue
+        yield {
+            "index": index,
+            "response": "",
+            "completion_tokens": 0,
+            "finish_reason": "error",
+            "error": f"Prompt of {len(prompt)} tokens exceeds the context of {active_profile.n_ctx} tokens",
+        }
+
+    if not batch_decoding_supported(llm):
+        if isinstance(llm, Llama):
+            logger.warning(f"Batched decoding is not supported by llama_cpp {llama_cpp.__version__}")
+        for index in valid:
+            aborted = stop_reason(deadline)
+            if aborted is not None:
+                yield {"index": index, "response": "", "completion_tokens": 0, "finish_reason": aborted}
+                continue
+            output = llm.create_chat_completion(messages=conversations[index], **options)
+            yield {
+                "index": index,
+                "response": output["choices"][0]["message"]["content"].strip(),
+                "completion_tokens": output["usage"]["completion_tokens"],
+                "finish_reason": output["choices"][0]["finish_reason"],
+            }
+        return
+
+    if options["seed"] is not None:
+        llm.set_seed(options["seed"])
+    num_generated = 0
+    for position, completion, finish_reason in decode_batch(
+        llm,
+        [prompts[index] for index in valid],
+        lambda: llm._init_sampler(
+            temp=options["temperature"], repeat_penalty=options["repeat_penalty"]
+        ),
+        max_tokens=options["max_tokens"],
+        max_sequences=BATCH_MAX_SEQUENCES,
+        should_stop=lambda: stop_reason(deadline),
+    ):
+        index = valid[position]
+        num_generated += len(completion)
+        yield {
+            "index": index,
+            "response": llm.detokenize(completion, prev_tokens=prompts[index])
+            .decode("utf-8", errors="ignore")
+            .strip(),
+            "completion_tokens": len(completion),
+            "finish_reason": finish_reason,
+        }
+    elapsed_s = time.perf_counter() - started_at
+    logger.info(
+        f"Batch of {len(prompts)} prompts generated {num_generated} tokens "
+        f"in {elapsed_s:.2f}s ({num_generated / elapsed_s:.1f} tokens/s)"
+    )
+
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages. Keep facts, names, decisions and open questions, "
+    "drop small talk. Answer with the updated summary only."
+)
+
+
+def generate_summary(llm: Llama, summary: str, transcript: str) -> Iterator[dict]:
+    """Fold a transcript of older messages into the running summary of a session."""
+    # The context of the active session is about to be overwritten
+    session_state_cache.release(llm)
+    output = llm.create_chat_completion(
+        messages=[
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {
+                "role": "user",
+                "content": f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}",
+            },
+        ],
+        max_tokens=COMPACTION_MAX_SUMMARY_TOKENS,
+        temperature=0,
+    )
+    yield {
+        "summary": output["choices"][0]["message"]["content"].strip(),
+        "num_tokens": output["usage"]["completion_tokens"],
+    }
+
+
+def warm_up(llm: Llama, system_message: str, prompt: str, max_tokens: int) -> Iterator[dict]:
+    """Run a short generation, so that the first request does not pay for the first evaluation.
+    The evaluated system message is kept in the system prompt cache, where new sessions using it reuse it.
+    """
+    session_state_cache.release(llm)
+    started_at = time.perf_counter()
+    system_prompt_cache.restore(llm, system_message)
+    llm.create_chat_completion(
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt},
+        ],
+        max_tokens=max_tokens,
+        temperature=0,
+    )
+    yield {"warmup_s": time.perf_counter() - started_at}
+
+
+def drop_session_state(llm: Llama, session_id: str) -> Iterator[dict]:
+    """Drop the cached model state of a session on the worker that runs this job."""
+    session_state_cache.drop(session_id)
+    yield from ()
@@ -1,22 +1,179 @@
-from fastapi import FastAPI
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager
-from .model import load_model
+from .memory import Embedder
+from .model import load_embedding_model, load_model
 from .api import router  # assuming you defined routes in api.py
-from .chat_history_db import init_db
+from .chat_history_db import init_async_db, init_db
+from .compaction import HistoryCompactor
+from .inference import warm_up
+from .maintenance import SessionReaper
+from .metrics import MODEL_LOAD_SECONDS
+from .parameters import (
+    COMPACTION_ENABLED,
+    INFERENCE_EXECUTOR_THREADS,
+    NUM_WORKERS,
+    PROFILE_HEADER,
+    PROFILING_ENABLED,
+    RETRIEVAL_ENABLED,
+    WARMUP_ENABLED,
+    WARMUP_MAX_TOKENS,
+    WARMUP_PROMPT,
+    WARMUP_SYSTEM_MESSAGE,
+)
+from .persistence import WriteBehindWriter
+from .profiler import SamplingProfiler, new_profile_path
+from .response_cache import response_cache
+from .scheduler import PRIORITY_BACKGROUND, InferenceScheduler
+from .state_cache import session_state_cache
+from .worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.llm = load_model()
-    print("✅ Model loaded at startup")
-
     # Initialize database
     app.state.db_session = init_db()
+    app.state.writer = WriteBehindWriter(app.state.db_session)
+    app.state.writer.start()
+    # Expires the sessions of clients that exited without deleting them
+    app.state.reaper = SessionReaper(app.state.db_session, app.state.writer)
+    app.state.reaper.start()
+    # The request handlers use the async engine, the background threads above the sync one
+    app.state.async_db_session = init_async_db()
     print("✅ Database initialized")
 
+    # The model loads in the background, /chat answers 503 until `ready` is set
+    app.state.llm = None
+    app.state.scheduler = None
+    app.state.compactor = None
+    app.state.embedder = None  # embedding model of the retrieval mode
+    app.state.ready = threading.Event()
+    app.state.startup_error = None
+    app.state.active_jobs = {}  # inference job of every session with a turn being generated
+    # Blocking model calls of requests run here, apart from the thread pool of the other endpoints
+    app.state.inference_executor = ThreadPoolExecutor(
+        max_workers=INFERENCE_EXECUTOR_THREADS, thread_name_prefix="inference-call"
+    )
+    app.state.loader = threading.Thread(
+        target=start_inference, args=(app.state,), name="model-loader", daemon=True
+    )
+    app.state.loader.start()
+
     yield
     print("🔻 Shutting down...")
+    app.state.loader.join()
+    if app.state.compactor is not None:
+        app.state.compactor.stop()
+    if app.state.scheduler is not None:
+        app.state.scheduler.stop()
+    # The stopped scheduler ended every job, so no call is left waiting on the executor
+    app.state.inference_executor.shutdown(wait=False)
+    await app.state.async_db_session.kw["bind"].dispose()
+    app.state.reaper.stop()
+    app.state.writer.stop()  # durable flush of the queued turns
+    session_state_cache.clear()  # sessions do not outlive the server, so neither do their states
+    response_cache.close()
+
+
+def start_inference(state) -> None:
+    """Load the model, start the inference workers and warm them up."""
+    try:
+        load_started_at = time.perf_counter()
+        if NUM_WORKERS > 1:
+            # Each worker process loads its own model, this process only needs the tokenizer
+            state.llm = load_model(vocab_only=True)
+            state.scheduler = WorkerPool()
+            state.scheduler.start()
+            state.scheduler.wait_ready()
+            print(f"✅ {NUM_WORKERS} model workers loaded at startup")
+        else:
+            state.llm = load_model()
+            print("✅ Model loaded at startup")
+
+            # All model calls go through the scheduler's single worker
+            state.scheduler = InferenceScheduler(state.llm)
+            state.scheduler.start()
+        if RETRIEVAL_ENABLED:
+            # Runs in this process, for the requests and the write-behind writer
+            state.embedder = Embedder(load_embedding_model())
+            state.writer.embedder = state.embedder
+            print("✅ Embedding model loaded at startup")
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - load_started_at)
+
+        if WARMUP_ENABLED:
+            warm_up_workers(state.scheduler)
+
+        if COMPACTION_ENABLED:
+            state.compactor = HistoryCompactor(state.scheduler, state.db_session, state.writer)
+            state.compactor.start()
+        state.ready.set()
+    except Exception as e:
+        logger.exception("Failed to load the model")
+        state.startup_error = f"{type(e).__name__}: {e}"
+
+
+def warm_up_workers(scheduler) -> None:
+    """Run the warm-up generation once on every inference worker."""
+    if isinstance(scheduler, WorkerPool):
+        workers = [worker for worker in scheduler.workers if worker.ready.is_set()]
+    else:
+        workers = [scheduler]
+    jobs = [
+        worker.submit(
+            warm_up,
+            WARMUP_SYSTEM_MESSAGE,
+            WARMUP_PROMPT,
+            WARMUP_MAX_TOKENS,
+            priority=PRIORITY_BACKGROUND,
+        )
+        for worker in workers
+    ]
+    for job in jobs:
+        try:
+            print(f"✅ Model warmed up in {job.result()['warmup_s']:.2f}s")
+        except Exception:
+            # Only the first request of the worker is slower
+            logger.exception("Model warm-up failed")
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(router)  # adding all api routes to the app
+
+
+async def profile_request(request: Request, call_next):
+    """Profile requests sent with the profiling header, until their response body is sent."""
+    if PROFILE_HEADER not in request.headers:
+        return await call_next(request)
+
+    profile_path = new_profile_path(request.url.path)
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        response = await call_next(request)
+    except Exception:
+        profiler.stop(profile_path)
+        raise
+
+    body = response.body_iterator
+
+    async def profiled_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            profiler.stop(profile_path)
+
+    response.body_iterator = profiled_body()
+    response.headers["X-Profile-File"] = str(profile_path)
+    return response
+
+
+# Only installed when enabled, the middleware adds overhead to every request
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_request)
@@ -0,0 +1,186 @@
+import datetime
+import gzip
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from .chat_history_db import ChatSession, Message, utc_now
+from .history_cache import history_cache
+from .metrics import DB_MAINTENANCE_SECONDS, EXPIRED_SESSIONS
+from .parameters import (
+    DB_ANALYSIS_LIMIT,
+    DB_MAINTENANCE_INTERVAL_S,
+    DB_VACUUM_MAX_PAGES,
+    SESSION_ARCHIVE_DIR,
+    SESSION_ARCHIVE_ENABLED,
+    SESSION_REAPER_BATCH_PAUSE_S,
+    SESSION_REAPER_BATCH_SIZE,
+    SESSION_REAPER_INTERVAL_S,
+    SESSION_TTL_S,
+)
+from .persistence import WriteBehindWriter
+from .state_cache import session_state_cache
+
+logger = logging.getLogger(__name__)
+
+
+class SessionReaper:
+    """Expires sessions idle for longer than `ttl_s` and keeps the database file compact.
+    Runs in a background thread every `interval_s`. Expired sessions are deleted in transactions
+    of at most `batch_size` sessions, pausing in between so that the turns written by requests are
+    not held up, and are first appended to a gzip-compressed JSONL archive when `archive` is set.
+    Every `maintenance_interval_s`, the pages freed by the deletes are returned to the file system
+    with an incremental VACUUM and the query planner statistics are refreshed with ANALYZE.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        writer: WriteBehindWriter,
+        ttl_s: float = SESSION_TTL_S,
+        interval_s: float = SESSION_REAPER_INTERVAL_S,
+        batch_size: int = SESSION_REAPER_BATCH_SIZE,
+        archive: bool = SESSION_ARCHIVE_ENABLED,
+        archive_dir: Path = SESSION_ARCHIVE_DIR,
+        maintenance_interval_s: float = DB_MAINTENANCE_INTERVAL_S,
+    ):
+        self.session_factory = session_factory
+        self.writer = writer
+        self.ttl_s = ttl_s
+        self.interval_s = interval_s
+        self.batch_size = batch_size
+        self.archive = archive
+        self.archive_dir = archive_dir
+        self.maintenance_interval_s = maintenance_interval_s
+        self._last_maintenance = time.monotonic()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.expire_sessions()
+                if time.monotonic() - self._last_maintenance >= self.maintenance_interval_s:
+                    self.compact_database()
+                    self._last_maintenance = time.monotonic()
+            except Exception:
+                logger.exception("Session maintenance failed")
+            self._stopping.wait(self.interval_s)
+
+    def expire_sessions(self) -> int:
+        """Delete, or archive then delete, every session idle for longer than the TTL."""
+        cutoff = utc_now() - datetime.timedelta(seconds=self.ttl_s)
+        num_expired = 0
+        while not self._stopping.is_set():
+            db = self.session_factory()
+            try:
+                session_ids = db.scalars(
+                    select(ChatSession.session_id)
+                    .where(ChatSession.last_activity < cutoff)
+                    .order_by(ChatSession.last_activity)
+                    .limit(self.batch_size)
+                ).all()
+                # Turns still queued for these sessions make them active again
+                session_ids = [
+                    session_id for session_id in session_ids if not self.writer.has_unsaved(session_id)
+                ]
+                if not session_ids:
+                    break
+                expired_ids = self._expire_batch(db, session_ids, cutoff)
+            finally:
+                db.close()
+            num_expired += len(expired_ids)
+            for session_id in expired_ids:
+                history_cache.invalidate(session_id)
+                session_state_cache.drop(session_id)
+            self._stopping.wait(SESSION_REAPER_BATCH_PAUSE_S)
+
+        if num_expired:
+            logger.info(
+                f"Expired {num_expired} sessions idle for more than {self.ttl_s:.0f}s"
+                + (f", archived to {self.archive_dir}" if self.archive else "")
+            )
+        return num_expired
+
+    def _expire_batch(self, db: Session, session_ids: List[str], cutoff: datetime.datetime) -> List[str]:
+        # The session rows are deleted first, which takes the write lock, so no turn can be added
+        # to them before the transaction ends. Sessions that were active since the select are skipped.
+        expired = db.execute(
+            delete(ChatSession)
+            .where(ChatSession.session_id.in_(session_ids), ChatSession.last_activity < cutoff)
+            .returning(
+                ChatSession.session_id,
+                ChatSession.created_at,
+                ChatSession.last_activity,
+                ChatSession.summary,
+            )
+        ).all()
+        expired_ids = [row.session_id for row in expired]
+        if self.archive and expired:
+            messages = db.execute(
+                select(Message.session_id, Message.role, Message.content, Message.timestamp, Message.num_tokens)
+                .where(Message.session_id.in_(expired_ids))
+                .order_by(Message.session_id, Message.timestamp, Message.id)
+            ).all()
+            self._archive(expired, messages)
+        db.execute(delete(Message).where(Message.session_id.in_(expired_ids)))
+        db.commit()
+        EXPIRED_SESSIONS.inc(len(expired), action="archived" if self.archive else "deleted")
+        return expired_ids
+
+    def _archive(self, sessions: list, messages: list) -> None:
+        """Append one JSON line per session, with its messages, to today's archive file."""
+        messages_by_session = {}
+        for message in messages:
+            messages_by_session.setdefault(message.session_id, []).append(
+                {
+                    "role": message.role,
+                    "content": message.content,
+                    "timestamp": message.timestamp.isoformat(),
+                    "num_tokens": message.num_tokens,
+                }
+            )
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        archive_path = self.archive_dir / f"sessions-{utc_now():%Y%m%d}.jsonl.gz"
+        # Every append adds a gzip member, the file still reads as one stream with `gzip.open`
+        with gzip.open(archive_path, "at", encoding="utf-8") as f:
+            for session in sessions:
+                record = {
+                    "session_id": session.session_id,
+                    "created_at": session.created_at.isoformat(),
+                    "last_activity": session.last_activity.isoformat(),
+                    "summary": session.summary,
+                    "messages": messages_by_session.get(session.session_id, []),
+                }
+                f.write(json.dumps(record) + "\n")
+
+    def compact_database(self) -> None:
+        """Return free pages to the file system and refresh the query planner statistics."""
+        db = self.session_factory()
+        try:
+            with DB_MAINTENANCE_SECONDS.time():
+                num_free_pages = db.execute(text("PRAGMA freelist_count")).scalar()
+                # `incremental_vacuum` frees one page per step, and `execute` only steps once,
+                # so the statements run as a script on the SQLite connection
+                connection = db.connection().connection.driver_connection
+                connection.executescript(
+                    f"PRAGMA incremental_vacuum({DB_VACUUM_MAX_PAGES});"
+                    f"PRAGMA analysis_limit={DB_ANALYSIS_LIMIT};"
+                    "ANALYZE;"
+                )
+            logger.info(f"Database compacted, {min(num_free_pages, DB_VACUUM_MAX_PAGES)} free pages released")
+        finally:
+            db.close()
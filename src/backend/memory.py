@@ -0,0 +1,89 @@
+import logging
+import threading
+from typing import List
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .history_cache import MessageRecord, history_cache
+from .parameters import RETRIEVAL_MAX_TOKENS, RETRIEVAL_RECENT_MESSAGES, RETRIEVAL_TOP_K
+
+logger = logging.getLogger(__name__)
+
+
+class Embedder:
+    """Turns texts into unit-length float32 vectors with the local embedding model.
+    The model is shared by the request handlers and the write-behind writer, one call at a time.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """One row per text, so that the dot product of two rows is their cosine similarity."""
+        with self._lock:
+            vectors = np.asarray(self.model.embed(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def select_relevant_turns(
+    roles: np.ndarray,
+    num_tokens: np.ndarray,
+    embeddings: np.ndarray,
+    query: np.ndarray,
+    top_k: int = RETRIEVAL_TOP_K,
+    max_tokens: int = RETRIEVAL_MAX_TOKENS,
+) -> np.ndarray:
+    """Positions of the messages of the `top_k` turns most similar to `query`, in chronological order.
+    `embeddings` holds one unit-length row per message, in chronological order. A turn starts at each
+    user message and scores as its most similar message. Turns that do not fit in `max_tokens` are skipped.
+    """
+    if len(roles) == 0:
+        return np.array([], dtype=np.intp)
+    starts = np.union1d([0], np.flatnonzero(roles == "user"))
+    ends = np.append(starts[1:], len(roles))
+    turn_scores = np.maximum.reduceat(embeddings @ query, starts)
+    turn_tokens = np.add.reduceat(num_tokens, starts)
+
+    # Only the best turns are sorted, there may be thousands of them
+    if len(starts) > top_k:
+        candidates = np.argpartition(-turn_scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(starts))
+    candidates = candidates[np.argsort(-turn_scores[candidates])]
+    selected = []
+    for turn in candidates:
+        if turn_tokens[turn] <= max_tokens:
+            selected.append(turn)
+            max_tokens -= turn_tokens[turn]
+    selected.sort()
+    if not selected:
+        return np.array([], dtype=np.intp)
+    return np.concatenate([np.arange(starts[turn], ends[turn]) for turn in selected])
+
+
+async def retrieve_history(
+    db: AsyncSession,
+    session_id: str,
+    history: List[MessageRecord],
+    query: np.ndarray,
+    has_summary: bool = False,
+) -> List[MessageRecord]:
+    """Messages to send for a new prompt instead of the whole `history` of a session: the most relevant
+    older turns, including the ones folded into the summary, followed by the recent messages.
+    `history` is the session's history from the history cache and `query` the embedding of the prompt.
+    The older messages and their embeddings come from the history cache as well, the database is only
+    read when they are not cached.
+    """
+    recent = history[-RETRIEVAL_RECENT_MESSAGES:]
+    if len(history) <= RETRIEVAL_RECENT_MESSAGES and not has_summary:
+        return history
+
+    older = await history_cache.older_messages_async(db, session_id, len(recent), query.shape[0])
+    if not older.records:
+        return recent
+    positions = select_relevant_turns(older.roles, older.num_tokens, older.embeddings, query)
+    logger.debug(f"Retrieved {len(positions)} of {len(older.records)} older messages for session {session_id}")
+    return [older.records[i] for i in positions] + recent
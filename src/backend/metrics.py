@@ -0,0 +1,211 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Default histogram buckets in seconds, from fast DB statements to long generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        return lines + self._render_samples()
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels) -> None:
+        """Mirror a count kept by another component, e.g. the scheduler."""
+        with self._lock:
+            self._values[self._label_key(labels)] = value
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, e.g. a queue depth sampled when the metrics are scraped."""
+
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._label_key(labels)] = value
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label key: count per bucket (the last one is +Inf), sum of observations
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the `with` block."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    bucket_labels = self._format_labels(key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total[0]}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+CHAT_STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "chat_stage_seconds",
+        "Time spent in each stage of a /chat request.",
+        ["stage"],
+    )
+)
+CHAT_REQUESTS = REGISTRY.register(
+    Counter("chat_requests_total", "Number of /chat requests by outcome.", ["outcome"])
+)
+TIME_TO_FIRST_TOKEN_SECONDS = REGISTRY.register(
+    Histogram(
+        "chat_time_to_first_token_seconds",
+        "Time from the start of generation to the first token, i.e. prompt evaluation (prefill).",
+    )
+)
+DECODE_TOKENS_PER_SECOND = REGISTRY.register(
+    Histogram(
+        "chat_decode_tokens_per_second",
+        "Generation speed after the first token.",
+        buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200),
+    )
+)
+GENERATED_TOKENS = REGISTRY.register(
+    Counter("chat_generated_tokens_total", "Number of tokens generated by the model.")
+)
+SPECULATIVE_TOKENS = REGISTRY.register(
+    Counter(
+        "chat_speculative_tokens_total",
+        "Tokens drafted by speculative decoding, and how many of them the model accepted.",
+        ["result"],
+    )
+)
+SYSTEM_PROMPT_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "system_prompt_cache_lookups_total",
+        "System prompts that new session contexts started from, reused or evaluated.",
+        ["result"],
+    )
+)
+MODEL_LOAD_SECONDS = REGISTRY.register(
+    Gauge("model_load_seconds", "Time it took to load the model at startup.")
+)
+WRITE_BEHIND_FLUSH_SECONDS = REGISTRY.register(
+    Histogram("write_behind_flush_seconds", "Time it takes to write one batch of queued turns.")
+)
+EXPIRED_SESSIONS = REGISTRY.register(
+    Counter("expired_sessions_total", "Sessions expired by the reaper, archived or deleted.", ["action"])
+)
+DB_MAINTENANCE_SECONDS = REGISTRY.register(
+    Histogram("db_maintenance_seconds", "Time it takes to vacuum and analyze the database.")
+)
+# Sampled from the components' own statistics when the metrics are scraped
+SCHEDULER_QUEUE_DEPTH = REGISTRY.register(
+    Gauge("scheduler_queue_depth", "Number of inference jobs waiting for the model.")
+)
+SCHEDULER_JOBS = REGISTRY.register(
+    Counter("scheduler_jobs_total", "Number of inference jobs by outcome.", ["outcome"])
+)
+HISTORY_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("history_cache_lookups_total", "History cache lookups by result.", ["result"])
+)
+HISTORY_CACHE_BYTES = REGISTRY.register(
+    Gauge("history_cache_bytes", "Approximate size of the cached histories.")
+)
+RESPONSE_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("response_cache_lookups_total", "Response cache lookups by result.", ["result"])
+)
+RESPONSE_CACHE_BYTES = REGISTRY.register(
+    Gauge("response_cache_bytes", "Size of the response cache on disk.")
+)
+DB_POOL_CONNECTIONS = REGISTRY.register(
+    Gauge("db_pool_connections", "Database connections of the pool by state.", ["state"])
+)
@@ -1,27 +1,97 @@
+import importlib
+from pathlib import Path
+from typing import Optional
+
 from llama_cpp import Llama
-from .parameters import MAX_TOKENS, CHACHED_MODEL_PATH
+from .parameters import (
+    CHACHED_MODEL_PATH,
+    EMBEDDING_MODEL_FACTORY,
+    EMBEDDING_MODEL_FILENAME,
+    EMBEDDING_MODEL_REPO_ID,
+    EMBEDDING_N_CTX,
+    MODEL_FACTORY,
+    MODEL_FILENAME,
+    MODEL_REPO_ID,
+)
+from .profiles import PerformanceProfile, active_profile
+from .speculative import create_draft_model
 
-# TODO: separate model configuration from loading logic
-def load_model() -> Llama:
+def load_model(
+    n_threads: Optional[int] = None,
+    vocab_only: bool = False,
+    profile: PerformanceProfile = active_profile,
+) -> Llama:
+    """Load the model with the settings of a performance profile.
+    `n_threads` replaces the decode threads of the profile, e.g. a worker's share of the cores.
+    With `vocab_only`, only the tokenizer is loaded, which is enough for counting tokens.
+    """
     print("Loading model...")
-    # check if the model is already cached
+    n_threads = n_threads or profile.n_threads
+    if MODEL_FACTORY:
+        module_name, factory_name = MODEL_FACTORY.split(":")
+        factory = getattr(importlib.import_module(module_name), factory_name)
+        return factory(n_ctx=profile.n_ctx, n_threads=n_threads, vocab_only=vocab_only)
+
+    model_options = dict(
+        profile.model_options(),  # n_ctx goes up to 128k for llama-3.2
+        verbose=False,
+        chat_format="llama-3",
+        n_threads=n_threads,
+        vocab_only=vocab_only,
+        # The tokenizer-only model of the API process never generates
+        draft_model=None if vocab_only else create_draft_model(profile.n_ctx, n_threads),
+    )
     # from_pretrained will raise error without an internet connection
-    # even when not downloading the model
-    model_path = CHACHED_MODEL_PATH.expanduser().resolve()
-    if model_path.exists():
-        llm = Llama(
-            model_path=str(model_path),
-            verbose=False,
-            chat_format="llama-3",
-            n_ctx=MAX_TOKENS,
-        )
+    # even when not downloading the model, so look for a cached copy first
+    model_path = find_cached_model()
+    if model_path is not None:
+        llm = Llama(model_path=str(model_path), **model_options)
     else:
-        llm = Llama.from_pretrained(
-            repo_id="unsloth/Llama-3.2-3B-Instruct-GGUF",
-            filename="Llama-3.2-3B-Instruct-IQ4_NL.gguf",
-            verbose=False,
-            chat_format="llama-3",
-            n_ctx=MAX_TOKENS,  # goes up to 128k for llama-3.2
-        )
+        llm = Llama.from_pretrained(repo_id=MODEL_REPO_ID, filename=MODEL_FILENAME, **model_options)
     print("Model loaded.")
     return llm
+
+
+def load_embedding_model():
+    """Load the small model embedding the messages in retrieval mode, see memory.py."""
+    print("Loading embedding model...")
+    if EMBEDDING_MODEL_FACTORY:
+        module_name, factory_name = EMBEDDING_MODEL_FACTORY.split(":")
+        factory = getattr(importlib.import_module(module_name), factory_name)
+        return factory(n_ctx=EMBEDDING_N_CTX)
+
+    model_options = dict(
+        embedding=True,
+        n_ctx=EMBEDDING_N_CTX,
+        n_batch=EMBEDDING_N_CTX,  # each text is embedded in one batch
+        n_ubatch=EMBEDDING_N_CTX,
+        verbose=False,
+    )
+    model_path = find_cached_model(EMBEDDING_MODEL_REPO_ID, EMBEDDING_MODEL_FILENAME, cached_path=None)
+    if model_path is not None:
+        embedding_model = Llama(model_path=str(model_path), **model_options)
+    else:
+        embedding_model = Llama.from_pretrained(
+            repo_id=EMBEDDING_MODEL_REPO_ID, filename=EMBEDDING_MODEL_FILENAME, **model_options
+        )
+    print("Embedding model loaded.")
+    return embedding_model
+
+
+def find_cached_model(
+    repo_id: str = MODEL_REPO_ID,
+    filename: str = MODEL_FILENAME,
+    cached_path: Optional[Path] = CHACHED_MODEL_PATH,
+) -> Optional[Path]:
+    """Path of the model file if it is already downloaded, without accessing the network."""
+    if cached_path is not None:
+        model_path = cached_path.expanduser().resolve()
+        if model_path.exists():
+            return model_path
+    try:
+        # The snapshot directory changes with every revision of the repository
+        from huggingface_hub import hf_hub_download
+
+        return Path(hf_hub_download(repo_id, filename, local_files_only=True))
+    except Exception:
+        return None
@@ -1,11 +1,157 @@
+import os
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 DATABASE_DIR = PROJECT_ROOT / "database"
 DATABASE_DIR.mkdir(exist_ok=True)  # Ensure the database directory exists
-DB_URL = f"sqlite:///{DATABASE_DIR / 'chat_history.db'}"  # Default database URL, can be overridden
+DB_URL = os.environ.get(
+    "CLICHATBOT_DB_URL", f"sqlite:///{DATABASE_DIR / 'chat_history.db'}"
+)  # Default database URL, can be overridden
+# The request handlers use an async engine on the same database, through the aiosqlite driver
+ASYNC_DB_URL = os.environ.get("CLICHATBOT_ASYNC_DB_URL", DB_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+
+# Write-behind persistence parameters
+# Conversation turns are queued and written in one transaction per flush
+WRITE_BEHIND_FLUSH_INTERVAL_S = 0.5
+WRITE_BEHIND_MAX_BATCH_SIZE = 256  # flush early once this many turns are queued
 
 # Model parameters
+# Context size of the default performance profile
 # Maximum for unsloth/Llama-3.2-3B-Instruct-GGUF/Llama-3.2-3B-Instruct-IQ4_NL.gguf is around 13k
 MAX_TOKENS = 10000
-CHACHED_MODEL_PATH = Path("~/.cache/huggingface/hub/models--unsloth--Llama-3.2-3B-Instruct-GGUF/snapshots/571c76bbd17f77e948aeda72fabfe31b9597864a/Llama-3.2-3B-Instruct-IQ4_NL.gguf")
\ No newline at end of file
+# "module:callable" building the model instead of `Llama`, e.g. the fake used by the benchmarks
+MODEL_FACTORY = os.environ.get("CLICHATBOT_MODEL_FACTORY")
+MODEL_REPO_ID = "unsloth/Llama-3.2-3B-Instruct-GGUF"
+MODEL_FILENAME = "Llama-3.2-3B-Instruct-IQ4_NL.gguf"
+CHACHED_MODEL_PATH = Path("~/.cache/huggingface/hub/models--unsloth--Llama-3.2-3B-Instruct-GGUF/snapshots/571c76bbd17f77e948aeda72fabfe31b9597864a/Llama-3.2-3B-Instruct-IQ4_NL.gguf")
+
+# Performance profile parameters
+# Named sets of model and generation settings (threads, batch sizes, context size, sampling...), see profiles.py.
+# Profiles written by `python -m src.backend.autotune` are saved to PERFORMANCE_PROFILES_FILE.
+PERFORMANCE_PROFILE = os.environ.get("CLICHATBOT_PERFORMANCE_PROFILE", "default")
+PERFORMANCE_PROFILES_FILE = PROJECT_ROOT / "config" / "performance_profiles.json"
+# Limits of the generation settings a request may override
+MAX_RESPONSE_TOKENS_CAP = 2048
+MAX_TEMPERATURE = 2.0
+MAX_REPEAT_PENALTY = 2.0
+
+# Speculative decoding parameters
+# None, "prompt_lookup" (drafts tokens by matching n-grams of the context, good for turns quoting earlier
+# messages) or "draft_model" (drafts tokens with the small GGUF model at DRAFT_MODEL_PATH).
+# NOTE: llama.cpp then keeps the logits of every token of the context, about n_ctx * 128k vocabulary * 4 bytes
+# of RAM for Llama 3.2, and cached session states grow accordingly, so use a profile with a smaller n_ctx.
+SPECULATIVE_DECODING = os.environ.get("CLICHATBOT_SPECULATIVE_DECODING")
+SPECULATIVE_NUM_PRED_TOKENS = 10  # tokens drafted per step
+SPECULATIVE_MAX_NGRAM_SIZE = 2  # prompt lookup: longest n-gram matched against the context
+DRAFT_MODEL_PATH = None  # e.g. Path("~/models/Llama-3.2-1B-Instruct-Q4_K_M.gguf"), must share the vocabulary
+
+# Startup parameters
+# The model is loaded in the background, /chat answers 503 until it is loaded and warmed up
+WARMUP_ENABLED = True
+# Matches the client's default, so that the first session reuses the evaluated system message
+WARMUP_SYSTEM_MESSAGE = """You are a helpful, respectful and honest assistant. \
+    Always answer as helpfully as possible, while being safe, and using the same language written by the user as a multilingual assistant. \
+    Your answers should be detailed, comprehensive but concise. \
+    """
+WARMUP_PROMPT = "Hello!"
+WARMUP_MAX_TOKENS = 8
+STARTUP_RETRY_AFTER_S = 5  # Retry-After sent with the 503 of requests made while the model loads
+
+# Session state cache parameters
+# Model states of inactive sessions are kept in memory up to this many bytes, then spilled to disk
+STATE_CACHE_MAX_BYTES = 2 * 1024**3
+STATE_CACHE_DIR = PROJECT_ROOT / "cache" / "session_states"
+
+# System prompt cache parameters
+# Token counts and evaluated model states of system prompts, which new sessions start from
+SYSTEM_PROMPT_CACHE_MAX_ENTRIES = 32
+SYSTEM_PROMPT_CACHE_MAX_BYTES = 512 * 1024**2  # model states of the least recently used prompts are evicted beyond this
+
+# Response cache parameters
+# Responses of deterministic (temperature 0 or fixed seed) requests, or of requests asking for it, are reused
+RESPONSE_CACHE_DIR = PROJECT_ROOT / "cache" / "responses"
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024**2  # least recently used responses are evicted beyond this
+
+
+# Inference scheduler parameters
+MAX_QUEUE_SIZE = 32  # requests waiting for the model beyond this are rejected with 429
+REQUEST_DEADLINE_S = 120.0  # requests still waiting for the model after this are dropped with 503
+# Generations running for longer than this are stopped, and their turn is not saved
+GENERATION_TIME_LIMIT_S = 120.0
+MAX_GENERATION_TIME_LIMIT_S = 600.0  # limit of the time limit a request may set
+
+# Threads of the executor running the blocking model calls of requests: tokenization and waiting for
+# the scheduler. Every queued or running request holds one, so there should be enough for a full queue.
+INFERENCE_EXECUTOR_THREADS = 64
+
+# Worker pool parameters
+# With more than one worker, each one runs in its own process with its own copy of the model
+NUM_WORKERS = 1
+WORKER_N_THREADS = None  # threads per worker, defaults to an equal share of the CPU cores
+WORKER_MAX_PENDING = 4  # a session is routed away from its worker when more jobs than this are pending
+
+
+# Batch completion parameters
+# /chat/batch decodes this many prompts at once, each in its own sequence of the shared KV cache
+BATCH_MAX_SEQUENCES = 8
+BATCH_MAX_PROMPTS = 64  # the whole batch runs as one job, so it holds the worker until it finishes
+
+
+# History cache parameters
+# Recent sessions' messages are kept in memory so that each turn does not re-read them from the database
+HISTORY_CACHE_MAX_BYTES = 64 * 1024**2
+HISTORY_CACHE_IDLE_TTL_S = 30 * 60  # sessions idle for longer are evicted
+
+
+# Session expiry parameters
+# Sessions are deleted by the client when it exits, those of clients that crashed are expired by a background task
+SESSION_TTL_S = float(os.environ.get("CLICHATBOT_SESSION_TTL_S", 7 * 24 * 3600))  # idle time before a session expires
+SESSION_REAPER_INTERVAL_S = 10 * 60
+SESSION_REAPER_BATCH_SIZE = 200  # sessions deleted per transaction, so that request writes are not held up
+SESSION_REAPER_BATCH_PAUSE_S = 0.1  # lets queued writes take the database lock between batches
+# When enabled, expired sessions are appended to one gzip-compressed JSONL file per day instead of being lost
+SESSION_ARCHIVE_ENABLED = os.environ.get("CLICHATBOT_SESSION_ARCHIVE", "0") == "1"
+SESSION_ARCHIVE_DIR = DATABASE_DIR / "archive"
+# Free pages left by deletes are returned to the file system, and query planner statistics refreshed, this often
+DB_MAINTENANCE_INTERVAL_S = 6 * 3600
+DB_VACUUM_MAX_PAGES = 2000  # pages freed per maintenance run, bounded so that the database is not locked for long
+DB_ANALYSIS_LIMIT = 1000  # rows sampled per index by ANALYZE
+
+
+# Export and import parameters
+# Sessions are exported and imported as NDJSON, one line per session with its messages, as in the archive
+EXPORT_FETCH_SIZE = 1000  # messages read per round trip of the export's server-side cursor
+IMPORT_BATCH_SIZE = 1000  # imported sessions are inserted in one transaction per this many rows, sessions and messages
+
+
+# History compaction parameters
+# When enabled, older turns of long sessions are folded into a summary generated in the background
+COMPACTION_ENABLED = False
+COMPACTION_THRESHOLD_TOKENS = 4000  # compact sessions whose history exceeds this many tokens
+COMPACTION_KEEP_RECENT_TOKENS = 1500  # the most recent turns up to this many tokens stay verbatim
+COMPACTION_MAX_SUMMARY_TOKENS = 500
+
+
+# Retrieval parameters
+# When enabled, each turn sends the recent messages and the older turns most similar to the new prompt,
+# instead of the whole history, which is then no longer trimmed. Messages are embedded by a small local model.
+RETRIEVAL_ENABLED = os.environ.get("CLICHATBOT_RETRIEVAL", "0") == "1"
+# "module:callable" building the embedding model instead of `Llama`, e.g. the fake used by the benchmarks
+EMBEDDING_MODEL_FACTORY = os.environ.get("CLICHATBOT_EMBEDDING_MODEL_FACTORY")
+EMBEDDING_MODEL_REPO_ID = "CompendiumLabs/bge-small-en-v1.5-gguf"
+EMBEDDING_MODEL_FILENAME = "bge-small-en-v1.5-q8_0.gguf"
+EMBEDDING_N_CTX = 512  # longer messages are truncated before being embedded
+RETRIEVAL_RECENT_MESSAGES = 6  # the most recent messages are always sent
+RETRIEVAL_TOP_K = 4  # older turns retrieved per request
+RETRIEVAL_MAX_TOKENS = 2000  # the retrieved turns take at most this many tokens of the prompt
+
+
+# Observability parameters
+LOG_LEVEL = os.environ.get("CLICHATBOT_LOG_LEVEL", "INFO")  # DEBUG logs every request's details
+# When enabled, requests sent with the header below are profiled by sampling the stacks of all threads
+PROFILING_ENABLED = os.environ.get("CLICHATBOT_PROFILING", "0") == "1"
+PROFILE_HEADER = "X-Profile"
+PROFILE_SAMPLE_INTERVAL_S = 0.005
+PROFILE_DIR = PROJECT_ROOT / "cache" / "profiles"
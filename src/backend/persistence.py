@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from .history_cache import MessageRecord, history_cache
+from .memory import Embedder
+from .metrics import WRITE_BEHIND_FLUSH_SECONDS
+from .parameters import (
+    MAX_GENERATION_TIME_LIMIT_S,
+    REQUEST_DEADLINE_S,
+    WRITE_BEHIND_FLUSH_INTERVAL_S,
+    WRITE_BEHIND_MAX_BATCH_SIZE,
+)
+from .utils_api import ConversationTurn, save_turns
+
+logger = logging.getLogger(__name__)
+
+# A request waits for the model and generates for at most this long, so it cannot submit a turn later
+MAX_TURN_DURATION_S = REQUEST_DEADLINE_S + MAX_GENERATION_TIME_LIMIT_S
+
+
+class WriteBehindWriter:
+    """Saves conversation turns off the request path.
+    Turns from all sessions are queued and written by a background thread in one transaction
+    per flush, every `flush_interval_s` or as soon as `max_batch_size` turns are waiting.
+    Code that reads or modifies the history of a session must call `wait_for_session` first,
+    so that it sees the turns still in the queue.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        flush_interval_s: float = WRITE_BEHIND_FLUSH_INTERVAL_S,
+        max_batch_size: int = WRITE_BEHIND_MAX_BATCH_SIZE,
+        embedder: Optional[Embedder] = None,
+    ):
+        self.session_factory = session_factory
+        # In retrieval mode, the messages of every batch are embedded before being written
+        self.embedder = embedder
+        self.flush_interval_s = flush_interval_s
+        self.max_batch_size = max_batch_size
+        self._pending: List[ConversationTurn] = []
+        self._num_unsaved = Counter()  # turns per session that are queued or being written
+        # Deleted sessions whose late turns are discarded, with the time of their deletion
+        self._discarded: "OrderedDict[str, float]" = OrderedDict()
+        self._flush_requested = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Write all queued turns and make them durable."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        # With synchronous=NORMAL the last commits may only be in the WAL, so checkpoint them
+        db = self.session_factory()
+        try:
+            db.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        finally:
+            db.close()
+
+    def submit(self, turn: ConversationTurn) -> bool:
+        """Queue a turn for saving. Returns False if its session was deleted, the turn is then dropped."""
+        with self._cond:
+            self._expire_discarded()
+            if turn.session_id in self._discarded:
+                logger.info(f"Dropping a turn of deleted session {turn.session_id}")
+                return False
+            self._pending.append(turn)
+            self._num_unsaved[turn.session_id] += 1
+            if len(self._pending) >= self.max_batch_size:
+                self._cond.notify_all()
+        return True
+
+    def discard_session(self, session_id: str) -> bool:
+        """Drop the queued turns of a session being deleted, and the turns submitted for it later
+        by requests that were already running, so that they do not create the session again.
+        Turns already being written are not affected, `wait_for_session` waits for them.
+        Returns whether queued turns were dropped.
+        """
+        with self._cond:
+            self._expire_discarded()
+            self._discarded[session_id] = time.monotonic()
+            kept = [turn for turn in self._pending if turn.session_id != session_id]
+            num_dropped = len(self._pending) - len(kept)
+            if num_dropped:
+                self._pending = kept
+                self._num_unsaved[session_id] -= num_dropped
+                if not self._num_unsaved[session_id]:
+                    del self._num_unsaved[session_id]
+                self._cond.notify_all()
+            return bool(num_dropped)
+
+    def has_unsaved(self, session_id: str) -> bool:
+        """Whether turns of a session are queued or being written."""
+        with self._cond:
+            return bool(self._num_unsaved[session_id])
+
+    def wait_for_session(self, session_id: str) -> None:
+        """Block until every queued turn of a session is saved, flushing right away if needed."""
+        with self._cond:
+            if self._num_unsaved[session_id]:
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: not self._num_unsaved[session_id])
+
+    def wait_for_all(self) -> None:
+        """Block until every queued turn is saved, flushing right away if needed."""
+        with self._cond:
+            if self._num_unsaved:
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: not self._num_unsaved)
+
+    def _expire_discarded(self) -> None:
+        """Forget the sessions deleted before any running request started. Called with the lock held."""
+        expired_before = time.monotonic() - MAX_TURN_DURATION_S
+        while self._discarded and next(iter(self._discarded.values())) < expired_before:
+            self._discarded.popitem(last=False)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping
+                    or self._flush_requested
+                    or len(self._pending) >= self.max_batch_size,
+                    timeout=self.flush_interval_s,
+                )
+                batch, self._pending = self._pending, []
+                self._flush_requested = False
+                stopping = self._stopping
+
+            if batch:
+                with WRITE_BEHIND_FLUSH_SECONDS.time():
+                    self._write(batch)
+                with self._cond:
+                    for turn in batch:
+                        self._num_unsaved[turn.session_id] -= 1
+                        if not self._num_unsaved[turn.session_id]:
+                            del self._num_unsaved[turn.session_id]
+                    self._cond.notify_all()
+
+            if stopping:
+                with self._cond:
+                    if not self._pending:
+                        return
+
+    def _write(self, batch: List[ConversationTurn]) -> None:
+        if self.embedder is not None:
+            batch = self._embed(batch)
+        db = self.session_factory()
+        saved = batch
+        try:
+            save_turns(db, batch)
+            logger.debug(f"Saved {len(batch)} conversation turns")
+        except Exception:
+            db.rollback()
+            logger.exception(f"Failed to save a batch of {len(batch)} turns, saving them one by one")
+            # Keep the good turns of a batch containing a bad one
+            saved = []
+            for turn in batch:
+                try:
+                    save_turns(db, [turn])
+                    saved.append(turn)
+                except Exception:
+                    db.rollback()
+                    logger.exception(f"Dropping unsaved turn of session {turn.session_id}")
+        finally:
+            db.close()
+        if self.embedder is not None:
+            # Retrieval reads the embeddings of the saved messages from the history cache
+            for turn in saved:
+                history_cache.append_embeddings(
+                    turn.session_id,
+                    [
+                        (MessageRecord("user", turn.prompt, turn.num_new_msg_tokens), turn.prompt_embedding),
+                        (
+                            MessageRecord("assistant", turn.response_text, turn.num_response_tokens),
+                            turn.response_embedding,
+                        ),
+                    ],
+                )
+
+    def _embed(self, batch: List[ConversationTurn]) -> List[ConversationTurn]:
+        """Fill in the missing embeddings of a batch with one call to the embedding model."""
+        texts = []
+        for turn in batch:
+            if turn.prompt_embedding is None:
+                texts.append(turn.prompt)
+            if turn.response_embedding is None:
+                texts.append(turn.response_text)
+        if not texts:
+            return batch
+        try:
+            embeddings = iter(self.embedder.embed(texts))
+        except Exception:
+            # The turns are still saved, they just cannot be retrieved
+            logger.exception(f"Failed to embed a batch of {len(batch)} turns")
+            return batch
+        return [
+            turn._replace(
+                prompt_embedding=turn.prompt_embedding or next(embeddings).tobytes(),
+                response_embedding=turn.response_embedding or next(embeddings).tobytes(),
+            )
+            for turn in batch
+        ]
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_chat_format import format_llama3
+
+from .parameters import SYSTEM_PROMPT_CACHE_MAX_BYTES, SYSTEM_PROMPT_CACHE_MAX_ENTRIES
+from .state_cache import state_size, strip_logits
+
+logger = logging.getLogger(__name__)
+
+END_OF_TURN = "<|eot_id|>"
+
+
+def system_prefix_tokens(llm: Llama, system_message: str) -> List[int]:
+    """Tokens that the chat prompt of every conversation starting with `system_message` begins with.
+    The model is loaded with the llama-3 chat format, see `load_model`. The system turn ends with a
+    special token, so its tokens do not depend on the messages that follow.
+    """
+    prompt = format_llama3([{"role": "system", "content": system_message}]).prompt
+    prefix = prompt[: prompt.index(END_OF_TURN) + len(END_OF_TURN)]
+    return llm.tokenize(prefix.encode("utf-8"), add_bos=True, special=True)
+
+
+class _SystemPrompt:
+    __slots__ = ("num_tokens", "prefix_tokens", "state", "num_bytes")
+
+    def __init__(self, num_tokens: int):
+        self.num_tokens = num_tokens  # tokens of the system message alone, as counted by the API
+        self.prefix_tokens: Optional[List[int]] = None  # tokens of the formatted system turn
+        self.state: Optional[LlamaState] = None  # model state after evaluating `prefix_tokens`
+        self.num_bytes = sys.getsizeof(self)
+
+
+class SystemPromptCache:
+    """LRU cache of system prompts keyed by a hash of the system message, shared by all sessions.
+    Holds the token count of the system message, so that requests do not tokenize it again, and the
+    model state after evaluating it, which new sessions start from so that their first turn only
+    evaluates the user prompt. Model states are only stored by the processes running inference.
+    At most `max_entries` system prompts are kept, and their states take at most `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = SYSTEM_PROMPT_CACHE_MAX_ENTRIES,
+        max_bytes: int = SYSTEM_PROMPT_CACHE_MAX_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _SystemPrompt]" = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def num_tokens(self, llm: Llama, system_message: str) -> int:
+        """Number of tokens of `system_message`, tokenized once per system prompt."""
+        key = self._key(system_message)
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry.num_tokens
+        num_tokens = len(llm.tokenize(system_message.encode("utf-8")))
+        with self._lock:
+            if self._get(key) is None:
+                self._add(key, _SystemPrompt(num_tokens))
+        return num_tokens
+
+    def restore(self, llm: Llama, system_message: str) -> bool:
+        """Make the context of `llm` start with the evaluated system prompt before generating for a
+        conversation whose own state is not cached. The rest of the context is left to the generation.
+        Returns True if the evaluated system prompt was reused, False if it had to be evaluated.
+        This runs on the inference worker that owns `llm`.
+        """
+        key = self._key(system_message)
+        with self._lock:
+            entry = self._get(key)
+            prefix_tokens = entry.prefix_tokens if entry is not None else None
+            state = entry.state if entry is not None else None
+        if prefix_tokens is None:
+            prefix_tokens = system_prefix_tokens(llm, system_message)
+
+        # E.g. the previous session had the same system prompt, generating reuses it right away
+        if list(llm._input_ids[: len(prefix_tokens)]) == prefix_tokens:
+            hit = True
+        elif state is not None:
+            llm.load_state(state)
+            hit = True
+        else:
+            started_at = time.perf_counter()
+            llm.reset()
+            llm.eval(prefix_tokens)
+            state = strip_logits(llm.save_state())
+            logger.info(
+                f"Evaluated a system prompt of {len(prefix_tokens)} tokens "
+                f"in {time.perf_counter() - started_at:.2f}s"
+            )
+            hit = False
+
+        with self._lock:
+            if hit:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+            entry = self._get(key)
+            if entry is None:
+                entry = self._add(key, _SystemPrompt(len(llm.tokenize(system_message.encode("utf-8")))))
+            entry.prefix_tokens = prefix_tokens
+            if entry.state is None and state is not None:
+                entry.state = state
+                added_bytes = state_size(state)
+                entry.num_bytes += added_bytes
+                self._num_bytes += added_bytes
+            self._evict()
+        return hit
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "num_entries": len(self._entries),
+                "num_bytes": self._num_bytes,
+                "num_hits": self.num_hits,
+                "num_misses": self.num_misses,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def _get(self, key: str) -> Optional[_SystemPrompt]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _add(self, key: str, entry: _SystemPrompt) -> _SystemPrompt:
+        self._entries[key] = entry
+        self._num_bytes += entry.num_bytes
+        self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        # Least recently used first, the most recent entry is always kept
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self._num_bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.num_bytes
+
+    @staticmethod
+    def _key(system_message: str) -> str:
+        return hashlib.sha256(system_message.encode("utf-8")).hexdigest()
+
+
+system_prompt_cache = SystemPromptCache()
@@ -0,0 +1,66 @@
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from .parameters import PROFILE_DIR, PROFILE_SAMPLE_INTERVAL_S
+
+logger = logging.getLogger(__name__)
+
+# Leaf frames of threads that are only waiting, e.g. idle thread pool workers
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+}
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of all threads of this process at a fixed interval.
+    The samples are written in the collapsed stack format read by flamegraph tools
+    (one `frame;frame;frame count` line per distinct stack). Model calls running in
+    worker processes are not sampled, only the time spent waiting for them.
+    """
+
+    def __init__(self, interval_s: float = PROFILE_SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, path: Path) -> None:
+        """Stop sampling and write the collapsed stacks to `path`."""
+        self._stopped.set()
+        self._thread.join()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Wrote {sum(self.samples.values())} profile samples to {path}")
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if (Path(frame.f_code.co_filename).name, frame.f_code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+
+def new_profile_path(label: str) -> Path:
+    """Unique file name for the profile of one request."""
+    safe_label = "".join(c if c.isalnum() else "_" for c in label).strip("_") or "root"
+    return PROFILE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{time.monotonic_ns()}-{safe_label}.folded"
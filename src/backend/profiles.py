@@ -0,0 +1,118 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from .parameters import MAX_TOKENS, PERFORMANCE_PROFILE, PERFORMANCE_PROFILES_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class PerformanceProfile(NamedTuple):
+    """Model and generation settings that control inference speed.
+    `None` leaves a setting to llama.cpp's default, e.g. one thread per physical core.
+    """
+
+    # Model settings, applied when the model is loaded
+    n_ctx: int = MAX_TOKENS
+    n_threads: Optional[int] = None  # threads used to generate tokens one by one (decode)
+    n_threads_batch: Optional[int] = None  # threads used to evaluate prompts (prefill)
+    n_batch: int = 512  # prompt tokens submitted to llama.cpp at once
+    n_ubatch: int = 512  # prompt tokens evaluated at once, at most n_batch
+    flash_attn: bool = False
+    use_mmap: bool = True  # map the model file instead of reading it, fast to load and shared between processes
+    use_mlock: bool = False  # lock the model in RAM so that it is never paged out, needs enough memlock quota
+    # Generation settings, the defaults of requests that do not override them
+    max_tokens: int = 1000
+    temperature: float = 1.0
+    repeat_penalty: float = 1.2
+    seed: Optional[int] = None  # a fixed seed makes responses reproducible, and cacheable
+
+    def check(self) -> None:
+        """Raise ValueError if the settings leave no room for the history of a conversation."""
+        # The rest of the context holds the system message, the history and the prompt
+        if self.max_tokens > self.n_ctx // 2:
+            raise ValueError(
+                f"max_tokens of {self.max_tokens} exceeds half of the context of {self.n_ctx} tokens"
+            )
+
+    def model_options(self) -> dict:
+        """Keyword arguments for `Llama`."""
+        return {
+            "n_ctx": self.n_ctx,
+            "n_threads": self.n_threads,
+            "n_threads_batch": self.n_threads_batch,
+            "n_batch": self.n_batch,
+            "n_ubatch": self.n_ubatch,
+            "flash_attn": self.flash_attn,
+            "use_mmap": self.use_mmap,
+            "use_mlock": self.use_mlock,
+        }
+
+    def generation_options(self) -> dict:
+        """Keyword arguments for `Llama.create_chat_completion`."""
+        return {
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "repeat_penalty": self.repeat_penalty,
+            "seed": self.seed,
+        }
+
+
+BUILTIN_PROFILES: Dict[str, PerformanceProfile] = {
+    "default": PerformanceProfile(),
+    # Smaller context and responses: faster attention, smaller session states to save and restore
+    "low_latency": PerformanceProfile(n_ctx=4096, flash_attn=True, max_tokens=512),
+    # Larger prompt batches for bulk jobs such as /chat/batch
+    "throughput": PerformanceProfile(n_batch=2048, n_ubatch=512, flash_attn=True),
+    # Small KV cache and buffers for machines with little RAM
+    "low_memory": PerformanceProfile(n_ctx=2048, n_batch=256, n_ubatch=256, max_tokens=512),
+}
+
+
+def load_profiles(path: Path = PERFORMANCE_PROFILES_FILE) -> Dict[str, PerformanceProfile]:
+    """Built-in profiles, plus the profiles saved in `path` such as the ones written by autotune.
+    Settings missing from a saved profile take the default value.
+    """
+    profiles = dict(BUILTIN_PROFILES)
+    if path.exists():
+        with open(path) as f:
+            for name, settings in json.load(f).items():
+                profiles[name] = PerformanceProfile(**settings)
+    for name, profile in profiles.items():
+        try:
+            profile.check()
+        except ValueError as e:
+            raise ValueError(f"Invalid performance profile {name!r}: {e}") from None
+    return profiles
+
+
+def get_profile(name: str, path: Path = PERFORMANCE_PROFILES_FILE) -> PerformanceProfile:
+    profiles = load_profiles(path)
+    if name not in profiles:
+        raise ValueError(f"Unknown performance profile {name!r}, available: {', '.join(profiles)}")
+    return profiles[name]
+
+
+def save_profile(name: str, profile: PerformanceProfile, path: Path = PERFORMANCE_PROFILES_FILE) -> None:
+    """Add or replace a profile in the profiles file, keeping the other saved profiles."""
+    saved = {}
+    if path.exists():
+        with open(path) as f:
+            saved = json.load(f)
+    saved[name] = profile._asdict()
+    path.parent.mkdir(exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=2)
+
+
+def generation_options(overrides: Optional[dict] = None) -> dict:
+    """Generation settings of the active profile, with the values set in `overrides` replacing them."""
+    options = active_profile.generation_options()
+    options.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    return options
+
+
+# Selected when the server starts
+active_profile = get_profile(PERFORMANCE_PROFILE)
+logger.info(f"Using performance profile {PERFORMANCE_PROFILE!r}")
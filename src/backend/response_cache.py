@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import List, Optional
+
+import diskcache
+
+from .parameters import (
+    MODEL_FACTORY,
+    MODEL_FILENAME,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_MAX_BYTES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_deterministic(options: dict) -> bool:
+    """Whether sampling with `options` always gives the same response to the same messages."""
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+
+class ResponseCache:
+    """Responses of previous requests, keyed by the messages sent to the model and the sampling options.
+    Stored on disk with `diskcache`, which evicts the least recently used entries once the cache
+    exceeds `max_bytes`. The directory is opened on first use, so importing this module is free.
+    """
+
+    def __init__(self, cache_dir=RESPONSE_CACHE_DIR, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.num_hits = 0
+        self.num_misses = 0
+        self._cache: Optional[diskcache.Cache] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(messages: List[dict], options: dict) -> str:
+        # The same messages give different responses with another model
+        payload = {"model": MODEL_FACTORY or MODEL_FILENAME, "messages": messages, "options": options}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        """The cached `{"response", "completion_tokens", "finish_reason"}` of a request, or None."""
+        result = self._open().get(key)
+        with self._lock:
+            if result is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+        return result
+
+    def put(self, key: str, response: str, completion_tokens: int, finish_reason: str) -> None:
+        self._open().set(
+            key,
+            {"response": response, "completion_tokens": completion_tokens, "finish_reason": finish_reason},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "num_bytes": self._cache.volume() if self._cache is not None else 0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+    def _open(self) -> diskcache.Cache:
+        with self._lock:
+            if self._cache is None:
+                self._cache = diskcache.Cache(
+                    str(self.cache_dir),
+                    size_limit=self.max_bytes,
+                    eviction_policy="least-recently-used",
+                )
+            return self._cache
+
+
+response_cache = ResponseCache()
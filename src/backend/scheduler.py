@@ -0,0 +1,298 @@
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterator, Optional
+
+from llama_cpp import Llama
+from . import inference
+from .parameters import MAX_QUEUE_SIZE, REQUEST_DEADLINE_S
+
+logger = logging.getLogger(__name__)
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+_END = object()  # marks the end of a job's events
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the scheduler queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full. Retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a job is still waiting for the model after its deadline."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Request deadline exceeded while waiting for the model.")
+        self.retry_after = retry_after
+
+
+class JobCancelledError(Exception):
+    """Raised when a job is cancelled before the worker starts it."""
+
+    def __init__(self):
+        super().__init__("Request cancelled before generation started.")
+
+
+class InferenceJob:
+    """A unit of work for the inference worker.
+    `fn(llm, *args)` must return an iterator of events, which the caller consumes with `events()`.
+    While waiting for it, the caller can run `poll` every `poll_interval_s`, e.g. to cancel the job
+    when its client has disconnected.
+    """
+
+    def __init__(self, fn: Callable[..., Iterator[Any]], args: tuple, deadline: float):
+        self.fn = fn
+        self.args = args
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.started = threading.Event()
+        self.expired = False  # set by the caller when it gives up waiting
+        self.cancelled = False
+        self.on_cancel: Optional[Callable[["InferenceJob"], None]] = None  # set by the scheduler
+        self._lock = threading.Lock()
+        self._settled = threading.Event()  # started or cancelled
+        self._events: "queue.Queue[Any]" = queue.Queue()
+
+    def put(self, event: Any) -> None:
+        self._events.put(event)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self._events.put(error if error is not None else _END)
+
+    def start(self) -> bool:
+        """Called by the worker when it picks up the job, returns False if it was cancelled."""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.started.set()
+            self._settled.set()
+            return True
+
+    def cancel(self) -> None:
+        """Drop the job if it is still queued, or ask the worker to stop it early if it is running.
+        A running generation then ends with a `cancelled` finish reason.
+        """
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            running = self.started.is_set()
+            if not running:
+                self._settled.set()
+        if not running:
+            self.finish(JobCancelledError())
+        elif self.on_cancel is not None:
+            self.on_cancel(self)
+
+    def wait_started(
+        self,
+        retry_after: int = 1,
+        poll: Optional[Callable[[], None]] = None,
+        poll_interval_s: float = 0.5,
+    ) -> None:
+        """Block until the worker picks up the job, or raise if the deadline passes first
+        or the job is cancelled.
+        """
+        while True:
+            remaining_s = self.deadline - time.monotonic()
+            if self._settled.wait(timeout=max(0.0, min(poll_interval_s, remaining_s))):
+                break
+            if time.monotonic() >= self.deadline:
+                self.expired = True
+                # The worker may have picked it up in the meantime
+                if not self.started.is_set():
+                    raise DeadlineExceededError(retry_after)
+                return
+            if poll is not None:
+                poll()
+        if not self.started.is_set():
+            raise JobCancelledError()
+
+    def events(
+        self, poll: Optional[Callable[[], None]] = None, poll_interval_s: float = 0.5
+    ) -> Iterator[Any]:
+        """Yield the events produced by the worker until the job ends."""
+        polled_at = time.monotonic()
+        while True:
+            if poll is not None and time.monotonic() - polled_at >= poll_interval_s:
+                poll()
+                polled_at = time.monotonic()
+            try:
+                event = self._events.get(timeout=poll_interval_s if poll is not None else None)
+            except queue.Empty:
+                continue
+            if event is _END:
+                return
+            if isinstance(event, BaseException):
+                raise event
+            yield event
+
+    def result(self, poll: Optional[Callable[[], None]] = None) -> Any:
+        """Wait for the job to end and return its last event."""
+        last = None
+        for event in self.events(poll):
+            last = event
+        return last
+
+
+class InferenceScheduler:
+    """Serializes all model calls on a single worker thread that owns the `Llama` instance.
+    Jobs wait in a bounded priority queue. When the queue is full, `submit` fails fast
+    with `QueueFullError` instead of letting requests pile up, and jobs still queued
+    after their deadline are dropped.
+    A running job is cancelled through `cancel_event`, which the job's function polls, see
+    `inference.cancel_event`. Cancelled jobs that are still queued are skipped.
+    """
+
+    def __init__(
+        self,
+        llm: Llama,
+        max_queue_size: int = MAX_QUEUE_SIZE,
+        deadline_s: float = REQUEST_DEADLINE_S,
+        cancel_event: Optional[Any] = None,
+    ):
+        self.llm = llm
+        self.deadline_s = deadline_s
+        self.cancel_event = cancel_event if cancel_event is not None else inference.cancel_event
+        self._running_job: Optional[InferenceJob] = None
+        self._running_lock = threading.Lock()
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue(maxsize=max_queue_size)
+        self._counter = itertools.count()  # keeps FIFO order among jobs of the same priority
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._running = False
+        self._busy = False
+
+        # Statistics
+        self._wait_times = deque(maxlen=100)
+        self._service_times = deque(maxlen=100)
+        self.num_completed = 0
+        self.num_rejected = 0
+        self.num_expired = 0
+        self.num_cancelled = 0
+
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the worker after the job it is running. Queued jobs are failed."""
+        self._running = False
+        self._wake()
+        self._thread.join()
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            if job is not None:
+                job.finish(RuntimeError("Inference scheduler stopped."))
+
+    def submit(
+        self,
+        fn: Callable[..., Iterator[Any]],
+        *args,
+        priority: int = PRIORITY_INTERACTIVE,
+        timeout: Optional[float] = None,
+        affinity_key: Optional[str] = None,
+    ) -> InferenceJob:
+        """Queue `fn(llm, *args)` for the worker, or raise `QueueFullError` if the queue is full.
+        `affinity_key` is only used for routing by `WorkerPool`, a single worker serves every key.
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.deadline_s)
+        job = InferenceJob(fn, args, deadline)
+        job.on_cancel = self._cancel_running
+        try:
+            self._queue.put_nowait((priority, next(self._counter), job))
+        except queue.Full:
+            self.num_rejected += 1
+            raise QueueFullError(self.retry_after())
+        return job
+
+    def retry_after(self) -> int:
+        """Estimate in seconds how long it takes the worker to drain the current queue."""
+        avg_service_time = (
+            sum(self._service_times) / len(self._service_times) if self._service_times else 1.0
+        )
+        return max(1, math.ceil(avg_service_time * (self._queue.qsize() + 1)))
+
+    def load(self) -> int:
+        """Number of jobs waiting for or running on the worker."""
+        return self._queue.qsize() + int(self._busy)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "busy": self._busy,
+            "max_queue_size": self._queue.maxsize,
+            "avg_wait_s": sum(self._wait_times) / len(self._wait_times) if self._wait_times else 0.0,
+            "max_wait_s": max(self._wait_times, default=0.0),
+            "num_completed": self.num_completed,
+            "num_rejected": self.num_rejected,
+            "num_expired": self.num_expired,
+            "num_cancelled": self.num_cancelled,
+        }
+
+    def _run(self) -> None:
+        while self._running:
+            _, _, job = self._queue.get()
+            self._prepare()
+            if job is None:
+                continue
+            if job.expired or time.monotonic() > job.deadline:
+                # Nobody is waiting for the result anymore
+                self.num_expired += 1
+                job.finish(DeadlineExceededError(self.retry_after()))
+                continue
+
+            with self._running_lock:
+                if not job.start():
+                    # Its caller already got a `JobCancelledError`
+                    self.num_cancelled += 1
+                    continue
+                self.cancel_event.clear()
+                self._running_job = job
+
+            started_at = time.monotonic()
+            self._wait_times.append(started_at - job.enqueued_at)
+            self._busy = True
+            try:
+                for event in self._execute(job):
+                    job.put(event)
+            except Exception as e:
+                logger.exception("Inference job failed")
+                job.finish(e)
+            else:
+                job.finish()
+            with self._running_lock:
+                self._running_job = None
+            if job.cancelled:
+                self.num_cancelled += 1
+            self._busy = False
+            self._service_times.append(time.monotonic() - started_at)
+            self.num_completed += 1
+
+    def _cancel_running(self, job: InferenceJob) -> None:
+        with self._running_lock:
+            if self._running_job is job:
+                self.cancel_event.set()
+
+    def _wake(self) -> None:
+        """Make the worker run `_prepare` without submitting a job."""
+        try:
+            self._queue.put_nowait((-math.inf, next(self._counter), None))
+        except queue.Full:
+            pass  # the worker runs `_prepare` before the next of the queued jobs anyway
+
+    def _prepare(self) -> None:
+        """Called by the worker before each job and wake-up."""
+
+    def _execute(self, job: InferenceJob) -> Iterator[Any]:
+        """Run a job against the model and return its events."""
+        return job.fn(self.llm, *job.args)
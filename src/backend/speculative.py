@@ -0,0 +1,104 @@
+import logging
+from typing import Any, Optional
+
+import llama_cpp
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from .parameters import (
+    DRAFT_MODEL_PATH,
+    SPECULATIVE_DECODING,
+    SPECULATIVE_MAX_NGRAM_SIZE,
+    SPECULATIVE_NUM_PRED_TOKENS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """Drafts tokens greedily with a small local model sharing the vocabulary of the main model,
+    e.g. Llama-3.2-1B-Instruct for Llama-3.2-3B-Instruct.
+    """
+
+    def __init__(
+        self, model_path: str, num_pred_tokens: int, n_ctx: int, n_threads: Optional[int] = None
+    ):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        draft = []
+        # `generate` reuses the longest matching prefix, so only the new tokens are evaluated
+        for token in self.llm.generate(input_ids.tolist(), temp=0.0):
+            if llama_cpp.llama_token_is_eog(self.llm._model.vocab, token):
+                break
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+class DraftStatistics(LlamaDraftModel):
+    """Wraps a draft model to count how many of its drafted tokens the main model accepts.
+    `Llama.generate` calls the draft model with all tokens so far. The tokens added since the
+    previous call are the accepted part of the previous draft, followed by one token sampled by
+    the main model, so the accepted count is the length of their common prefix with that draft.
+    The last draft of a generation may be cut short by the end of the response, so it is not counted.
+    """
+
+    def __init__(self, draft_model: LlamaDraftModel):
+        self.draft_model = draft_model
+        self.reset()
+
+    def reset(self) -> None:
+        """Start counting for a new generation."""
+        self.num_drafted = 0
+        self.num_accepted = 0
+        self._last_draft = np.array([], dtype=np.intc)
+        self._last_length = 0
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        self.resolve(input_ids)
+        draft = self.draft_model(input_ids, **kwargs)
+        self._last_draft = draft
+        self._last_length = len(input_ids)
+        return draft
+
+    def resolve(self, input_ids: npt.NDArray[np.intc]) -> None:
+        """Count the tokens of the previous draft that ended up in `input_ids`."""
+        if len(self._last_draft) == 0 or len(input_ids) <= self._last_length:
+            return
+        added = input_ids[self._last_length : self._last_length + len(self._last_draft)]
+        mismatches = np.nonzero(added != self._last_draft[: len(added)])[0]
+        self.num_drafted += len(self._last_draft)
+        self.num_accepted += int(mismatches[0]) if len(mismatches) else len(added)
+        self._last_draft = np.array([], dtype=np.intc)
+
+    def stats(self) -> dict:
+        return {
+            "num_drafted": self.num_drafted,
+            "num_accepted": self.num_accepted,
+            "acceptance_rate": self.num_accepted / self.num_drafted if self.num_drafted else None,
+        }
+
+
+def create_draft_model(n_ctx: int, n_threads: Optional[int] = None) -> Optional[DraftStatistics]:
+    """Draft model configured by `SPECULATIVE_DECODING`, or None to decode without speculation."""
+    if SPECULATIVE_DECODING is None:
+        return None
+    if SPECULATIVE_DECODING == "prompt_lookup":
+        draft_model = LlamaPromptLookupDecoding(
+            max_ngram_size=SPECULATIVE_MAX_NGRAM_SIZE, num_pred_tokens=SPECULATIVE_NUM_PRED_TOKENS
+        )
+    elif SPECULATIVE_DECODING == "draft_model":
+        if DRAFT_MODEL_PATH is None:
+            raise ValueError("SPECULATIVE_DECODING is 'draft_model' but DRAFT_MODEL_PATH is not set")
+        draft_model = GGUFDraftModel(
+            str(DRAFT_MODEL_PATH.expanduser()), SPECULATIVE_NUM_PRED_TOKENS, n_ctx, n_threads
+        )
+    else:
+        raise ValueError(f"Unknown speculative decoding mode: {SPECULATIVE_DECODING}")
+    logger.info(f"Using speculative decoding with {type(draft_model).__name__}")
+    return DraftStatistics(draft_model)
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+from llama_cpp import Llama, LlamaState
+from .parameters import STATE_CACHE_DIR, STATE_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+def strip_logits(state: LlamaState) -> LlamaState:
+    """Drop the logits saved with a model state, which are as large as the whole batch buffer.
+    Generating from a restored state always evaluates at least one more token, so they are never read.
+    """
+    return LlamaState(
+        input_ids=state.input_ids,
+        scores=np.zeros((1, state.scores.shape[1]), dtype=np.single),
+        n_tokens=state.n_tokens,
+        llama_state=state.llama_state,
+        llama_state_size=state.llama_state_size,
+        seed=state.seed,
+    )
+
+
+def state_size(state: LlamaState) -> int:
+    """Bytes held by a model state: the KV cache, the tokens and the logits if they were not stripped."""
+    return state.llama_state_size + state.input_ids.nbytes + state.scores.nbytes
+
+
+class SessionStateCache:
+    """LRU cache of llama.cpp model states (KV cache and input tokens) keyed by session ID.
+    The model only holds the context of one session at a time. When another session is served,
+    the state of the previous one is saved here, so that it only needs to evaluate the new turn
+    when it comes back instead of re-evaluating the whole conversation.
+    States exceeding the memory budget are spilled to disk, oldest first.
+    """
+
+    def __init__(self, max_bytes: int = STATE_CACHE_MAX_BYTES, cache_dir: Path = STATE_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.active_session_id: Optional[str] = None  # session currently loaded in the model
+        self._states: "OrderedDict[str, LlamaState]" = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self._drop_listeners: List[Callable[[str], None]] = []
+
+    def restore(self, llm: Llama, session_id: str) -> bool:
+        """Make `llm` hold the context of `session_id` before generating for it.
+        Returns True if the model already holds, or was restored to, a cached state of the session.
+        """
+        with self._lock:
+            if self.active_session_id == session_id:
+                return True
+            if self.active_session_id is not None:
+                self._put(self.active_session_id, llm.save_state())
+            state = self._take(session_id)
+            if state is not None:
+                llm.load_state(state)
+                logger.debug(f"Restored model state for session {session_id}")
+            # The model holds this session's context from now on, even if it starts from scratch
+            self.active_session_id = session_id
+            return state is not None
+
+    def release(self, llm: Llama) -> None:
+        """Save the state of the active session before `llm` is used for something else."""
+        with self._lock:
+            if self.active_session_id is not None:
+                self._put(self.active_session_id, llm.save_state())
+                self.active_session_id = None
+
+    def drop(self, session_id: str) -> None:
+        """Forget the cached state of a session whose history has changed."""
+        with self._lock:
+            state = self._states.pop(session_id, None)
+            if state is not None:
+                self._num_bytes -= state_size(state)
+            self._spill_path(session_id).unlink(missing_ok=True)
+            if self.active_session_id == session_id:
+                self.active_session_id = None
+        for listener in self._drop_listeners:
+            listener(session_id)
+
+    def add_drop_listener(self, listener: Callable[[str], None]) -> None:
+        """Call `listener(session_id)` whenever a session state is dropped,
+        e.g. to forward the drop to caches held by other processes.
+        """
+        self._drop_listeners.append(listener)
+
+    def clear(self) -> None:
+        """Remove all cached states, including the ones spilled to disk."""
+        with self._lock:
+            self._states.clear()
+            self._num_bytes = 0
+            self.active_session_id = None
+            if self.cache_dir.exists():
+                # Including the directories of the worker processes, see `worker_pool._worker_main`
+                for path in self.cache_dir.rglob("*.state"):
+                    path.unlink(missing_ok=True)
+
+    def _put(self, session_id: str, state: LlamaState) -> None:
+        state = strip_logits(state)
+        self._states[session_id] = state
+        self._num_bytes += state_size(state)
+        # Evict least recently used states until the budget is met
+        while self._num_bytes > self.max_bytes and self._states:
+            evicted_id, evicted_state = self._states.popitem(last=False)
+            self._num_bytes -= state_size(evicted_state)
+            self._spill(evicted_id, evicted_state)
+
+    def _take(self, session_id: str) -> Optional[LlamaState]:
+        """Remove and return the state of a session from memory or disk."""
+        state = self._states.pop(session_id, None)
+        if state is not None:
+            self._num_bytes -= state_size(state)
+            return state
+
+        spill_path = self._spill_path(session_id)
+        if spill_path.exists():
+            try:
+                with open(spill_path, "rb") as f:
+                    state = pickle.load(f)
+                logger.debug(f"Loaded spilled model state for session {session_id}")
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                # A missing state only costs a full re-evaluation of the history
+                logger.warning(f"Discarding unreadable model state for session {session_id}: {e}")
+            spill_path.unlink(missing_ok=True)
+        return state
+
+    def _spill(self, session_id: str, state: LlamaState) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self._spill_path(session_id), "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.debug(f"Spilled model state for session {session_id} to disk")
+
+    def _spill_path(self, session_id: str) -> Path:
+        # Session IDs come from clients, so hash them instead of using them as file names
+        return self.cache_dir / f"{hashlib.sha256(session_id.encode('utf-8')).hexdigest()}.state"
+
+
+session_state_cache = SessionStateCache()
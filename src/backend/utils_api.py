@@ -1,81 +1,163 @@
 import uuid
-from typing import Tuple, List, Optional
+from collections import defaultdict
+from typing import NamedTuple, Tuple, List, Optional
 import logging
 import datetime
 
+from sqlalchemy import bindparam, delete, func, insert, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from llama_cpp import Llama
-from .chat_history_db import ChatSession, Message
-from .model import MAX_TOKENS
+from .chat_history_db import ChatSession, Message, summarized_until_subquery, utc_now
+from .history_cache import history_cache
+from .prefix_cache import system_prompt_cache
+from .profiles import active_profile
+from .state_cache import session_state_cache
 
 logger = logging.getLogger(__name__)
 
 
-def get_or_create_session(
-    db: Session, session_id: Optional[str] = None
+class ConversationTurn(NamedTuple):
+    """A user prompt and the LLM response to it, waiting to be saved."""
+
+    session_id: str
+    prompt: str
+    response_text: str
+    num_new_msg_tokens: int
+    num_response_tokens: int
+    timestamp: datetime.datetime
+    # Embeddings of the prompt and the response in retrieval mode, filled in by the writer if missing
+    prompt_embedding: Optional[bytes] = None
+    response_embedding: Optional[bytes] = None
+
+
+async def get_or_create_session(
+    db: AsyncSession, session_id: Optional[str] = None
 ) -> Tuple[str, ChatSession]:
-    """Get an existing session or create a new one."""
+    """Get an existing session or create a new one.
+    New sessions are not written here, their row is created when their first turn is saved.
+    """
     if not session_id:
         session_id = str(uuid.uuid4())
 
-    db_session = (
-        db.query(ChatSession).filter(ChatSession.session_id == session_id).first()
-    )
+    db_session = await db.get(ChatSession, session_id)
     if not db_session:
-        db_session = ChatSession(session_id=session_id)
-        db.add(db_session)
-        db.commit()
+        # Column defaults only apply on insert, so set them on the unsaved object
+        db_session = ChatSession(
+            session_id=session_id, num_tokens=0, summary_tokens=0, summarized_until=0
+        )
         logger.info(f"Created session for ID: {session_id}")
 
     return session_id, db_session
 
 
-def clear_session_history(db: Session, session_id: str) -> None:
-    """Clear all messages for a given session."""
-    db.query(Message).filter(Message.session_id == session_id).delete()
-    db.commit()
+async def clear_session_history(db: AsyncSession, session_id: str) -> None:
+    """Clear all messages and the summary of a given session."""
+    await db.execute(delete(Message).where(Message.session_id == session_id))
+    await db.execute(
+        update(ChatSession)
+        .where(ChatSession.session_id == session_id)
+        .values(num_tokens=0, summary=None, summary_tokens=0, summarized_until=0)
+    )
+    await db.commit()
+    history_cache.clear(session_id)
+    session_state_cache.drop(session_id)
     logger.info(f"Cleared history for session {session_id}")
 
 
 def validate_token_limits(
-    llm: Llama, system_message: str, prompt: str
+    llm: Llama, system_message: str, prompt: str, max_response_tokens: int
 ) -> Tuple[int, int, int]:
-    """Validate that messages are within token limits and return token counts."""
+    """Validate that messages are within token limits and return token counts.
+    Raises ValueError when the system message, the prompt and a response of up to
+    `max_response_tokens` do not fit in the context.
+    """
     # llm.tokenize expects UTF-8 encoded bytes
-    sys_msg_tokens = llm.tokenize(system_message.encode("utf-8"))
     new_msg_tokens = llm.tokenize(prompt.encode("utf-8"))
     num_new_msg_tokens = len(new_msg_tokens)
-    num_sys_token = len(sys_msg_tokens)
+    # Sessions mostly share a few system messages, which are only tokenized once
+    num_sys_token = system_prompt_cache.num_tokens(llm, system_message)
     num_sys_msg_token = num_sys_token + num_new_msg_tokens
 
-    assert (
-        num_sys_msg_token < MAX_TOKENS
-    ), f"Input exceeds maximum token limit of {MAX_TOKENS}. Current count: {num_sys_msg_token}"
+    if num_sys_msg_token + max_response_tokens >= active_profile.n_ctx:
+        raise ValueError(
+            f"Input exceeds maximum token limit of {active_profile.n_ctx} with max_tokens of "
+            f"{max_response_tokens}. Current count: {num_sys_msg_token}"
+        )
 
     return num_new_msg_tokens, num_sys_token, num_sys_msg_token
 
 
-def trim_history_if_needed(
-    db: Session, db_messages: List[Message], num_total_tokens: int, num_sys_token: int
+async def trim_history_if_needed(
+    db: AsyncSession,
+    session_id: str,
+    num_total_tokens: int,
+    num_sys_token: int,
+    max_response_tokens: int,
+    num_unsaved_tokens: int = 0,
 ) -> None:
     """Trim conversation history if it exceeds token limits.
-    If the total number of tokens exceeds 80% of the maximum token limit,
-    this function removes the oldest messages from the history until the
-    total token count falls below the threshold.
+    The context must hold the system message, the history, the next prompt and a response of up to
+    `max_response_tokens`. If the total number of tokens exceeds 80% of what the response leaves,
+    the rest being kept for the next prompt, this function removes the oldest messages from the
+    history until the total token count falls below the threshold.
+    `num_unsaved_tokens` are the tokens of the turn being saved, which is not in the database yet
+    and is kept whole.
+    The cut-off is found with one windowed query and the messages are removed with one bulk delete,
+    so the cost does not grow with the number of removed messages.
     """
-    max_tokens_limit = (MAX_TOKENS * 0.8) - num_sys_token
+    max_tokens_limit = (active_profile.n_ctx - max_response_tokens) * 0.8 - num_sys_token
     if num_total_tokens > max_tokens_limit:
         logger.warning(
-            f"Total tokens {num_total_tokens} exceed 80% of max limit {max_tokens_limit}. Trimming history."
+            f"Total tokens {num_total_tokens} exceed the history limit {max_tokens_limit}. Trimming history."
         )
-        # Calculate how many tokens we need to remove
-        num_current = sum(msg.num_tokens for msg in db_messages)
-        # Remove oldest messages until we reach the limit
-        while (num_current > max_tokens_limit) and len(db_messages) > 0:
-            oldest_msg = db_messages.pop(0)
-            db.delete(oldest_msg)
-            num_current -= oldest_msg.num_tokens
-        db.commit()
+        # Running token count from the newest message backwards
+        window = (
+            select(
+                Message.id,
+                Message.timestamp,
+                Message.num_tokens,
+                func.sum(Message.num_tokens)
+                .over(order_by=(Message.timestamp.desc(), Message.id.desc()))
+                .label("num_newer_tokens"),
+            )
+            .where(
+                Message.session_id == session_id,
+                # Messages folded into the summary are not part of the prompt anymore
+                Message.id > summarized_until_subquery(session_id),
+            )
+            .subquery()
+        )
+        # The newest message that does not fit is the cut-off, it and everything older is removed
+        cutoff = (
+            await db.execute(
+                select(window)
+                .where(window.c.num_newer_tokens > max_tokens_limit - num_unsaved_tokens)
+                .order_by(
+                    window.c.num_newer_tokens, window.c.timestamp.desc(), window.c.id.desc()
+                )
+                .limit(1)
+            )
+        ).first()
+        if cutoff is None:
+            return
+
+        # The cached model state no longer matches the trimmed history
+        session_state_cache.drop(session_id)
+        await db.execute(
+            delete(Message).where(
+                Message.session_id == session_id,
+                tuple_(Message.timestamp, Message.id) <= (cutoff.timestamp, cutoff.id),
+            )
+        )
+        await db.execute(
+            update(ChatSession)
+            .where(ChatSession.session_id == session_id)
+            .values(num_tokens=cutoff.num_newer_tokens - cutoff.num_tokens)
+        )
+        await db.commit()
+        history_cache.invalidate(session_id)
 
 
 def save_conversation(
@@ -87,25 +169,89 @@ def save_conversation(
     num_response_tokens: int,
 ) -> None:
     """Save user prompt and LLM response to the database."""
-    db_session = (
-        db.query(ChatSession).filter(ChatSession.session_id == session_id).first()
+    save_turns(
+        db,
+        [
+            ConversationTurn(
+                session_id,
+                prompt,
+                response_text,
+                num_new_msg_tokens,
+                num_response_tokens,
+                utc_now(),
+            )
+        ],
     )
-    db.add(
-        Message(
-            session_id=session_id,
-            role="user",
-            content=prompt,
-            num_tokens=num_new_msg_tokens,
+
+
+def save_turns(db: Session, turns: List[ConversationTurn]) -> None:
+    """Save conversation turns, possibly from many sessions, in a single transaction.
+    The number of statements does not depend on the number of turns.
+    """
+    if not turns:
+        return
+
+    # Create the rows of new sessions
+    db.execute(
+        sqlite_insert(ChatSession)
+        .values(
+            [
+                {
+                    "session_id": turn.session_id,
+                    "created_at": turn.timestamp,
+                    "last_activity": turn.timestamp,
+                    "num_tokens": 0,
+                }
+                for turn in turns
+            ]
         )
+        .on_conflict_do_nothing(index_elements=["session_id"])
     )
-    db.add(
-        Message(
-            session_id=session_id,
-            role="assistant",
-            content=response_text,
-            num_tokens=num_response_tokens,
+
+    message_rows = []
+    session_updates = defaultdict(lambda: {"num_tokens": 0, "last_activity": None})
+    for turn in turns:
+        message_rows.append(
+            {
+                "session_id": turn.session_id,
+                "role": "user",
+                "content": turn.prompt,
+                "timestamp": turn.timestamp,
+                "num_tokens": turn.num_new_msg_tokens,
+                "embedding": turn.prompt_embedding,
+            }
         )
+        message_rows.append(
+            {
+                "session_id": turn.session_id,
+                "role": "assistant",
+                "content": turn.response_text,
+                "timestamp": turn.timestamp,
+                "num_tokens": turn.num_response_tokens,
+                "embedding": turn.response_embedding,
+            }
+        )
+        session_update = session_updates[turn.session_id]
+        session_update["num_tokens"] += turn.num_new_msg_tokens + turn.num_response_tokens
+        session_update["last_activity"] = turn.timestamp
+    db.execute(insert(Message), message_rows)
+
+    # Update sessions' last activity and token count
+    sessions = ChatSession.__table__
+    db.execute(
+        update(sessions)
+        .where(sessions.c.session_id == bindparam("target_session_id"))
+        .values(
+            last_activity=bindparam("last_activity"),
+            num_tokens=sessions.c.num_tokens + bindparam("added_tokens"),
+        ),
+        [
+            {
+                "target_session_id": session_id,
+                "last_activity": session_update["last_activity"],
+                "added_tokens": session_update["num_tokens"],
+            }
+            for session_id, session_update in session_updates.items()
+        ],
     )
-    # Update session's last activity
-    db_session.last_activity = datetime.datetime.now(datetime.timezone.utc)
     db.commit()
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterator, List, Optional
+
+from . import inference
+from .inference import drop_session_state
+from .model import load_model
+from .parameters import NUM_WORKERS, STATE_CACHE_DIR, WORKER_MAX_PENDING, WORKER_N_THREADS
+from .profiles import active_profile
+from .scheduler import (
+    PRIORITY_INTERACTIVE,
+    InferenceJob,
+    InferenceScheduler,
+    QueueFullError,
+)
+from .state_cache import session_state_cache
+
+logger = logging.getLogger(__name__)
+
+# Spawn fresh interpreters, forking a process that runs threads (and llama.cpp) is unsafe
+_mp = multiprocessing.get_context("spawn")
+
+PRIORITY_CONTROL = -10  # cache maintenance jobs jump ahead of generation
+
+
+class WorkerDiedError(Exception):
+    """Raised when a worker process exits while it is loading the model or running a job."""
+
+
+class NoWorkerAvailableError(Exception):
+    """Raised when no worker process is ready to accept jobs."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("No inference worker is available.")
+        self.retry_after = retry_after
+
+
+def _worker_main(worker_id: int, n_threads: Optional[int], jobs, results, cancel_event) -> None:
+    """Entry point of a worker process: load a model and run the jobs sent by the parent."""
+    # Set by the parent to stop the running job
+    inference.cancel_event = cancel_event
+    # Sessions can move between workers, so each one spills the states it holds to its own directory
+    session_state_cache.cache_dir = STATE_CACHE_DIR / f"worker-{worker_id}"
+    # States spilled by a previous process of this worker missed the drops sent while it was down
+    session_state_cache.clear()
+    llm = load_model(n_threads=n_threads)
+    results.put(("ready", None))
+    while True:
+        item = jobs.get()
+        if item is None:
+            break
+        fn, args = item
+        try:
+            for event in fn(llm, *args):
+                results.put(("event", event))
+        except Exception as e:
+            # Exceptions are not always picklable, so only send their description
+            results.put(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+        else:
+            results.put(("end", None))
+
+
+class RemoteWorker(InferenceScheduler):
+    """Inference scheduler whose jobs run in a child process holding its own `Llama` instance.
+    The queueing, admission control and deadlines are handled in the parent process, the child
+    only runs one job at a time. A child that dies is restarted by the worker thread.
+    """
+
+    def __init__(self, worker_id: int, n_threads: Optional[int], **kwargs):
+        # Shared with the child process, which polls it while generating
+        super().__init__(llm=None, cancel_event=_mp.Event(), **kwargs)
+        self.worker_id = worker_id
+        self.n_threads = n_threads
+        self.ready = threading.Event()  # set while the child process has a model loaded
+        self._process = None
+        self._jobs = None
+        self._results = None
+        self._thread.name = f"inference-worker-{worker_id}"
+
+    def stop(self) -> None:
+        super().stop()
+        if self._process is not None and self._process.is_alive():
+            self._jobs.put(None)
+            self._process.join(timeout=10)
+            if self._process.is_alive():
+                self._process.terminate()
+        self.ready.clear()
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "pid": self._process.pid if self._process is not None else None,
+            "ready": self.ready.is_set(),
+            **super().stats(),
+        }
+
+    def start(self) -> None:
+        super().start()
+        self._wake()  # the worker thread starts the child process
+
+    def check_alive(self) -> bool:
+        """Detect a child process that died while idle and have it restarted."""
+        if self.ready.is_set() and not self._process.is_alive():
+            logger.error(f"Inference worker {self.worker_id} died, restarting it")
+            self.ready.clear()
+            self._wake()
+        return self.ready.is_set()
+
+    def _prepare(self) -> None:
+        if self._running and not self.ready.is_set():
+            try:
+                self._spawn()
+            except Exception:
+                # Routing skips this worker until it is restarted by a later job or `check_alive`
+                logger.exception(f"Inference worker {self.worker_id} failed to start")
+
+    def _spawn(self) -> None:
+        """Start a child process and wait until it has loaded the model."""
+        self._jobs = _mp.Queue()
+        self._results = _mp.Queue()
+        self._process = _mp.Process(
+            target=_worker_main,
+            args=(self.worker_id, self.n_threads, self._jobs, self._results, self.cancel_event),
+            name=f"inference-worker-{self.worker_id}",
+            daemon=True,
+        )
+        self._process.start()
+        self._receive()
+        self.ready.set()
+        logger.info(f"Inference worker {self.worker_id} ready (pid {self._process.pid})")
+
+    def _receive(self) -> tuple:
+        """Wait for the next message of the child process, checking that it is still alive."""
+        while True:
+            try:
+                return self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self.ready.clear()
+                    self._wake()  # restart it once the current job has failed
+                    raise WorkerDiedError(
+                        f"Inference worker {self.worker_id} exited with code {self._process.exitcode}"
+                    )
+
+    def _execute(self, job: InferenceJob) -> Iterator[Any]:
+        if not self.ready.is_set():
+            raise WorkerDiedError(f"Inference worker {self.worker_id} is not running")
+        self._jobs.put((job.fn, job.args))
+        while True:
+            kind, payload = self._receive()
+            if kind == "event":
+                yield payload
+            elif kind == "error":
+                raise payload
+            else:
+                return
+
+
+class WorkerPool:
+    """Pool of out-of-process inference workers with session affinity.
+    Every session is routed to the same worker, so that the model context of the session
+    stays warm there. The worker of a session is chosen by rendezvous hashing, so when a worker
+    dies only its own sessions move. Sessions whose worker is overloaded go to the next
+    worker in their ranking instead.
+    The pool has the same interface as `InferenceScheduler`.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = NUM_WORKERS,
+        n_threads: Optional[int] = WORKER_N_THREADS,
+        max_pending: int = WORKER_MAX_PENDING,
+    ):
+        if n_threads is None:
+            n_threads = active_profile.n_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.max_pending = max_pending
+        self.workers: List[RemoteWorker] = [
+            RemoteWorker(worker_id, n_threads) for worker_id in range(num_workers)
+        ]
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+        # History changes are handled in this process, but the states live in the workers
+        session_state_cache.add_drop_listener(self.drop_session_state)
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+
+    def wait_ready(self) -> None:
+        """Block until every worker has loaded its model, skipping workers that failed to start."""
+        for worker in self.workers:
+            while not worker.ready.wait(timeout=1.0):
+                if worker._process is not None and worker._process.exitcode is not None:
+                    break
+
+    def submit(
+        self,
+        fn: Callable[..., Iterator[Any]],
+        *args,
+        priority: int = PRIORITY_INTERACTIVE,
+        timeout: Optional[float] = None,
+        affinity_key: Optional[str] = None,
+    ) -> InferenceJob:
+        worker = self.route(affinity_key)
+        return worker.submit(fn, *args, priority=priority, timeout=timeout)
+
+    def route(self, affinity_key: Optional[str] = None) -> RemoteWorker:
+        """Pick the worker for a job, preferring the one that owns `affinity_key`."""
+        ready = [worker for worker in self.workers if worker.check_alive()]
+        if not ready:
+            raise NoWorkerAvailableError(self.retry_after())
+        if affinity_key is None:
+            return min(ready, key=lambda worker: worker.load())
+
+        ranked = _rank_workers(ready, affinity_key)
+        for worker in ranked:
+            if worker.load() < self.max_pending:
+                return worker
+        return min(ranked, key=lambda worker: worker.load())
+
+    def drop_session_state(self, session_id: str) -> None:
+        """Drop the cached state of a session on the worker that owns it.
+        Workers that ran the session while its owner was overloaded or down may keep a stale state,
+        which is only a missed cache hit: llama.cpp re-evaluates the tokens that do not match.
+        A restarted worker starts without states.
+        """
+        ready = [worker for worker in self.workers if worker.ready.is_set()]
+        if not ready:
+            return
+        worker = _rank_workers(ready, session_id)[0]
+        try:
+            worker.submit(drop_session_state, session_id, priority=PRIORITY_CONTROL)
+        except QueueFullError:
+            logger.warning(f"Could not drop state of session {session_id} on worker {worker.worker_id}")
+
+    def retry_after(self) -> int:
+        return min(worker.retry_after() for worker in self.workers)
+
+    def stats(self) -> dict:
+        worker_stats = [worker.stats() for worker in self.workers]
+        return {
+            "queue_depth": sum(stats["queue_depth"] for stats in worker_stats),
+            "num_ready_workers": sum(stats["ready"] for stats in worker_stats),
+            "workers": worker_stats,
+        }
+
+
+def _rank_workers(workers: List[RemoteWorker], key: str) -> List[RemoteWorker]:
+    """Workers in the order of preference of `key`, its owner first."""
+    return sorted(workers, key=lambda worker: _rendezvous_score(key, worker.worker_id), reverse=True)
+
+
+def _rendezvous_score(key: str, worker_id: int) -> int:
+    """Stable score of a (key, worker) pair, the highest scoring worker owns the key."""
+    digest = hashlib.sha1(f"{key}:{worker_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
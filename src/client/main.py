@@ -1,31 +1,87 @@
+import gzip
+import json
 import requests
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Optional
 import sys
 import signal
 from urllib.parse import urljoin
 
 import typer
 
-from .utils import load_config, update_config, cleanup_session
-from .parameters import DEFAULT_SYSTEM_MESSAGE, API_URL
+from .utils import (
+    cancel_generation,
+    cleanup_session,
+    create_http_session,
+    iter_pages,
+    load_config,
+    post_with_retries,
+    request_with_retries,
+    update_config,
+)
+from .parameters import (
+    API_URL,
+    BATCH_CONCURRENCY,
+    DEFAULT_SYSTEM_MESSAGE,
+    HISTORY_PAGE_SIZE,
+    TRANSFER_CHUNK_BYTES,
+)
 
 app = typer.Typer()
-CHAT_URL = urljoin(API_URL, "chat/")
+# No trailing slash, "/chat/" is redirected to "/chat" with an extra round trip
+CHAT_URL = urljoin(API_URL, "chat")
+SESSIONS_URL = urljoin(API_URL, "sessions")
+# Responses stopped by the backend before their end, whose turn is not saved
+ABORTED_FINISH_REASONS = {"cancelled", "timeout"}
+
+
+class GenerationInterrupted(Exception):
+    """Raised by the signal handler when Ctrl+C is pressed while a response is being generated."""
 
 
 def signal_handler(sig, frame):
-    """Handle termination signals by cleaning up the current session."""
+    """Handle termination signals by cleaning up the current session.
+    Ctrl+C while a response is being generated only cancels that response.
+    """
+    if sig == signal.SIGINT and generating:
+        raise GenerationInterrupted()
     typer.echo("\nReceived termination signal. Closing session...")
     if active_session_id:
-        cleanup_session(active_session_id)
+        cleanup_session(active_session_id, active_http)
     sys.exit(0)
 
 
+def print_streamed_response(response: requests.Response) -> Optional[str]:
+    """Render server-sent event chunks as they arrive and return the session ID sent at the end."""
+    session_id = None
+    typer.echo("LLaMA: ", nl=False)
+    for line in response.iter_lines(decode_unicode=True):
+        # Events are separated by blank lines and each payload is prefixed with "data: "
+        if not line or not line.startswith("data: "):
+            continue
+        event = json.loads(line[len("data: ") :])
+        if "token" in event:
+            typer.echo(event["token"], nl=False)
+        elif event.get("done"):
+            session_id = event.get("session_id")
+    typer.echo("\n")
+    return session_id
+
+
 @app.command()
-def chat():
+def chat(
+    stream: bool = typer.Option(
+        True, "--stream/--no-stream", help="Render the response while it is generated"
+    ),
+):
     """Start an interactive chat with the LLaMA model running on the backend."""
-    global active_session_id
+    global active_session_id, active_http, generating
     active_session_id = None  # Initialize global variable to track session ID
+    generating = False  # True while waiting for a response, when Ctrl+C cancels it
+    # Every turn reuses the same keep-alive connection to the backend
+    active_http = create_http_session()
 
     # Set up signal handlers for graceful termination
     signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C
@@ -51,7 +107,7 @@ def chat():
             elif prompt.lower() == "/clear":
                 if session_id:
                     try:
-                        response = requests.post(
+                        response = active_http.post(
                             CHAT_URL,
                             json={
                                 "prompt": "< History clearance request >",
@@ -68,27 +124,246 @@ def chat():
                     typer.echo("No active conversation to clear.\n")
             else:
                 try:
-                    response = requests.post(
+                    generating = True
+                    response = post_with_retries(
+                        active_http,
                         CHAT_URL,
-                        json={
+                        {
                             "prompt": prompt,
                             "system_message": system_message,
                             "session_id": session_id,
                             "clear_history": False,
+                            "stream": stream,
                         },
+                        stream=stream,
                     )
                     response.raise_for_status()
-                    typer.echo(f"LLaMA: {response.json()['response']}\n")
-                    session_id = response.json().get("session_id", session_id)
+                    if stream:
+                        session_id = print_streamed_response(response) or session_id
+                    else:
+                        typer.echo(f"LLaMA: {response.json()['response']}\n")
+                        session_id = response.json().get("session_id", session_id)
                     # Update the global variable when we get a session_id
                     active_session_id = session_id
+                except GenerationInterrupted:
+                    # Closing the connection also makes the backend stop, e.g. for a new session
+                    active_http.close()
+                    active_http = create_http_session()
+                    cancel_generation(session_id, active_http)
+                    typer.echo("\n[Cancelled] The response was not added to the conversation.\n")
                 except requests.exceptions.RequestException as e:
                     typer.echo(f"[Error] Failed to connect to backend: {e}\n")
+                finally:
+                    generating = False
     finally:
         # Clean up operations on exit
         if active_session_id:
-            cleanup_session(active_session_id)
+            cleanup_session(active_session_id, active_http)
             active_session_id = None  # Clear the global variable
+        active_http.close()
+
+
+def run_conversation(
+    http: requests.Session, conversation: dict, default_system_message: str, keep_session: bool
+) -> dict:
+    """Send the prompts of one conversation in order and return its transcript."""
+    system_message = conversation.get("system_message", default_system_message)
+    result = {"id": conversation.get("id"), "session_id": None, "turns": []}
+    try:
+        for prompt in conversation["prompts"]:
+            started_at = time.perf_counter()
+            response = post_with_retries(
+                http,
+                CHAT_URL,
+                {
+                    "prompt": prompt,
+                    "system_message": system_message,
+                    "session_id": result["session_id"],
+                },
+            )
+            response.raise_for_status()
+            body = response.json()
+            result["session_id"] = body["session_id"]
+            if body.get("finish_reason") in ABORTED_FINISH_REASONS:
+                # The turn is missing from the history, the next prompts would lack its context
+                result["error"] = (
+                    f"Response to prompt {len(result['turns'])} stopped early ({body['finish_reason']})"
+                )
+                break
+            result["turns"].append(
+                {
+                    "prompt": prompt,
+                    "response": body["response"],
+                    "latency_s": round(time.perf_counter() - started_at, 3),
+                }
+            )
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        result["error"] = str(e)
+    finally:
+        if result["session_id"] and not keep_session:
+            try:
+                http.delete(f"{API_URL}/sessions/{result['session_id']}")
+            except requests.exceptions.RequestException:
+                pass  # a leftover session only takes up space in the database
+    return result
+
+
+@app.command()
+def batch(
+    input_file: Path = typer.Argument(
+        ..., exists=True, dir_okay=False, help="JSONL file with one conversation per line"
+    ),
+    output_file: Path = typer.Argument(..., dir_okay=False, help="JSONL file to write the results to"),
+    concurrency: int = typer.Option(
+        BATCH_CONCURRENCY, "--concurrency", "-c", min=1, help="Conversations run in parallel"
+    ),
+    keep_sessions: bool = typer.Option(
+        False, "--keep-sessions", help="Keep the sessions on the backend after they finish"
+    ),
+):
+    """Run the conversations of a JSONL file against the backend and save the responses.
+    Each input line is an object like {"id": "...", "system_message": "...", "prompts": ["...", "..."]},
+    where the ID and the system message are optional. A result line is written for every
+    conversation as soon as it finishes, so the output is not in input order.
+    """
+    with open(input_file) as f:
+        conversations = [json.loads(line) for line in f if line.strip()]
+    default_system_message = load_config()["system_message"]
+
+    http = create_http_session(pool_size=concurrency)
+    num_failed = 0
+    with open(output_file, "w") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                run_conversation, http, conversation, default_system_message, keep_sessions
+            )
+            for conversation in conversations
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            num_failed += "error" in result
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    http.close()
+    typer.echo(
+        f"Finished {len(conversations)} conversations ({num_failed} failed), results saved to {output_file}"
+    )
+
+
+@app.command()
+def history(
+    session_id: Optional[str] = typer.Argument(
+        None, help="Session whose messages to show, the sessions are listed when omitted"
+    ),
+    output_file: Optional[Path] = typer.Option(
+        None, "--output", "-o", dir_okay=False, help="Write to this file instead of the terminal"
+    ),
+    page_size: int = typer.Option(
+        HISTORY_PAGE_SIZE, "--page-size", min=1, max=1000, help="Messages or sessions fetched per request"
+    ),
+):
+    """Show the messages of a session saved on the backend, or list the saved sessions.
+    The history is fetched and written one page at a time, so long histories are never loaded at once.
+    """
+    http = create_http_session()
+    out = open(output_file, "w") if output_file else sys.stdout
+    try:
+        if session_id:
+            for message in iter_pages(http, f"{SESSIONS_URL}/{session_id}", "messages", page_size):
+                speaker = "You" if message["role"] == "user" else "LLaMA"
+                out.write(f"[{message['timestamp']}] {speaker}: {message['content']}\n\n")
+        else:
+            for session in iter_pages(http, SESSIONS_URL, "sessions", page_size):
+                out.write(
+                    f"{session['session_id']}  last active {session['last_activity']}  "
+                    f"{session['message_count']} messages\n"
+                )
+    except requests.exceptions.RequestException as e:
+        typer.echo(f"[Error] Failed to fetch the history: {e}")
+        raise typer.Exit(1)
+    finally:
+        if output_file:
+            out.close()
+        http.close()
+
+
+def open_transfer_file(path: Path, mode: str):
+    """Open an export file, gzip-compressed when its name ends with .gz like the session archive."""
+    return gzip.open(path, mode) if path.suffix == ".gz" else open(path, mode)
+
+
+def read_chunks(path: Path) -> Iterator[bytes]:
+    """Contents of an export file, read as it is uploaded."""
+    with open_transfer_file(path, "rb") as f:
+        yield from iter(lambda: f.read(TRANSFER_CHUNK_BYTES), b"")
+
+
+@app.command()
+def export(
+    output_file: Path = typer.Argument(
+        ..., dir_okay=False, help="NDJSON file to write the sessions to, compressed if it ends with .gz"
+    ),
+    session_id: Optional[str] = typer.Option(None, "--session", "-s", help="Only export this session"),
+):
+    """Export the sessions saved on the backend, one JSON line per session with its messages.
+    The export is written to the file as it is received.
+    """
+    params = {"session_id": session_id} if session_id else {}
+    num_sessions = 0
+    http = create_http_session()
+    try:
+        with request_with_retries(
+            http, "GET", f"{SESSIONS_URL}/export", params=params, stream=True
+        ) as response:
+            response.raise_for_status()
+            with open_transfer_file(output_file, "wb") as out:
+                for chunk in response.iter_content(chunk_size=TRANSFER_CHUNK_BYTES):
+                    out.write(chunk)
+                    num_sessions += chunk.count(b"\n")
+    except requests.exceptions.RequestException as e:
+        typer.echo(f"[Error] Failed to export the sessions: {e}")
+        raise typer.Exit(1)
+    finally:
+        http.close()
+    typer.echo(f"Exported {num_sessions} sessions to {output_file}")
+
+
+@app.command("import")
+def import_sessions(
+    input_file: Path = typer.Argument(
+        ...,
+        exists=True,
+        dir_okay=False,
+        help="File written by the export command, or a session archive of the backend",
+    ),
+):
+    """Load the sessions of an export file into the backend. Sessions that already exist are skipped.
+    The file is uploaded as it is read, and decompressed on the way if it ends with .gz.
+    """
+    http = create_http_session()
+    try:
+        # Sessions imported before a retried failure are skipped by the next attempt
+        response = request_with_retries(
+            http,
+            "POST",
+            f"{SESSIONS_URL}/import",
+            open_body=lambda: read_chunks(input_file),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+    except requests.exceptions.RequestException as e:
+        typer.echo(f"[Error] Failed to import the sessions: {e}")
+        raise typer.Exit(1)
+    finally:
+        http.close()
+    if not response.ok:
+        is_json = response.headers.get("Content-Type", "").startswith("application/json")
+        typer.echo(f"[Error] Failed to import the sessions: {response.json()['detail'] if is_json else response.text}")
+        raise typer.Exit(1)
+    result = response.json()
+    typer.echo(
+        f"Imported {result['imported']} sessions with {result['messages']} messages, "
+        f"skipped {result['skipped']} that already exist"
+    )
 
 
 @app.command()
@@ -4,6 +4,14 @@ CONFIG_DIR = Path(__file__).resolve().parent.parent.parent / "config"
 CONFIG_FILE = CONFIG_DIR / "chatbot_config.json"
 API_URL = "http://localhost:8000"
 
+# HTTP client parameters
+# Requests rejected with 429 (queue full) or 503 (model loading, deadline exceeded) are retried
+MAX_RETRIES = 5
+RETRY_BACKOFF_S = 1.0  # doubled on every retry, used when the server sends no Retry-After header
+BATCH_CONCURRENCY = 4  # conversations run in parallel by the batch command
+HISTORY_PAGE_SIZE = 100  # messages or sessions fetched per request by the history command
+TRANSFER_CHUNK_BYTES = 64 * 1024  # export and import files are streamed in chunks of this size
+
 # Default system message if none is set
 DEFAULT_SYSTEM_MESSAGE = """You are a helpful, respectful and honest assistant. \
     Always answer as helpfully as possible, while being safe, and using the same language written by the user as a multilingual assistant. \
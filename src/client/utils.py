@@ -1,10 +1,23 @@
 import json
 import os
+import time
+from typing import Callable, Iterator, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
 
 import typer
 
-from .parameters import CONFIG_DIR, CONFIG_FILE, DEFAULT_SYSTEM_MESSAGE, API_URL
+from .parameters import (
+    API_URL,
+    CONFIG_DIR,
+    CONFIG_FILE,
+    DEFAULT_SYSTEM_MESSAGE,
+    MAX_RETRIES,
+    RETRY_BACKOFF_S,
+)
+
+RETRY_STATUS_CODES = {429, 503}
 
 
 def load_config():
@@ -36,12 +49,56 @@ def update_config(updates: dict):
     return config
 
 
-def cleanup_session(session_id: str):
+def create_http_session(pool_size: int = 1) -> requests.Session:
+    """HTTP client keeping up to `pool_size` connections to the backend alive between requests."""
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+def request_with_retries(
+    http: requests.Session,
+    method: str,
+    url: str,
+    max_retries: int = MAX_RETRIES,
+    open_body: Optional[Callable[[], Iterator[bytes]]] = None,
+    **kwargs,
+) -> requests.Response:
+    """Send a request, retrying while the backend is busy or still loading the model.
+    The delay between attempts follows the server's Retry-After header when it sends one.
+    A body streamed from a file is given as `open_body`, called again for every attempt.
+    """
+    for attempt in range(max_retries + 1):
+        if open_body is not None:
+            kwargs["data"] = open_body()
+        response = http.request(method, url, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+            return response
+        retry_after = response.headers.get("Retry-After")
+        delay = float(retry_after) if retry_after else RETRY_BACKOFF_S * 2**attempt
+        response.close()  # return the connection to the pool
+        time.sleep(delay)
+
+
+def post_with_retries(
+    http: requests.Session,
+    url: str,
+    payload: dict,
+    stream: bool = False,
+    max_retries: int = MAX_RETRIES,
+) -> requests.Response:
+    """POST `payload` as JSON, retrying while the backend is busy or still loading the model."""
+    return request_with_retries(http, "POST", url, max_retries, json=payload, stream=stream)
+
+
+def cleanup_session(session_id: str, http: Optional[requests.Session] = None):
     # API_URL is a Path object, convert it to string for requests
     delete_url = f"{API_URL}/sessions/{session_id}"
     if session_id:
         try:
-            response = requests.delete(delete_url)
+            response = (http or requests).delete(delete_url)
             if response.status_code == 200:
                 typer.echo(f"Session {session_id} cleaned up successfully.")
             else:
@@ -53,3 +110,30 @@ def cleanup_session(session_id: str):
     else:
         # Nothing to clean up
         pass
+
+
+def cancel_generation(session_id: Optional[str], http: Optional[requests.Session] = None):
+    """Ask the backend to stop generating the response of a session, which is then not saved."""
+    if not session_id:
+        # A new session has no ID yet, the backend stops when the connection is closed
+        return
+    try:
+        (http or requests).post(f"{API_URL}/sessions/{session_id}/cancel")
+    except requests.exceptions.RequestException as e:
+        typer.echo(f"Error while cancelling the response: {e}")
+
+
+def iter_pages(http: requests.Session, url: str, key: str, page_size: int) -> Iterator[dict]:
+    """Yield the items under `key` of every page of a paginated endpoint, one request per page."""
+    cursor = None
+    while True:
+        params = {"limit": page_size}
+        if cursor:
+            params["cursor"] = cursor
+        response = http.get(url, params=params)
+        response.raise_for_status()
+        page = response.json()
+        yield from page[key]
+        cursor = page.get("next_cursor")
+        if not cursor:
+            return
@@ -0,0 +1,89 @@
+import functools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "chat_history.db")
+# Read when the backend modules are imported
+os.environ["CLICHATBOT_DB_URL"] = f"sqlite:///{DB_PATH}"
+os.environ["CLICHATBOT_MODEL_FACTORY"] = "benchmarks.fake_llama:FakeLlama"
+os.environ["FAKE_LLAMA_DECODE_S_PER_TOKEN"] = "0.02"
+os.environ["FAKE_LLAMA_RESPONSE_TOKENS"] = "50"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src.backend import main  # noqa: E402
+from src.backend.main import app  # noqa: E402
+from src.backend.persistence import WriteBehindWriter  # noqa: E402
+from src.backend.scheduler import InferenceJob  # noqa: E402
+
+SYSTEM_MESSAGE = "You are a test assistant."
+
+
+def wait_until_ready(client: TestClient) -> None:
+    for _ in range(100):
+        if client.get("/readyz").status_code == 200:
+            return
+        time.sleep(0.1)
+    raise TimeoutError("The model did not load")
+
+
+def count_rows(session_id: str) -> tuple:
+    with sqlite3.connect(DB_PATH) as conn:
+        num_sessions = conn.execute(
+            "SELECT COUNT(*) FROM chat_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+        num_messages = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+    return num_sessions, num_messages
+
+
+def test_turn_in_flight_does_not_restore_deleted_session(monkeypatch):
+    # The generation ends before the cancellation reaches it, so its turn is still submitted
+    monkeypatch.setattr(InferenceJob, "cancel", lambda self: None)
+    with TestClient(app) as client:
+        wait_until_ready(client)
+        session_id = client.post(
+            "/chat", json={"prompt": "Hello", "system_message": SYSTEM_MESSAGE}
+        ).json()["session_id"]
+
+        responses = []
+        turn = threading.Thread(
+            target=lambda: responses.append(
+                client.post(
+                    "/chat",
+                    json={"prompt": "Again", "system_message": SYSTEM_MESSAGE, "session_id": session_id},
+                )
+            )
+        )
+        turn.start()
+        while session_id not in app.state.active_jobs:
+            time.sleep(0.01)
+        deleted = client.delete(f"/sessions/{session_id}").json()
+        turn.join()
+
+        assert deleted["status"] == "success"
+        assert responses[0].status_code == 200
+        app.state.writer.wait_for_all()
+        assert count_rows(session_id) == (0, 0)
+
+
+def test_delete_session_with_queued_turns_only(monkeypatch):
+    # Keep the first turn of a new session in the queue
+    monkeypatch.setattr(main, "WriteBehindWriter", functools.partial(WriteBehindWriter, flush_interval_s=60))
+    with TestClient(app) as client:
+        wait_until_ready(client)
+        writer = app.state.writer
+        session_id = client.post(
+            "/chat", json={"prompt": "Hello", "system_message": SYSTEM_MESSAGE}
+        ).json()["session_id"]
+        assert writer.has_unsaved(session_id)
+
+        deleted = client.delete(f"/sessions/{session_id}").json()
+
+        assert deleted["status"] == "success"
+        assert not writer.has_unsaved(session_id)
+        assert count_rows(session_id) == (0, 0)